@@ -66,9 +66,27 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Тестовая база в файле: в общей памяти SQLite параллельные
+        # запросы из потоков падают с "table is locked" вместо ожидания
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
+# Режим SQLite для параллельных запросов: WAL, BEGIN IMMEDIATE в atomic()
+# и постоянные соединения (food_plan/sqlite_backend). Только для базы
+# на локальном диске; сравнение со стандартным режимом - команда bench_sqlite
+SQLITE_CONCURRENT = env.bool('SQLITE_CONCURRENT', False)
+if SQLITE_CONCURRENT:
+    DATABASES['default'].update({
+        'ENGINE': 'food_plan.sqlite_backend',
+        'CONN_MAX_AGE': env.int('DB_CONN_MAX_AGE', 600),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+    })
+
 
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -125,6 +143,35 @@ YOOKASSA_SHOP_ID = env.str('YOOKASSA_SHOP_ID')
 YOOKASSA_SECRET_KEY = env.str('YOOKASSA_SECRET_KEY')
 YOOKASSA_REDIRECT_URI = 'https://yelena0000.pythonanywhere.com/yoomoney/callback/'
 YOOKASSA_RETURN_URL = 'https://yelena0000.pythonanywhere.com/payment/success/'
+# Адрес API; для нагрузочных проверок указывается локальная заглушка,
+# например http://127.0.0.1:8099/v3 (команда run_yookassa_stub)
+YOOKASSA_API_URL = env.str('YOOKASSA_API_URL', 'https://api.yookassa.ru/v3')
+# Таймауты запросов к API ЮKassa, секунды: соединение и ожидание ответа
+YOOKASSA_CONNECT_TIMEOUT = env.float('YOOKASSA_CONNECT_TIMEOUT', 3)
+YOOKASSA_TIMEOUT = env.float('YOOKASSA_TIMEOUT', 10)
+# Размер пула потоков для вызовов SDK из асинхронных view
+YOOKASSA_MAX_CONCURRENCY = env.int('YOOKASSA_MAX_CONCURRENCY', 32)
+# Обрабатывать оплату асинхронными view (для запуска через asgi.py)
+YOOKASSA_ASYNC_CHECKOUT = env.bool('YOOKASSA_ASYNC_CHECKOUT', False)
+# Проверка уведомлений: 'api' - статус всегда перечитывается через API,
+# 'ip' - уведомлениям с адресов ЮKassa доверяем без запроса к API
+YOOKASSA_WEBHOOK_VERIFICATION = env.str('YOOKASSA_WEBHOOK_VERIFICATION', 'api')
+# Адреса, с которых ЮKassa отправляет уведомления
+YOOKASSA_TRUSTED_NETWORKS = env.list('YOOKASSA_TRUSTED_NETWORKS', default=[
+    '185.71.76.0/27',
+    '185.71.77.0/27',
+    '77.75.153.0/25',
+    '77.75.156.11',
+    '77.75.156.35',
+    '77.75.154.128/25',
+    '2a02:5180::/32',
+])
+# Заголовок с адресом отправителя, если приложение стоит за прокси,
+# например HTTP_X_FORWARDED_FOR
+YOOKASSA_WEBHOOK_IP_HEADER = env.str('YOOKASSA_WEBHOOK_IP_HEADER', 'REMOTE_ADDR')
+# Перечитывать через API неподтверждённые и неоднозначные уведомления;
+# если выключено, уведомления с чужих адресов отклоняются
+YOOKASSA_WEBHOOK_API_FALLBACK = env.bool('YOOKASSA_WEBHOOK_API_FALLBACK', True)
 
 CSRF_TRUSTED_ORIGINS = [
     'https://yelena0000.pythonanywhere.com/',
@@ -0,0 +1,50 @@
+"""SQLite для смешанной нагрузки чтения и записи из нескольких потоков.
+
+Отличия от стандартного бэкенда:
+
+* на каждом новом соединении выполняются PRAGMA из ``OPTIONS['pragmas']``
+  (по умолчанию WAL, synchronous=NORMAL, busy_timeout, mmap_size и
+  cache_size): в режиме WAL чтение не ждёт запись и наоборот;
+* транзакции ``atomic()`` открываются как ``BEGIN IMMEDIATE``
+  (``OPTIONS['transaction_mode']``). При обычном ``BEGIN`` транзакция,
+  которая сначала читает, а потом пишет, не может дождаться блокировки
+  записи и сразу падает с "database is locked". IMMEDIATE берёт
+  блокировку при открытии, и конкуренты ждут её в пределах busy_timeout.
+
+WAL требует локальной файловой системы: на сетевых дисках его включать нельзя.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 20000,
+    'mmap_size': 128 * 1024 * 1024,
+    # Отрицательное значение - размер в килобайтах, а не в страницах
+    'cache_size': -32000,
+}
+
+TRANSACTION_MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        self.pragmas = {**DEFAULT_PRAGMAS, **params.pop('pragmas', {})}
+        self.transaction_mode = params.pop('transaction_mode', 'IMMEDIATE').upper()
+        if self.transaction_mode not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(
+                f"transaction_mode должен быть одним из {', '.join(TRANSACTION_MODES)}"
+            )
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(f'BEGIN {self.transaction_mode}')
@@ -12,13 +12,40 @@ urlpatterns = [
     path('auth/', views.auth_view, name='auth'),
     path('registration/', views.register_view, name='registration'),
     path('lk/', views.lk_view, name='lk'),
+    path('lk/shopping-list/', views.shopping_list, name='shopping_list'),
+    path('lk/meal-plan/', views.meal_plan_view, name='meal_plan'),
+    path(
+        'export/shopping-lists/',
+        views.export_shopping_lists,
+        name='export_shopping_lists',
+    ),
     path('order/', views.order_view, name='order'),
     path('card/', views.card, name='card'),
     path('logout/', views.logout_view, name='logout'),
     path('update-profile/', views.update_profile, name='update_profile'),
     path('card/<int:dish_id>/', views.dish_card, name='card'),
     path('update_avatar/', views.update_avatar, name='update_avatar'),
-    path('create-payment/', views.create_payment, name='create_payment'),
-    path('payment/success/', views.payment_success, name='payment_success'),
+    path(
+        'create-payment/',
+        views.create_payment_async
+        if settings.YOOKASSA_ASYNC_CHECKOUT else views.create_payment,
+        name='create_payment',
+    ),
+    path(
+        'payment/success/',
+        views.payment_success_async
+        if settings.YOOKASSA_ASYNC_CHECKOUT else views.payment_success,
+        name='payment_success',
+    ),
+    path(
+        'create-payment/async/',
+        views.create_payment_async,
+        name='create_payment_async',
+    ),
+    path(
+        'payment/success/async/',
+        views.payment_success_async,
+        name='payment_success_async',
+    ),
     path('yookassa-webhook/', views.yookassa_webhook, name='yookassa_webhook'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -1,15 +1,41 @@
-from django.contrib import admin
+import time
+
+from django.contrib import admin, messages
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
 from django.utils.html import format_html
-from django.utils import timezone
+from .forms import PriceImportForm
 from .models import (
     Allergy,
+    DailyMenu,
     DietType,
     UserProfile,
     Ingredient,
     Dish,
     DishIngredient,
-    SubscriptionOrder
+    SubscriptionOrder,
+    WebhookEvent,
 )
+from .price_import import PriceImportError, import_prices, read_price_rows
+
+
+class SubscriptionActivityFilter(admin.SimpleListFilter):
+    title = 'подписка'
+    parameter_name = 'subscription'
+
+    def lookups(self, request, model_admin):
+        return (
+            ('active', 'Активна'),
+            ('expired', 'Истекла или нет'),
+        )
+
+    def queryset(self, request, queryset):
+        if self.value() == 'active':
+            return queryset.active()
+        if self.value() == 'expired':
+            return queryset.expired()
+        return queryset
 
 
 @admin.register(Allergy)
@@ -27,7 +53,10 @@ class DietTypeAdmin(admin.ModelAdmin):
 @admin.register(UserProfile)
 class UserProfileAdmin(admin.ModelAdmin):
     list_display = ('user', 'diet_type', 'subscription_status', 'count_of_persons')
-    list_filter = ('diet_type', 'breakfast', 'lunch', 'dinner', 'dessert')
+    list_filter = (
+        SubscriptionActivityFilter, 'diet_type', 'breakfast', 'lunch', 'dinner', 'dessert',
+    )
+    list_select_related = ('user', 'diet_type')
     search_fields = ('user__username',)
     filter_horizontal = ('allergies',)
 
@@ -43,13 +72,18 @@ class UserProfileAdmin(admin.ModelAdmin):
         }),
     )
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_subscription_status()
+
     def subscription_status(self, obj):
-        if obj.subscription_end_date:
-            if obj.subscription_end_date >= timezone.now().date():
-                return f"Активна до {obj.subscription_end_date.strftime('%d.%m.%Y')}"
-            return f"Истекла {obj.subscription_end_date.strftime('%d.%m.%Y')}"
-        return "Нет подписки"
+        if not obj.subscription_end_date:
+            return "Нет подписки"
+        end_date = obj.subscription_end_date.strftime('%d.%m.%Y')
+        if obj.subscription_is_active:
+            return f"Активна до {end_date}"
+        return f"Истекла {end_date}"
     subscription_status.short_description = 'Статус подписки'
+    subscription_status.admin_order_field = 'subscription_is_active'
 
 
 @admin.register(Ingredient)
@@ -59,17 +93,87 @@ class IngredientAdmin(admin.ModelAdmin):
     search_fields = ('name',)
     filter_horizontal = ('allergens',)
 
+    def get_urls(self):
+        return [
+            path(
+                'import-prices/',
+                self.admin_site.admin_view(self.import_prices_view),
+                name='planner_ingredient_import_prices',
+            ),
+        ] + super().get_urls()
+
+    def import_prices_view(self, request):
+        if not self.has_change_permission(request):
+            return redirect('admin:planner_ingredient_changelist')
+
+        form = PriceImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            file = form.cleaned_data['file']
+            started = time.perf_counter()
+            try:
+                stats = import_prices(read_price_rows(file, file.name))
+            except (PriceImportError, UnicodeDecodeError) as e:
+                form.add_error('file', str(e))
+            else:
+                elapsed = time.perf_counter() - started
+                self.message_user(
+                    request,
+                    f"Строк: {stats['rows']}, обновлено ингредиентов: {stats['updated']}, "
+                    f"не найдено: {stats['unknown']}, с ошибками: {stats['invalid']}, "
+                    f"пересчитано блюд: {stats['dishes']} "
+                    f"({stats['rows'] / max(elapsed, 1e-6):.0f} строк в секунду)",
+                    messages.SUCCESS,
+                )
+                return redirect('admin:planner_ingredient_changelist')
+
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Загрузка прайс-листа',
+            'form': form,
+        }
+        return TemplateResponse(request, 'admin/planner/ingredient/import_prices.html', context)
+
 
 class DishIngredientInline(admin.TabularInline):
     model = DishIngredient
     extra = 1
     fields = ('ingredient', 'quantity')
+    autocomplete_fields = ('ingredient',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('ingredient')
+
+
+class DishPriceFilter(admin.SimpleListFilter):
+    title = 'стоимость'
+    parameter_name = 'price'
+    ranges = {
+        'lt200': ('до 200 руб', None, 200),
+        '200-500': ('200–500 руб', 200, 500),
+        '500-1000': ('500–1000 руб', 500, 1000),
+        'gte1000': ('от 1000 руб', 1000, None),
+    }
+
+    def lookups(self, request, model_admin):
+        return [(key, label) for key, (label, _, _) in self.ranges.items()]
+
+    def queryset(self, request, queryset):
+        if self.value() not in self.ranges:
+            return queryset
+        _, low, high = self.ranges[self.value()]
+        if low is not None:
+            queryset = queryset.filter(cached_price__gte=low)
+        if high is not None:
+            queryset = queryset.filter(cached_price__lt=high)
+        return queryset
 
 
 @admin.register(Dish)
 class DishAdmin(admin.ModelAdmin):
     list_display = ('name', 'category', 'diet_type', 'total_price', 'total_calories')
-    list_filter = ('category', 'diet_type')
+    list_filter = ('category', 'diet_type', DishPriceFilter)
+    list_select_related = ('diet_type',)
     search_fields = ('name', 'description')
     inlines = [DishIngredientInline]
 
@@ -85,16 +189,28 @@ class DishAdmin(admin.ModelAdmin):
     def total_price(self, obj):
         return f"{obj.total_price:.2f} руб"
     total_price.short_description = 'Стоимость'
+    total_price.admin_order_field = 'cached_price'
 
     def total_calories(self, obj):
         return f"{obj.total_calories:.0f} ккал"
     total_calories.short_description = 'Калории'
+    total_calories.admin_order_field = 'cached_calories'
+
+
+@admin.register(DailyMenu)
+class DailyMenuAdmin(admin.ModelAdmin):
+    list_display = ('profile', 'date', 'category', 'dish', 'price', 'calories')
+    list_filter = ('date', 'category')
+    search_fields = ('profile__user__username',)
+    list_select_related = ('profile__user', 'dish')
+    raw_id_fields = ('profile', 'dish')
 
 
 @admin.register(SubscriptionOrder)
 class SubscriptionOrderAdmin(admin.ModelAdmin):
-    list_display = ('id', 'user', 'amount', 'status', 'created_at')
-    list_filter = ('status', 'created_at')
+    list_display = ('id', 'user', 'amount', 'status', 'subscription_active', 'created_at')
+    list_filter = ('status', SubscriptionActivityFilter, 'created_at')
+    list_select_related = ('user',)
     search_fields = ('user__username', 'description')
     readonly_fields = ('created_at', 'payment_details')
 
@@ -117,3 +233,20 @@ class SubscriptionOrderAdmin(admin.ModelAdmin):
                 str(obj.payment_data))
         return "Нет данных"
     payment_details.short_description = 'Детали платежа'
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_activity()
+
+    def subscription_active(self, obj):
+        return obj.is_active
+    subscription_active.short_description = 'Подписка активна'
+    subscription_active.boolean = True
+    subscription_active.admin_order_field = 'subscription_is_active'
+
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('event', 'payment_id', 'status', 'attempts', 'received_at', 'processed_at')
+    list_filter = ('status', 'event')
+    search_fields = ('payment_id',)
+    readonly_fields = ('received_at', 'processed_at')
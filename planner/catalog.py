@@ -0,0 +1,143 @@
+"""Снимок каталога блюд в памяти процесса.
+
+Каталог меняется только из админки, поэтому подбор меню для личного
+кабинета можно делать по колонкам в памяти, а не запросами к базе.
+Снимок перечитывается, когда сигналы моделей и загрузчики каталога
+увеличивают версию в таблице CatalogVersion, общей для всех процессов.
+"""
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import CatalogVersion, Dish
+
+
+# Версия каталога хранится в единственной строке таблицы
+CATALOG_VERSION_ID = 1
+
+CATEGORY_CODES = {
+    'breakfast': 0,
+    'lunch': 1,
+    'dinner': 2,
+    'dessert': 3,
+}
+
+_lock = threading.Lock()
+_catalog = None
+
+
+def get_catalog_version():
+    version = CatalogVersion.objects.filter(
+        pk=CATALOG_VERSION_ID
+    ).values_list('version', flat=True).first()
+    return version or 1
+
+
+def increment_catalog_version():
+    versions = CatalogVersion.objects.filter(pk=CATALOG_VERSION_ID)
+    if versions.update(version=F('version') + 1):
+        return
+    try:
+        with transaction.atomic():
+            CatalogVersion.objects.create(pk=CATALOG_VERSION_ID, version=2)
+    except IntegrityError:
+        # Строку одновременно создал другой процесс
+        versions.update(version=F('version') + 1)
+
+
+def bump_catalog_version():
+    # Версия меняется только после фиксации транзакции: иначе параллельный
+    # запрос успел бы закешировать старые строки под новой версией
+    transaction.on_commit(increment_catalog_version)
+
+
+class MenuCatalog:
+    """Колонки каталога, отсортированные по (тип диеты, категория, id)."""
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.ids = array('q')
+        self.diet_types = array('q')
+        self.categories = array('b')
+        self.allergen_masks = array('q')
+        # Цены в копейках, чтобы сравнение с бюджетом было точным
+        self.prices = array('q')
+        self.calories = array('d')
+        # Ключ сегмента (тип диеты, категория) для бинарного поиска
+        self._segment_keys = array('q')
+
+        rows = sorted(
+            rows,
+            key=lambda row: (row[2] or 0, CATEGORY_CODES.get(row[1], -1), row[0]),
+        )
+        for dish_id, category, diet_type_id, mask, price, calories in rows:
+            category_code = CATEGORY_CODES.get(category)
+            if category_code is None:
+                continue
+            diet_type_id = diet_type_id or 0
+            self.ids.append(dish_id)
+            self.diet_types.append(diet_type_id)
+            self.categories.append(category_code)
+            self.allergen_masks.append(mask)
+            self.prices.append(int(price * 100))
+            self.calories.append(float(calories))
+            self._segment_keys.append(diet_type_id * len(CATEGORY_CODES) + category_code)
+        self._positions = {dish_id: position for position, dish_id in enumerate(self.ids)}
+
+    @classmethod
+    def load(cls, version):
+        rows = Dish.objects.values_list(
+            'id', 'category', 'diet_type_id',
+            'allergen_mask', 'cached_price', 'cached_calories',
+        )
+        return cls(version, rows)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def totals(self, dish_id):
+        """Цена в рублях и калорийность одной порции блюда."""
+        position = self._positions[dish_id]
+        return Decimal(self.prices[position]) / 100, Decimal(str(self.calories[position]))
+
+    def segment(self, diet_type_id, category):
+        key = diet_type_id * len(CATEGORY_CODES) + CATEGORY_CODES[category]
+        return (
+            bisect_left(self._segment_keys, key),
+            bisect_right(self._segment_keys, key),
+        )
+
+    def select(self, diet_type_id, categories, allergen_mask=0, persons=1,
+               budget=None):
+        """Возвращает id подходящих блюд по категориям в порядке id."""
+        budget = int(budget * 100) if budget else None
+        masks = self.allergen_masks
+        prices = self.prices
+
+        selected = {}
+        for category in categories:
+            start, stop = self.segment(diet_type_id, category)
+            positions = [
+                position for position in range(start, stop)
+                if not masks[position] & allergen_mask
+                and (budget is None or prices[position] * persons <= budget)
+            ]
+            selected[category] = [self.ids[position] for position in positions]
+        return selected
+
+
+def get_catalog():
+    global _catalog
+    version = get_catalog_version()
+    catalog = _catalog
+    if catalog is not None and catalog.version == version:
+        return catalog
+
+    with _lock:
+        if _catalog is None or _catalog.version != version:
+            _catalog = MenuCatalog.load(version)
+        return _catalog
@@ -0,0 +1,307 @@
+"""Массовая загрузка каталога блюд из JSON или CSV.
+
+JSON-каталог::
+
+    {
+        "ingredients": [
+            {"name": "Лосось", "unit": "g", "price": "1.80", "callories": "2.08",
+             "allergens": ["Рыба и морепродукты"]}
+        ],
+        "dishes": [
+            {"name": "Лосось на пару", "diet_type": "Низкоуглеводное",
+             "category": "dinner", "description": "...", "recipe": "...",
+             "ingredients": [{"name": "Лосось", "unit": "g", "quantity": "200"}]}
+        ]
+    }
+
+В CSV каждая строка - один ингредиент блюда, колонки: dish, diet_type,
+category, description, recipe, ingredient, unit, quantity, price,
+callories, allergens (названия через ``|``).
+
+Записи сопоставляются с базой по естественному ключу: аллергии и типы
+диет - по названию, ингредиенты - по названию и единице измерения, блюда -
+по названию и типу диеты.
+"""
+import json
+from collections import Counter
+from decimal import InvalidOperation
+
+from django.db import transaction
+
+from .bulk import delete_rows, update_rows
+from .catalog import bump_catalog_version
+from .models import (
+    MAX_ALLERGY_BITS,
+    UNIT_NAMES,
+    Allergy,
+    DietType,
+    Dish,
+    DishIngredient,
+    Ingredient,
+)
+from .price_import import PRICE_FIELDS, csv_rows, parse_decimal
+
+
+CATALOG_BATCH_SIZE = 1000
+DISH_FIELDS = ('category', 'description', 'recipe', 'recipe_paragraphs')
+
+CATEGORIES = dict(Dish.DISH_CATEGORY_CHOICES)
+
+
+class CatalogImportError(Exception):
+    pass
+
+
+def text(value):
+    return str(value or '').strip()
+
+
+def catalog_from_rows(rows):
+    """Каталог из плоских строк CSV: одна строка на ингредиент блюда."""
+    ingredients = {}
+    dishes = {}
+    for row in rows:
+        dish = dishes.setdefault((text(row.get('dish')), text(row.get('diet_type'))), {
+            'name': text(row.get('dish')),
+            'diet_type': text(row.get('diet_type')),
+            'category': text(row.get('category')),
+            'description': text(row.get('description')),
+            'recipe': row.get('recipe') or '',
+            'ingredients': [],
+        })
+        name, unit = text(row.get('ingredient')), text(row.get('unit'))
+        if not name:
+            continue
+        dish['ingredients'].append({'name': name, 'unit': unit, 'quantity': row.get('quantity')})
+
+        ingredient = ingredients.setdefault((name, unit), {'name': name, 'unit': unit})
+        for field in PRICE_FIELDS:
+            if text(row.get(field)):
+                ingredient[field] = row[field]
+        if text(row.get('allergens')):
+            ingredient['allergens'] = [
+                allergy.strip() for allergy in row['allergens'].split('|') if allergy.strip()
+            ]
+    return {'ingredients': list(ingredients.values()), 'dishes': list(dishes.values())}
+
+
+def read_catalog(file, filename):
+    if filename.lower().endswith('.json'):
+        try:
+            catalog = json.load(file)
+        except ValueError as e:
+            raise CatalogImportError(f'Некорректный JSON: {str(e)}')
+        if not isinstance(catalog, dict):
+            raise CatalogImportError('Каталог должен быть JSON-объектом')
+        return catalog
+    return catalog_from_rows(csv_rows(file))
+
+
+def chunks(values, size):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def decimal_field(entry, field, where):
+    try:
+        return parse_decimal(text(entry.get(field)))
+    except InvalidOperation:
+        raise CatalogImportError(f'{where}: поле {field} должно быть неотрицательным числом')
+
+
+def name_map(model, names, batch_size):
+    """Словарь название -> id; недостающие записи создаются одним bulk_create."""
+    names = set(names)
+    existing = {}
+    for pk, name in model.objects.filter(name__in=names).order_by('-pk').values_list('pk', 'name'):
+        existing[name] = pk
+    missing = sorted(names - existing.keys())
+    if not missing:
+        return existing
+
+    if model is Allergy:
+        # bulk_create не вызывает Allergy.save(), поэтому биты раздаются здесь
+        used = set(Allergy.objects.filter(bit__isnull=False).values_list('bit', flat=True))
+        free = [1 << index for index in range(MAX_ALLERGY_BITS) if 1 << index not in used]
+        if len(free) < len(missing):
+            raise CatalogImportError('Закончились свободные биты для аллергенов')
+        objs = [Allergy(name=name, bit=bit) for name, bit in zip(missing, free)]
+    else:
+        objs = [model(name=name) for name in missing]
+    model.objects.bulk_create(objs, batch_size=batch_size)
+    return name_map(model, names, batch_size)
+
+
+def load_ingredients(entries, update_existing, batch_size, stats):
+    """Создаёт и обновляет ингредиенты; возвращает их id и id изменённых."""
+    existing = {}
+    for ingredient in Ingredient.objects.only('pk', 'name', 'unit', *PRICE_FIELDS).order_by('-pk'):
+        existing[(ingredient.name, ingredient.unit)] = ingredient
+
+    new, updated, allergens = {}, [], {}
+    for entry in entries:
+        key = (text(entry.get('name')), text(entry.get('unit')) or 'g')
+        where = f'Ингредиент {key[0]!r}'
+        if not key[0]:
+            raise CatalogImportError('У ингредиента не указано название')
+        if key[1] not in UNIT_NAMES:
+            raise CatalogImportError(f'{where}: неизвестная единица измерения {key[1]!r}')
+        values = {field: decimal_field(entry, field, where) for field in PRICE_FIELDS}
+        values = {field: value for field, value in values.items() if value is not None}
+
+        ingredient = existing.get(key)
+        if ingredient is None:
+            if len(values) != len(PRICE_FIELDS):
+                raise CatalogImportError(f'{where}: для нового ингредиента нужны price и callories')
+            new[key] = Ingredient(name=key[0], unit=key[1], **values)
+        elif not update_existing:
+            stats['ingredients_skipped'] += 1
+            continue
+        elif any(getattr(ingredient, field) != value for field, value in values.items()):
+            for field, value in values.items():
+                setattr(ingredient, field, value)
+            updated.append(ingredient)
+        if 'allergens' in entry:
+            allergens[key] = [text(name) for name in entry['allergens'] if text(name)]
+
+    Ingredient.objects.bulk_create(new.values(), batch_size=batch_size)
+    update_rows(updated, PRICE_FIELDS)
+    stats['ingredients_created'] += len(new)
+    stats['ingredients_updated'] += len(updated)
+
+    ids = {}
+    for pk, name, unit in Ingredient.objects.order_by('-pk').values_list('pk', 'name', 'unit'):
+        ids[(name, unit)] = pk
+
+    allergy_ids = name_map(
+        Allergy, {name for names in allergens.values() for name in names}, batch_size
+    )
+    relinked = [ids[key] for key in allergens]
+    Link = Ingredient.allergens.through
+    for pks in chunks(relinked, batch_size):
+        delete_rows(Link, 'ingredient', pks)
+    Link.objects.bulk_create(
+        [
+            Link(ingredient_id=ids[key], allergy_id=allergy_ids[name])
+            for key, names in allergens.items()
+            for name in dict.fromkeys(names)
+        ],
+        batch_size=batch_size,
+    )
+
+    changed = {ingredient.pk for ingredient in updated} | set(relinked)
+    return ids, changed
+
+
+def load_dishes(entries, ingredient_ids, update_existing, batch_size, stats):
+    """Создаёт и обновляет блюда с их ингредиентами; возвращает id загруженных."""
+    diet_type_ids = name_map(
+        DietType, {text(entry.get('diet_type')) for entry in entries} - {''}, batch_size
+    )
+    existing = {}
+    for pk, name, diet_type_id in Dish.objects.order_by('-pk').values_list(
+        'pk', 'name', 'diet_type_id'
+    ):
+        existing[(name, diet_type_id)] = pk
+
+    new, updated, recipes = {}, {}, {}
+    for entry in entries:
+        name = text(entry.get('name'))
+        if not name:
+            raise CatalogImportError('У блюда не указано название')
+        key = (name, diet_type_ids.get(text(entry.get('diet_type'))))
+        where = f'Блюдо {name!r}'
+        category = text(entry.get('category')) or 'lunch'
+        if category not in CATEGORIES:
+            raise CatalogImportError(f'{where}: неизвестная категория {category!r}')
+
+        rows = []
+        for item in entry.get('ingredients') or []:
+            item_key = (text(item.get('name')), text(item.get('unit')) or 'g')
+            if item_key not in ingredient_ids:
+                raise CatalogImportError(f'{where}: ингредиент {item_key[0]!r} не найден')
+            quantity = decimal_field(item, 'quantity', where)
+            if quantity is None:
+                raise CatalogImportError(f'{where}: не указано количество {item_key[0]!r}')
+            rows.append((ingredient_ids[item_key], quantity))
+
+        recipe = entry.get('recipe') or ''
+        dish = Dish(
+            pk=existing.get(key),
+            name=name,
+            diet_type_id=key[1],
+            category=category,
+            description=text(entry.get('description')),
+            recipe=recipe,
+            # bulk_create и update_rows не вызывают Dish.save()
+            recipe_paragraphs=recipe.splitlines(),
+        )
+        if dish.pk is None:
+            new[key] = dish
+        elif update_existing:
+            updated[key] = dish
+        else:
+            stats['dishes_skipped'] += 1
+            continue
+        recipes[key] = rows
+
+    Dish.objects.bulk_create(new.values(), batch_size=batch_size)
+    update_rows(updated.values(), DISH_FIELDS)
+    stats['dishes_created'] += len(new)
+    stats['dishes_updated'] += len(updated)
+
+    if new:
+        for pk, name, diet_type_id in Dish.objects.order_by('-pk').values_list(
+            'pk', 'name', 'diet_type_id'
+        ):
+            existing[(name, diet_type_id)] = pk
+    dish_ids = {key: existing[key] for key in recipes}
+
+    for pks in chunks([dish.pk for dish in updated.values()], batch_size):
+        # Сигналы удаления пересчитывали бы блюдо на каждую строку
+        delete_rows(DishIngredient, 'dish', pks)
+    DishIngredient.objects.bulk_create(
+        [
+            DishIngredient(dish_id=dish_ids[key], ingredient_id=ingredient_id, quantity=quantity)
+            for key, rows in recipes.items()
+            for ingredient_id, quantity in rows
+        ],
+        batch_size=batch_size,
+    )
+    return set(dish_ids.values())
+
+
+def load_catalog(catalog, update_existing=True, batch_size=CATALOG_BATCH_SIZE):
+    """Загружает каталог в одной транзакции.
+
+    Записи создаются через bulk_create в порядке зависимостей, уже
+    существующие обновляются (или пропускаются без ``update_existing``).
+    Сохранённые итоги, маски аллергенов и списки ингредиентов
+    пересчитываются для загруженных блюд и блюд с изменёнными
+    ингредиентами. Возвращает счётчики созданных и обновлённых записей.
+    """
+    stats = Counter()
+    with transaction.atomic():
+        ingredient_ids, changed = load_ingredients(
+            catalog.get('ingredients') or [], update_existing, batch_size, stats
+        )
+        dish_ids = load_dishes(
+            catalog.get('dishes') or [], ingredient_ids, update_existing, batch_size, stats
+        )
+        for pks in chunks(changed, batch_size):
+            dish_ids.update(
+                DishIngredient.objects.filter(
+                    ingredient_id__in=pks
+                ).values_list('dish_id', flat=True)
+            )
+
+        for pks in chunks(sorted(dish_ids), batch_size):
+            dishes = Dish.objects.filter(pk__in=pks)
+            dishes.refresh_cached_totals()
+            dishes.refresh_allergen_mask()
+            dishes.refresh_ingredient_lists()
+            dishes.drop_future_daily_menus()
+        stats['dishes_refreshed'] = len(dish_ids)
+    bump_catalog_version()
+    return stats
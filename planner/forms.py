@@ -111,3 +111,16 @@ class UserProfileForm(forms.ModelForm):
             profile.save()
 
         return profile
+
+
+class PriceImportForm(forms.Form):
+    file = forms.FileField(
+        label="Прайс-лист",
+        help_text="CSV или XLSX с колонками name, unit, price, callories"
+    )
+
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        if not file.name.lower().endswith(('.csv', '.xlsx')):
+            raise forms.ValidationError("Поддерживаются только файлы CSV и XLSX")
+        return file
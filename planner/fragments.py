@@ -0,0 +1,79 @@
+import hashlib
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from .catalog import get_catalog_version
+from .menu import enabled_categories
+
+
+MENU_FRAGMENT_TIMEOUT = 60 * 60 * 24
+DISH_CARD_TIMEOUT = 60 * 60 * 24
+
+# Бюджеты округляются до корзин, чтобы близкие значения давали одну подпись
+BUDGET_BUCKET_SIZE = 100
+
+MENU_SECTIONS = [
+    ('breakfast', 'Завтрак', 'Нет доступных блюд для завтрака или этот приём пищи не выбран'),
+    ('lunch', 'Обед', 'Нет доступных блюд для обеда или этот приём пищи не выбран'),
+    ('dinner', 'Ужин', 'Нет доступных блюд для ужина или этот приём пищи не выбран'),
+    ('dessert', 'Десерт', 'Нет доступных десертов или этот приём пищи не выбран'),
+]
+
+
+def profile_signature(profile):
+    """Подпись настроек меню, общая для всех подписчиков с одинаковым планом."""
+    budget_bucket = (
+        int(profile.budget_limit // BUDGET_BUCKET_SIZE)
+        if profile.budget_limit else None
+    )
+    return (
+        f'{profile.diet_type_id}:{",".join(enabled_categories(profile))}:'
+        f'{profile.allergen_mask}:{profile.count_of_persons}:{budget_bucket}'
+    )
+
+
+def menu_fragment_cache_key(profile, menu):
+    # Подписчики с одной подписью получают разные блюда из-за ротации,
+    # поэтому в ключ входят и id выбранных блюд
+    dish_ids = ','.join(
+        f'{category}={dishes[0].id}' if dishes else f'{category}='
+        for category, dishes in sorted(menu.items())
+    )
+    digest = hashlib.blake2b(
+        f'{profile_signature(profile)}|{dish_ids}'.encode(), digest_size=12
+    ).hexdigest()
+    return f'planner:menu_fragment:{get_catalog_version()}:{digest}'
+
+
+def render_menu_section(profile, menu):
+    key = menu_fragment_cache_key(profile, menu)
+    html = cache.get(key)
+    if html is None:
+        sections = [
+            {
+                'title': title,
+                'dish': menu[category][0] if menu.get(category) else None,
+                'empty_message': empty_message,
+            }
+            for category, title, empty_message in MENU_SECTIONS
+            if category != 'dessert' or profile.dessert
+        ]
+        html = render_to_string('menu_section.html', {'sections': sections})
+        cache.set(key, str(html), MENU_FRAGMENT_TIMEOUT)
+    return mark_safe(html)
+
+
+def scaled_ingredient_list(dish, persons):
+    """Ингредиенты карточки блюда с количеством на всех персон."""
+    key = f'planner:dish_ingredients:{get_catalog_version()}:{dish.pk}:{persons}'
+    ingredients = cache.get(key)
+    if ingredients is None:
+        ingredients = [
+            {**entry, 'quantity': Decimal(entry['quantity']) * persons}
+            for entry in dish.ingredient_list
+        ]
+        cache.set(key, ingredients, DISH_CARD_TIMEOUT)
+    return ingredients
@@ -0,0 +1,70 @@
+import asyncio
+import statistics
+import time
+
+from yookassa import Configuration
+
+from django.core.management.base import BaseCommand
+
+from planner.payments import create_provider_payment, run_provider_call
+from planner.yookassa_stub import StubProvider
+
+
+PAYLOAD = {
+    'amount': {'value': '1200.00', 'currency': 'RUB'},
+    'confirmation': {'type': 'redirect', 'return_url': 'http://localhost/payment/success/'},
+    'capture': True,
+    'description': 'Подписка FoodPlan: замер',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает блокирующее и асинхронное создание платежей '
+        'на локальной заглушке ЮKassa'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkouts', type=int, default=50)
+        parser.add_argument(
+            '--latency', type=float, default=0.2,
+            help='Задержка ответа заглушки, секунды',
+        )
+
+    def handle(self, *args, **options):
+        checkouts = options['checkouts']
+        with StubProvider(latency=options['latency']) as provider:
+            Configuration.configure('stub', 'stub', api_url=provider.api_url, timeout=10)
+
+            # Все оформления приходят одновременно, а один WSGI-воркер
+            # обрабатывает их по очереди: каждое ждёт все предыдущие
+            started = time.perf_counter()
+            sync_latencies = []
+            for _ in range(checkouts):
+                create_provider_payment(PAYLOAD)
+                sync_latencies.append(time.perf_counter() - started)
+            sync_total = time.perf_counter() - started
+
+            started = time.perf_counter()
+            async_latencies = asyncio.run(self.run_async(checkouts))
+            async_total = time.perf_counter() - started
+
+        self.report('WSGI, один воркер', checkouts, sync_total, sync_latencies)
+        self.report('ASGI, пул потоков', checkouts, async_total, async_latencies)
+
+    async def run_async(self, checkouts):
+        async def checkout():
+            started = time.perf_counter()
+            await run_provider_call(create_provider_payment, PAYLOAD)
+            return time.perf_counter() - started
+
+        return await asyncio.gather(*(checkout() for _ in range(checkouts)))
+
+    def report(self, title, checkouts, total, latencies):
+        latencies = sorted(latencies)
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        self.stdout.write(
+            f'{title}: {checkouts} оформлений за {total:.2f} с, '
+            f'ожидание p50 {statistics.median(latencies) * 1000:.0f} мс, '
+            f'p95 {p95 * 1000:.0f} мс'
+        )
@@ -0,0 +1,52 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from planner.catalog import CATEGORY_CODES, MenuCatalog
+from planner.meal_plan import build_meal_plan
+
+
+class Command(BaseCommand):
+    help = 'Замеряет время составления меню на синтетических каталогах разного размера'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+            help='Размеры каталога (число блюд)',
+        )
+        parser.add_argument('--days', type=int, default=30)
+        parser.add_argument('--diet-types', type=int, default=4)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        categories = list(CATEGORY_CODES)
+
+        self.stdout.write(f"{'блюд':>8} {'дней':>5} {'загрузка, мс':>13} {'план, мс':>10}")
+        for size in options['sizes']:
+            rows = [
+                (
+                    dish_id,
+                    rng.choice(categories),
+                    rng.randint(1, options['diet_types']),
+                    rng.getrandbits(6) & rng.getrandbits(6),
+                    rng.randint(50, 900),
+                    rng.randint(80, 900),
+                )
+                for dish_id in range(1, size + 1)
+            ]
+
+            started = time.perf_counter()
+            catalog = MenuCatalog(version=0, rows=rows)
+            loaded = time.perf_counter()
+            build_meal_plan(
+                catalog, 1, categories, options['days'],
+                allergen_mask=0b1, persons=2, daily_budget=4000,
+            )
+            planned = time.perf_counter()
+
+            self.stdout.write(
+                f"{size:>8} {options['days']:>5} "
+                f"{(loaded - started) * 1000:>13.1f} {(planned - loaded) * 1000:>10.1f}"
+            )
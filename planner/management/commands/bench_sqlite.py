@@ -0,0 +1,212 @@
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.utils import ConnectionHandler, OperationalError
+
+
+MODES = {
+    'stock': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'CONN_MAX_AGE': 0,
+        'OPTIONS': {},
+    },
+    'concurrent': {
+        'ENGINE': 'food_plan.sqlite_backend',
+        'CONN_MAX_AGE': None,
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE', 'timeout': 20},
+    },
+}
+
+# Упрощённые таблицы профилей, заказов и уведомлений с горячими индексами
+SCHEMA = [
+    'CREATE TABLE profile (id INTEGER PRIMARY KEY, end_date TEXT, allergen_mask INTEGER NOT NULL)',
+    'CREATE TABLE subscription_order (id INTEGER PRIMARY KEY, profile_id INTEGER NOT NULL, '
+    'status TEXT NOT NULL, payment_id TEXT, amount REAL NOT NULL)',
+    'CREATE INDEX order_profile_idx ON subscription_order (profile_id, status)',
+    'CREATE UNIQUE INDEX order_payment_idx ON subscription_order (payment_id)',
+    'CREATE TABLE webhook_event (id INTEGER PRIMARY KEY, payment_id TEXT, payload TEXT NOT NULL)',
+]
+
+OPERATIONS = ['cabinet', 'checkout', 'webhook', 'payment']
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает стандартный SQLite и режим SQLITE_CONCURRENT на смешанной '
+        'нагрузке чтения и записи из нескольких потоков'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument(
+            '--seconds', type=float, default=5,
+            help='Длительность прогона каждого режима',
+        )
+        parser.add_argument(
+            '--read-ratio', type=float, default=0.7,
+            help='Доля чтений личного кабинета, остальное - записи поровну',
+        )
+        parser.add_argument('--profiles', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        results = {}
+        for mode, database in MODES.items():
+            with tempfile.TemporaryDirectory() as directory:
+                # Отдельный набор соединений: у каждого потока своё
+                connections = ConnectionHandler({
+                    'default': {**database, 'NAME': os.path.join(directory, 'bench.sqlite3')},
+                })
+                try:
+                    self.prepare(connections['default'], options['profiles'])
+                    results[mode] = self.run(connections, options)
+                finally:
+                    connections.close_all()
+            self.report(mode, results[mode], options['seconds'])
+
+        stock, concurrent = (sum(results[mode]['ok'].values()) for mode in MODES)
+        if stock:
+            self.stdout.write(f'Прирост пропускной способности: {concurrent / stock:.1f}x')
+
+    def prepare(self, connection, profiles):
+        today = date.today()
+        with connection.cursor() as cursor:
+            for statement in SCHEMA:
+                cursor.execute(statement)
+            cursor.executemany(
+                'INSERT INTO profile (id, end_date, allergen_mask) VALUES (%s, %s, %s)',
+                [(pk, str(today), 0) for pk in range(1, profiles + 1)],
+            )
+            cursor.executemany(
+                'INSERT INTO subscription_order (profile_id, status, payment_id, amount) '
+                'VALUES (%s, %s, %s, %s)',
+                [(pk, 'paid', f'seed-{pk}', 1200) for pk in range(1, profiles + 1)],
+            )
+        connection.close()
+
+    def run(self, connections, options):
+        stats = {'ok': Counter(), 'errors': Counter(), 'latency': defaultdict(list)}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + options['seconds']
+        write_ratio = (1 - options['read_ratio']) / (len(OPERATIONS) - 1)
+        weights = [options['read_ratio']] + [write_ratio] * (len(OPERATIONS) - 1)
+
+        def worker(number):
+            rng = random.Random(options['seed'] * 1000 + number)
+            connection = connections['default']
+            local = {'ok': Counter(), 'errors': Counter(), 'latency': defaultdict(list)}
+            sequence = 0
+            while time.perf_counter() < deadline:
+                operation = rng.choices(OPERATIONS, weights)[0]
+                profile_id = rng.randint(1, options['profiles'])
+                sequence += 1
+                started = time.perf_counter()
+                try:
+                    getattr(self, operation)(connection, profile_id, f'{number}-{sequence}')
+                except OperationalError:
+                    local['errors'][operation] += 1
+                else:
+                    local['ok'][operation] += 1
+                    local['latency'][operation].append(time.perf_counter() - started)
+                finally:
+                    # Без постоянных соединений каждый запрос открывает своё
+                    connection.close_if_unusable_or_obsolete()
+            connection.close()
+            with lock:
+                for key in ('ok', 'errors'):
+                    stats[key].update(local[key])
+                for operation, latencies in local['latency'].items():
+                    stats['latency'][operation].extend(latencies)
+
+        threads = [
+            threading.Thread(target=worker, args=(number,))
+            for number in range(options['threads'])
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return stats
+
+    def cabinet(self, connection, profile_id, key):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT p.end_date, p.allergen_mask, o.id, o.status FROM profile p '
+                'LEFT JOIN subscription_order o ON o.profile_id = p.id AND o.status = %s '
+                'WHERE p.id = %s',
+                ['paid', profile_id],
+            )
+            cursor.fetchall()
+
+    def checkout(self, connection, profile_id, key):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO subscription_order (profile_id, status, payment_id, amount) '
+                'VALUES (%s, %s, %s, %s)',
+                [profile_id, 'pending', f'payment-{key}', 1200],
+            )
+
+    def webhook(self, connection, profile_id, key):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO webhook_event (payment_id, payload) VALUES (%s, %s)',
+                [f'payment-{key}', '{"event": "payment.succeeded"}'],
+            )
+
+    def payment(self, connection, profile_id, key):
+        """Как apply_payment: чтение заказа и запись в одной транзакции."""
+        self.atomic(connection, self.activate, profile_id)
+
+    def activate(self, cursor, profile_id):
+        cursor.execute(
+            'SELECT id FROM subscription_order WHERE profile_id = %s AND status = %s',
+            [profile_id, 'paid'],
+        )
+        cursor.fetchall()
+        cursor.execute('SELECT end_date FROM profile WHERE id = %s', [profile_id])
+        (end_date,) = cursor.fetchone()
+        end_date = date.fromisoformat(end_date) + timedelta(days=30)
+        cursor.execute(
+            'UPDATE profile SET end_date = %s WHERE id = %s', [str(end_date), profile_id]
+        )
+
+    def atomic(self, connection, func, *args):
+        # transaction.atomic() работает только с django.db.connections,
+        # поэтому транзакция открывается так же, как это делает он
+        connection.set_autocommit(False, force_begin_transaction_with_broken_autocommit=True)
+        try:
+            with connection.cursor() as cursor:
+                func(cursor, *args)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.set_autocommit(True)
+
+    def report(self, mode, stats, seconds):
+        ok = sum(stats['ok'].values())
+        errors = sum(stats['errors'].values())
+        self.stdout.write(
+            f'{mode}: {ok / seconds:.0f} операций в секунду, '
+            f'ошибок "database is locked": {errors}'
+        )
+        for operation in OPERATIONS:
+            latencies = sorted(stats['latency'][operation])
+            if not latencies:
+                self.stdout.write(
+                    f'  {operation}: нет успешных, ошибок {stats["errors"][operation]}'
+                )
+                continue
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            self.stdout.write(
+                f'  {operation}: {len(latencies)} успешно, ошибок {stats["errors"][operation]}, '
+                f'p50 {statistics.median(latencies) * 1000:.1f} мс, p95 {p95 * 1000:.1f} мс'
+            )
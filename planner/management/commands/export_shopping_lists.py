@@ -0,0 +1,39 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from planner.shopping import EXPORT_CHUNK_SIZE, export_shopping_rows, render_export
+
+
+class Command(BaseCommand):
+    help = 'Выгружает ингредиенты на день по всем активным подписчикам в CSV или NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date',
+            help='Дата в формате ГГГГ-ММ-ДД, по умолчанию завтра',
+        )
+        parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+        parser.add_argument('--output', help='Файл для выгрузки, по умолчанию stdout')
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                day = date.fromisoformat(options['date'])
+            except ValueError:
+                raise CommandError('Дата должна быть в формате ГГГГ-ММ-ДД')
+        else:
+            day = timezone.now().date() + timedelta(days=1)
+
+        lines = render_export(
+            export_shopping_rows(day, chunk_size=options['chunk_size']),
+            options['format'],
+        )
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from planner.price_import import (
+    PRICE_IMPORT_CHUNK_SIZE,
+    PriceImportError,
+    import_prices,
+    read_price_rows,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Загружает цены и калорийность ингредиентов из прайс-листа CSV или XLSX '
+        'с колонками name, unit, price, callories'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл прайс-листа (.csv или .xlsx)')
+        parser.add_argument('--chunk-size', type=int, default=PRICE_IMPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        started = time.perf_counter()
+        try:
+            with open(path, 'rb') as file:
+                stats = import_prices(
+                    read_price_rows(file, path),
+                    chunk_size=options['chunk_size'],
+                )
+        except (OSError, PriceImportError) as e:
+            raise CommandError(str(e))
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Строк: {stats['rows']}, обновлено ингредиентов: {stats['updated']}, "
+            f"без изменений: {stats['unchanged']}, не найдено: {stats['unknown']}, "
+            f"с ошибками: {stats['invalid']}, пересчитано блюд: {stats['dishes']}"
+        ))
+        self.stdout.write(
+            f"{elapsed:.2f} с, {stats['rows'] / max(elapsed, 1e-6):.0f} строк в секунду"
+        )
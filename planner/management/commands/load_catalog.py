@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from planner.catalog_import import (
+    CATALOG_BATCH_SIZE,
+    CatalogImportError,
+    load_catalog,
+    read_catalog,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Загружает каталог блюд, ингредиентов и аллергенов из JSON или CSV; '
+        'существующие записи обновляются по названию'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл каталога (.json или .csv)')
+        parser.add_argument(
+            '--skip-existing', action='store_true',
+            help='Не изменять уже существующие блюда и ингредиенты',
+        )
+        parser.add_argument('--batch-size', type=int, default=CATALOG_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        started = time.perf_counter()
+        try:
+            with open(path, 'rb') as file:
+                catalog = read_catalog(file, path)
+            stats = load_catalog(
+                catalog,
+                update_existing=not options['skip_existing'],
+                batch_size=options['batch_size'],
+            )
+        except (OSError, CatalogImportError) as e:
+            raise CommandError(str(e))
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Блюд создано: {stats['dishes_created']}, обновлено: {stats['dishes_updated']}, "
+            f"пропущено: {stats['dishes_skipped']}; ингредиентов создано: "
+            f"{stats['ingredients_created']}, обновлено: {stats['ingredients_updated']}, "
+            f"пропущено: {stats['ingredients_skipped']}; "
+            f"пересчитано блюд: {stats['dishes_refreshed']}"
+        ))
+        self.stdout.write(f'{elapsed:.2f} с')
@@ -0,0 +1,188 @@
+import statistics
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from yookassa import Configuration
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import (
+    CaptureQueriesContext,
+    setup_test_environment,
+    teardown_test_environment,
+)
+from django.urls import reverse
+
+from planner.models import SubscriptionOrder, UserProfile
+from planner.webhooks import process_webhook_batch
+from planner.yookassa_stub import StubProvider
+
+
+CHECKOUT_FORM = {
+    'foodtype': 'classic',
+    'select1': '0',
+    'select2': '0',
+    'select3': '1',
+    'select4': '1',
+    'select5': '0',
+    'duration': '0',
+    'allergy1': '1',
+}
+
+STEPS = ['create_payment', 'yookassa_webhook', 'payment_success', 'process_webhooks']
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный прогон оплаты на временной базе и локальной заглушке '
+        'ЮKassa: create_payment, уведомление, payment_success'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkouts', type=int, default=200)
+        parser.add_argument(
+            '--rps', type=float, default=20,
+            help='С какой частотой начинать оформления, в секунду',
+        )
+        parser.add_argument('--workers', type=int, default=16)
+        parser.add_argument(
+            '--latency', type=float, default=0.05,
+            help='Задержка ответа заглушки, секунды',
+        )
+        parser.add_argument(
+            '--failure-rate', type=float, default=0.0,
+            help='Доля запросов к заглушке, завершающихся ошибкой 500',
+        )
+
+    def handle(self, *args, **options):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+        # Прогон создаёт тысячи пользователей и заказов, поэтому работает
+        # на временной базе, как тесты
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def run(self, options):
+        users = User.objects.bulk_create(
+            User(username=f'load-{number}') for number in range(options['checkouts'])
+        )
+        UserProfile.objects.bulk_create(UserProfile(user=user) for user in users)
+
+        provider = StubProvider(
+            latency=options['latency'],
+            failure_rate=options['failure_rate'],
+            webhook=self.deliver_webhook,
+        )
+        with provider:
+            Configuration.configure('stub', 'stub', api_url=provider.api_url)
+            self.provider = provider
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+                for number, user in enumerate(users):
+                    pool.submit(self.checkout, user, started + number / options['rps'])
+            elapsed = time.perf_counter() - started
+
+            # payment_success перенаправляет в кабинет и при сбое активации,
+            # поэтому итог считается по заказам
+            paid_online = SubscriptionOrder.objects.filter(status='paid').count()
+            self.measure('process_webhooks', process_webhook_batch, len(users))
+            paid = SubscriptionOrder.objects.filter(status='paid').count()
+
+        self.report(len(users), elapsed, provider.requests)
+        self.stdout.write(
+            f'Оплачено заказов: {paid_online} сразу, {paid} после обработки уведомлений'
+        )
+
+    def measure(self, step, func, *args):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            try:
+                result = func(*args)
+            except Exception:
+                result = None
+            elapsed = time.perf_counter() - started
+        with self.lock:
+            if result is None:
+                self.errors[step] += 1
+            else:
+                self.samples[step].append((elapsed, len(queries)))
+        return result
+
+    def checkout(self, user, start_at):
+        time.sleep(max(0, start_at - time.perf_counter()))
+        client = Client()
+        try:
+            client.force_login(user)
+            response = self.measure('create_payment', self.post_checkout, client)
+            if response is None:
+                return
+            payment_id = urlsplit(response['Location']).path.rsplit('/', 1)[-1]
+            self.provider.pay(payment_id)
+            self.measure('payment_success', self.return_to_site, client, payment_id)
+        finally:
+            connection.close()
+
+    def post_checkout(self, client):
+        response = client.post(reverse('create_payment'), CHECKOUT_FORM)
+        if not response['Location'].startswith(self.provider.base_url):
+            return None
+        return response
+
+    def return_to_site(self, client, payment_id):
+        url = urlsplit(self.provider.return_urls[payment_id])
+        response = client.get(f'{url.path}?{url.query}')
+        return response if response['Location'] == reverse('lk') else None
+
+    def deliver_webhook(self, notification):
+        client = Client()
+        try:
+            self.measure(
+                'yookassa_webhook',
+                lambda: client.post(
+                    reverse('yookassa_webhook'),
+                    notification,
+                    content_type='application/json',
+                ).status_code == 200 or None,
+            )
+        finally:
+            connection.close()
+
+    def report(self, checkouts, elapsed, provider_requests):
+        self.stdout.write(
+            f'{checkouts} оформлений за {elapsed:.2f} с '
+            f'({checkouts / elapsed:.1f} в секунду)'
+        )
+        for step in STEPS:
+            samples = self.samples[step]
+            if not samples:
+                self.stdout.write(f'{step}: нет успешных запросов, ошибок {self.errors[step]}')
+                continue
+            latencies = [latency * 1000 for latency, _ in samples]
+            queries = [count for _, count in samples]
+            self.stdout.write(
+                f'{step}: {len(samples)} успешно, ошибок {self.errors[step]}, '
+                f'p50 {statistics.median(latencies):.0f} мс, '
+                f'p95 {percentile(latencies, 0.95):.0f} мс, '
+                f'p99 {percentile(latencies, 0.99):.0f} мс, '
+                f'запросов к БД в среднем {statistics.mean(queries):.1f}, '
+                f'максимум {max(queries)}'
+            )
+        self.stdout.write(f'Запросы к заглушке ЮKassa: {provider_requests}')
@@ -0,0 +1,88 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from planner.catalog import get_catalog
+from planner.menu import build_daily_menu
+from planner.models import DailyMenu, UserProfile
+
+
+PROFILE_FIELDS = (
+    'id', 'user_id', 'diet_type_id', 'allergen_mask', 'budget_limit',
+    'count_of_persons', 'breakfast', 'lunch', 'dinner', 'dessert',
+)
+
+
+class Command(BaseCommand):
+    help = 'Сохраняет меню на день для всех профилей с активной подпиской'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date',
+            help='Дата меню в формате ГГГГ-ММ-ДД, по умолчанию завтра',
+        )
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Число потоков, обрабатывающих пачки профилей параллельно',
+        )
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                day = date.fromisoformat(options['date'])
+            except ValueError:
+                raise CommandError('Дата должна быть в формате ГГГГ-ММ-ДД')
+        else:
+            day = timezone.now().date() + timedelta(days=1)
+
+        profile_ids = list(
+            UserProfile.objects.filter(
+                subscription_end_date__gte=day,
+                diet_type__isnull=False,
+            ).order_by('pk').values_list('pk', flat=True)
+        )
+        chunk_size = options['chunk_size']
+        chunks = [
+            profile_ids[start:start + chunk_size]
+            for start in range(0, len(profile_ids), chunk_size)
+        ]
+        catalog = get_catalog()
+
+        started = time.perf_counter()
+        if options['workers'] > 1:
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                created = sum(executor.map(
+                    lambda chunk: self.materialize_in_thread(chunk, day, catalog),
+                    chunks,
+                ))
+        else:
+            created = sum(self.materialize(chunk, day, catalog) for chunk in chunks)
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Меню на {day:%d.%m.%Y}: профилей {len(profile_ids)}, '
+            f'строк {created}, {elapsed:.1f} с'
+        ))
+
+    def materialize_in_thread(self, profile_ids, day, catalog):
+        try:
+            return self.materialize(profile_ids, day, catalog)
+        finally:
+            # У каждого потока своё соединение с базой
+            connection.close()
+
+    def materialize(self, profile_ids, day, catalog):
+        profiles = UserProfile.objects.filter(pk__in=profile_ids).only(*PROFILE_FIELDS)
+        rows = []
+        for profile in profiles:
+            rows.extend(build_daily_menu(profile, day, catalog))
+
+        with transaction.atomic():
+            DailyMenu.objects.filter(profile_id__in=profile_ids, date=day).delete()
+            DailyMenu.objects.bulk_create(rows)
+        return len(rows)
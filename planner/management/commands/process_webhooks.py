@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from planner.webhooks import (
+    WEBHOOK_BATCH_SIZE,
+    WEBHOOK_MAX_ATTEMPTS,
+    process_webhook_batch,
+)
+
+
+class Command(BaseCommand):
+    help = 'Обрабатывает очередь уведомлений ЮKassa и активирует оплаченные подписки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=WEBHOOK_BATCH_SIZE)
+        parser.add_argument('--max-attempts', type=int, default=WEBHOOK_MAX_ATTEMPTS)
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Не завершаться, а ждать новые уведомления',
+        )
+        parser.add_argument(
+            '--interval', type=float, default=2.0,
+            help='Пауза между опросами пустой очереди в режиме --loop, секунды',
+        )
+
+    def handle(self, *args, **options):
+        total = {'processed': 0, 'retried': 0, 'failed': 0, 'api_calls': 0}
+        while True:
+            stats = process_webhook_batch(
+                batch_size=options['batch_size'],
+                max_attempts=options['max_attempts'],
+            )
+            for key in total:
+                total[key] += stats[key]
+            if stats:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Обработано: {total['processed']}, отложено: {total['retried']}, "
+            f"с ошибкой: {total['failed']}, запросов к API: {total['api_calls']}"
+        ))
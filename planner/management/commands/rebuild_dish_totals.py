@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from planner.catalog import bump_catalog_version
+from planner.models import Dish
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает сохранённые стоимость, калорийность и маски аллергенов всех блюд'
+
+    def handle(self, *args, **options):
+        updated = Dish.objects.all().refresh_cached_totals()
+        Dish.objects.all().refresh_allergen_mask()
+        Dish.objects.all().drop_future_daily_menus()
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано блюд: {updated}'))
@@ -0,0 +1,55 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from planner.reconciliation import (
+    RECONCILE_BATCH_SIZE,
+    RECONCILE_WORKERS,
+    reconcile_orders,
+)
+
+
+class Command(BaseCommand):
+    help = 'Сверяет с ЮKassa заказы, зависшие в статусе ожидания оплаты'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=3,
+            help='Насколько давно созданные заказы проверять, дни',
+        )
+        parser.add_argument(
+            '--min-age', type=int, default=30,
+            help='Не трогать заказы моложе этого срока, минуты',
+        )
+        parser.add_argument('--batch-size', type=int, default=RECONCILE_BATCH_SIZE)
+        parser.add_argument(
+            '--workers', type=int, default=RECONCILE_WORKERS,
+            help='Число одновременных запросов к ЮKassa',
+        )
+        parser.add_argument(
+            '--use-list', action='store_true',
+            help='Брать статусы из списка платежей вместо запроса на каждый заказ',
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        started = time.perf_counter()
+        stats = reconcile_orders(
+            created_from=now - timedelta(days=options['days']),
+            created_to=now - timedelta(minutes=options['min_age']),
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            use_list=options['use_list'],
+        )
+        elapsed = time.perf_counter() - started
+
+        rate = stats['checked'] / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Проверено заказов: {stats['checked']} за {elapsed:.1f} с "
+            f"({rate:.0f} в секунду). Найдено платежей после таймаута: "
+            f"{stats['recovered']}. Оплачено: {stats['paid']}, "
+            f"отменено: {stats['failed']}, ещё ожидают: {stats['pending']}, "
+            f"статус не получен: {stats['unknown']}, ошибок активации: {stats['errors']}"
+        ))
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from planner.yookassa_stub import StubProvider
+
+
+class Command(BaseCommand):
+    help = (
+        'Запускает локальную заглушку API ЮKassa. Чтобы сайт работал с ней, '
+        'укажите YOOKASSA_API_URL=http://<host>:<port>/v3'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8099)
+        parser.add_argument(
+            '--latency', type=float, default=0.0,
+            help='Задержка ответа API, секунды',
+        )
+        parser.add_argument(
+            '--failure-rate', type=float, default=0.0,
+            help='Доля запросов к API, завершающихся ошибкой 500',
+        )
+        parser.add_argument(
+            '--webhook-url',
+            help='Куда отправлять уведомления об оплате, например '
+                 'http://127.0.0.1:8000/yookassa-webhook/',
+        )
+
+    def handle(self, *args, **options):
+        provider = StubProvider(
+            host=options['host'],
+            port=options['port'],
+            latency=options['latency'],
+            failure_rate=options['failure_rate'],
+            webhook=options['webhook_url'],
+        )
+        with provider:
+            self.stdout.write(f'Заглушка ЮKassa слушает {provider.api_url}')
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                pass
+        self.stdout.write(f'Запросов к заглушке: {provider.requests}')
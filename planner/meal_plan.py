@@ -0,0 +1,167 @@
+"""Составление меню на несколько дней по снимку каталога.
+
+Кандидаты каждой категории один раз сортируются по отклонению от
+калорийности приёма пищи, после чего для каждого дня перебираются только
+первые ``beam`` ещё не повторявшихся блюд каждой категории (и самое
+дешёвое из них), а среди их сочетаний выбирается укладывающееся в дневной
+бюджет и ближайшее к дневной норме калорий.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.utils import timezone
+
+from .catalog import get_catalog
+from .menu import enabled_categories
+
+
+DAILY_CALORIES_PER_PERSON = 2000
+
+# Доля дневной нормы калорий на каждый приём пищи
+MEAL_CALORIE_SHARES = {
+    'breakfast': 0.25,
+    'lunch': 0.35,
+    'dinner': 0.3,
+    'dessert': 0.1,
+}
+
+REPEAT_WINDOW_DAYS = 7
+PLAN_BEAM_WIDTH = 4
+
+# На сколько дней вперёд личный кабинет показывает план питания
+MEAL_PLAN_DAYS = 7
+
+
+class MealPlanError(Exception):
+    pass
+
+
+def _ranked_candidates(catalog, diet_type_id, category, allergen_mask, target):
+    start, stop = catalog.segment(diet_type_id, category)
+    masks = catalog.allergen_masks
+    calories = catalog.calories
+    positions = [
+        position for position in range(start, stop)
+        if not masks[position] & allergen_mask
+    ]
+    positions.sort(key=lambda position: abs(calories[position] - target))
+    return positions
+
+
+def _pick_candidates(ranked, cheapest_first, last_used, day, window, beam):
+    fresh = []
+    for position in ranked:
+        if day - last_used.get(position, -window) >= window:
+            fresh.append(position)
+            if len(fresh) == beam:
+                break
+    if not fresh:
+        # Блюд меньше, чем дней в окне: берём давно не повторявшиеся
+        fresh = sorted(ranked, key=lambda position: last_used.get(position, -1))[:beam]
+
+    for position in cheapest_first:
+        if day - last_used.get(position, -window) >= window:
+            if position not in fresh:
+                fresh.append(position)
+            break
+    return fresh
+
+
+def _combinations(options, prices, calories):
+    """Все сочетания кандидатов с накопленными ценой и калориями."""
+    combinations = [(0, 0.0, ())]
+    for positions in options:
+        combinations = [
+            (price + prices[position], energy + calories[position], chosen + (position,))
+            for price, energy, chosen in combinations
+            for position in positions
+        ]
+    return combinations
+
+
+def build_meal_plan(catalog, diet_type_id, categories, days, allergen_mask=0,
+                    persons=1, daily_budget=None,
+                    calorie_target=DAILY_CALORIES_PER_PERSON,
+                    repeat_window=REPEAT_WINDOW_DAYS, start_date=None,
+                    beam=PLAN_BEAM_WIDTH):
+    """Возвращает список дней: дата, блюдо на каждый приём пищи, цена, калории.
+
+    Цена дня считается на всех персон, калории на одну персону.
+    """
+    if not categories:
+        return []
+    if not diet_type_id:
+        raise MealPlanError('Не выбран тип диеты')
+    start_date = start_date or timezone.now().date()
+    budget = int(daily_budget * 100) if daily_budget else None
+    prices = catalog.prices
+    calories = catalog.calories
+
+    ranked = {}
+    cheapest = {}
+    for category in categories:
+        target = calorie_target * MEAL_CALORIE_SHARES[category]
+        ranked[category] = _ranked_candidates(
+            catalog, diet_type_id, category, allergen_mask, target
+        )
+        if not ranked[category]:
+            raise MealPlanError(f'Нет подходящих блюд для категории {category}')
+        cheapest[category] = sorted(
+            ranked[category], key=lambda position: prices[position]
+        )
+
+    day_target = calorie_target * sum(
+        MEAL_CALORIE_SHARES[category] for category in categories
+    )
+    last_used = {}
+    plan = []
+    for day in range(days):
+        options = [
+            _pick_candidates(
+                ranked[category], cheapest[category], last_used,
+                day, repeat_window, beam,
+            )
+            for category in categories
+        ]
+
+        best = None
+        best_key = None
+        for price, energy, combination in _combinations(options, prices, calories):
+            cost = price * persons
+            over_budget = budget is not None and cost > budget
+            key = (over_budget, cost if over_budget else 0, abs(energy - day_target), cost)
+            if best_key is None or key < best_key:
+                best, best_key = combination, key
+
+        for position in best:
+            last_used[position] = day
+        cost = sum(prices[position] for position in best) * persons
+        plan.append({
+            'date': start_date + timedelta(days=day),
+            'meals': {
+                category: catalog.ids[position]
+                for category, position in zip(categories, best)
+            },
+            'price': Decimal(cost) / 100,
+            'calories': sum(calories[position] for position in best),
+            'within_budget': not best_key[0],
+        })
+    return plan
+
+
+def plan_for_profile(profile, days=MEAL_PLAN_DAYS, start_date=None):
+    # budget_limit задаётся на один приём пищи для всех персон
+    categories = enabled_categories(profile)
+    daily_budget = (
+        profile.budget_limit * len(categories) if profile.budget_limit else None
+    )
+    return build_meal_plan(
+        get_catalog(),
+        profile.diet_type_id,
+        categories,
+        days,
+        allergen_mask=profile.allergen_mask,
+        persons=profile.count_of_persons,
+        daily_budget=daily_budget,
+        start_date=start_date,
+    )
@@ -0,0 +1,144 @@
+import hashlib
+
+from django.core.cache import cache
+
+from .catalog import get_catalog, get_catalog_version
+from .models import DailyMenu, Dish
+
+
+MEAL_CATEGORIES = ['breakfast', 'lunch', 'dinner', 'dessert']
+
+# Меню на день живёт в кеше не дольше суток: дата входит в ключ
+DAILY_MENU_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Поля, которые нужны карточке блюда в личном кабинете
+MENU_CARD_FIELDS = (
+    'id', 'name', 'description', 'category', 'cached_price', 'cached_calories',
+)
+
+
+def enabled_categories(profile):
+    return [
+        category for category in MEAL_CATEGORIES
+        if getattr(profile, category)
+    ]
+
+
+def _load_menu_dishes(profile, selected):
+    dish_ids = [dish_id for ids in selected.values() for dish_id in ids]
+    dishes = Dish.objects.only(*MENU_CARD_FIELDS).in_bulk(dish_ids) if dish_ids else {}
+
+    menu = {}
+    for category, ids in selected.items():
+        menu[category] = []
+        for dish_id in ids:
+            dish = dishes.get(dish_id)
+            if dish is None:
+                continue
+            dish.adjusted_price = dish.cached_price * profile.count_of_persons
+            dish.adjusted_calories = dish.cached_calories * profile.count_of_persons
+            menu[category].append(dish)
+    return menu
+
+
+def _catalog_selection(profile, catalog):
+    return catalog.select(
+        profile.diet_type_id,
+        enabled_categories(profile),
+        allergen_mask=profile.allergen_mask,
+        persons=profile.count_of_persons,
+        budget=profile.budget_limit,
+    )
+
+
+def rotation_index(user_id, day, category, size):
+    """Детерминированный номер блюда для пользователя, дня и приёма пищи."""
+    seed = f'{user_id}:{day.isoformat()}:{category}'.encode()
+    digest = hashlib.blake2b(seed, digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % size
+
+
+def rotated_selection(profile, day, catalog=None):
+    if not enabled_categories(profile) or not profile.diet_type_id:
+        return {}
+
+    if catalog is None:
+        catalog = get_catalog()
+    selected = _catalog_selection(profile, catalog)
+    return {
+        category: (
+            [dish_ids[rotation_index(profile.user_id, day, category, len(dish_ids))]]
+            if dish_ids else []
+        )
+        for category, dish_ids in selected.items()
+    }
+
+
+def daily_menu_cache_key(profile, day):
+    """Ключ меню на день: меняется вместе с каталогом и настройками профиля."""
+    settings = (
+        f'{profile.diet_type_id}:{profile.allergen_mask}:{profile.count_of_persons}:'
+        f'{profile.budget_limit}:{",".join(enabled_categories(profile))}'
+    )
+    settings_digest = hashlib.blake2b(settings.encode(), digest_size=8).hexdigest()
+    return (
+        f'planner:daily_menu:{profile.user_id}:{day.isoformat()}:'
+        f'{get_catalog_version()}:{settings_digest}'
+    )
+
+
+def select_daily_menu(profile, day):
+    key = daily_menu_cache_key(profile, day)
+    menu = cache.get(key)
+    if menu is None:
+        menu = _load_menu_dishes(profile, rotated_selection(profile, day))
+        cache.set(key, menu, DAILY_MENU_CACHE_TIMEOUT)
+    return menu
+
+
+def build_daily_menu(profile, day, catalog=None):
+    """Возвращает несохранённые строки DailyMenu профиля на указанный день."""
+    if catalog is None:
+        catalog = get_catalog()
+    persons = profile.count_of_persons
+
+    rows = []
+    for category, dish_ids in rotated_selection(profile, day, catalog).items():
+        for dish_id in dish_ids:
+            price, calories = catalog.totals(dish_id)
+            rows.append(DailyMenu(
+                profile=profile,
+                date=day,
+                category=category,
+                dish_id=dish_id,
+                price=price * persons,
+                calories=calories * persons,
+            ))
+    return rows
+
+
+def materialized_menu(profile, day):
+    rows = DailyMenu.objects.filter(
+        profile=profile, date=day
+    ).select_related('dish').only(
+        'category', 'price', 'calories',
+        *(f'dish__{field}' for field in MENU_CARD_FIELDS),
+    )
+
+    menu = {}
+    for row in rows:
+        dish = row.dish
+        dish.adjusted_price = row.price
+        dish.adjusted_calories = row.calories
+        menu.setdefault(row.category, []).append(dish)
+    return menu
+
+
+def menu_for_day(profile, day):
+    """Меню из сохранённого DailyMenu, а если его нет, то из кеша или на лету."""
+    menu = materialized_menu(profile, day)
+    if menu:
+        for category in enabled_categories(profile):
+            menu.setdefault(category, [])
+        return menu
+    return select_daily_menu(profile, day)
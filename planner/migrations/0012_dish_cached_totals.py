@@ -0,0 +1,56 @@
+# Generated by Django 4.2.20 on 2026-10-18 18:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_cached_totals(apps, schema_editor):
+    Dish = apps.get_model('planner', 'Dish')
+    DishIngredient = apps.get_model('planner', 'DishIngredient')
+    for dish in Dish.objects.all():
+        rows = DishIngredient.objects.filter(dish=dish).select_related('ingredient')
+        dish.cached_price = sum(r.quantity * r.ingredient.price for r in rows)
+        dish.cached_calories = sum(r.quantity * r.ingredient.callories for r in rows)
+        dish.save(update_fields=['cached_price', 'cached_calories'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('planner', '0011_userprofile_avatar'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dish',
+            name='cached_calories',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12, verbose_name='Калорийность'),
+        ),
+        migrations.AddField(
+            model_name='dish',
+            name='cached_price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12, verbose_name='Стоимость'),
+        ),
+        migrations.CreateModel(
+            name='SubscriptionOrder',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='Сумма заказа')),
+                ('description', models.CharField(max_length=255, verbose_name='Описание подписки')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает оплаты'), ('paid', 'Оплачен'), ('failed', 'Не удался')], default='pending', max_length=20, verbose_name='Статус')),
+                ('payment_id', models.CharField(blank=True, max_length=255, null=True, verbose_name='ID платежа')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('subscription_params', models.JSONField(default=dict, verbose_name='Параметры подписки')),
+                ('payment_data', models.JSONField(blank=True, null=True, verbose_name='Данные платежа')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='active_subscription',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='planner.subscriptionorder', verbose_name='Активная подписка'),
+        ),
+        migrations.RunPython(fill_cached_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.20 on 2026-10-18 18:12
+
+from django.db import migrations, models
+
+
+def fill_allergen_masks(apps, schema_editor):
+    Allergy = apps.get_model('planner', 'Allergy')
+    Dish = apps.get_model('planner', 'Dish')
+    UserProfile = apps.get_model('planner', 'UserProfile')
+
+    for index, allergy in enumerate(Allergy.objects.order_by('id')):
+        allergy.bit = 1 << index
+        allergy.save(update_fields=['bit'])
+
+    for dish in Dish.objects.all():
+        bits = set(Allergy.objects.filter(
+            ingredient__dishingredient__dish=dish
+        ).values_list('bit', flat=True))
+        dish.allergen_mask = sum(bits)
+        dish.save(update_fields=['allergen_mask'])
+
+    for profile in UserProfile.objects.all():
+        profile.allergen_mask = sum(profile.allergies.values_list('bit', flat=True))
+        profile.save(update_fields=['allergen_mask'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planner', '0012_dish_cached_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='allergy',
+            name='bit',
+            field=models.BigIntegerField(editable=False, null=True, unique=True, verbose_name='Бит в маске аллергенов'),
+        ),
+        migrations.AddField(
+            model_name='dish',
+            name='allergen_mask',
+            field=models.BigIntegerField(default=0, editable=False, verbose_name='Маска аллергенов'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='allergen_mask',
+            field=models.BigIntegerField(default=0, editable=False, verbose_name='Маска аллергий'),
+        ),
+        migrations.RunPython(fill_allergen_masks, migrations.RunPython.noop),
+    ]
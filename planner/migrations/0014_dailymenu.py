@@ -0,0 +1,34 @@
+# Generated by Django 4.2.20 on 2026-10-18 18:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planner', '0013_allergen_masks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyMenu',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Дата')),
+                ('category', models.CharField(choices=[('breakfast', 'Завтрак'), ('lunch', 'Обед'), ('dinner', 'Ужин'), ('dessert', 'Десерт')], max_length=50, verbose_name='Приём пищи')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Стоимость на всех персон')),
+                ('calories', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Калорийность на всех персон')),
+                ('dish', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='planner.dish', verbose_name='Блюдо')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_menus', to='planner.userprofile', verbose_name='Профиль')),
+            ],
+            options={
+                'verbose_name': 'Меню на день',
+                'verbose_name_plural': 'Меню на день',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dailymenu',
+            constraint=models.UniqueConstraint(fields=('profile', 'date', 'category'), name='unique_daily_menu_meal'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.20 on 2026-10-18 18:18
+
+from django.db import migrations, models
+
+
+def fill_card_fields(apps, schema_editor):
+    Dish = apps.get_model('planner', 'Dish')
+    DishIngredient = apps.get_model('planner', 'DishIngredient')
+    for dish in Dish.objects.all():
+        rows = DishIngredient.objects.filter(dish=dish).select_related('ingredient').order_by('pk')
+        dish.recipe_paragraphs = dish.recipe.splitlines()
+        dish.ingredient_list = [
+            {
+                'name': row.ingredient.name,
+                'quantity': str(row.quantity),
+                'unit': row.ingredient.get_unit_display(),
+            }
+            for row in rows
+        ]
+        dish.save(update_fields=['recipe_paragraphs', 'ingredient_list'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planner', '0014_dailymenu'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dish',
+            name='ingredient_list',
+            field=models.JSONField(default=list, editable=False, verbose_name='Ингредиенты для карточки'),
+        ),
+        migrations.AddField(
+            model_name='dish',
+            name='recipe_paragraphs',
+            field=models.JSONField(default=list, editable=False, verbose_name='Абзацы рецепта'),
+        ),
+        migrations.RunPython(fill_card_fields, migrations.RunPython.noop),
+    ]
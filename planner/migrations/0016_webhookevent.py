@@ -0,0 +1,34 @@
+# Generated by Django 4.2.20 on 2026-10-18 18:25
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planner', '0015_dish_card_precomputed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event', models.CharField(blank=True, max_length=64, verbose_name='Событие')),
+                ('payment_id', models.CharField(blank=True, db_index=True, max_length=255, verbose_name='ID платежа')),
+                ('payload', models.JSONField(verbose_name='Тело уведомления')),
+                ('status', models.CharField(choices=[('new', 'Ожидает обработки'), ('processed', 'Обработано'), ('failed', 'Не удалось обработать')], default='new', max_length=20, verbose_name='Статус')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Попыток обработки')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Следующая попытка')),
+                ('last_error', models.TextField(blank=True, verbose_name='Последняя ошибка')),
+                ('received_at', models.DateTimeField(auto_now_add=True, verbose_name='Получено')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='Обработано')),
+            ],
+            options={
+                'verbose_name': 'Уведомление ЮKassa',
+                'verbose_name_plural': 'Уведомления ЮKassa',
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='webhook_event_queue_idx')],
+            },
+        ),
+    ]
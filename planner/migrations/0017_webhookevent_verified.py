@@ -0,0 +1,18 @@
+# Generated by Django 4.2.20 on 2026-10-18 18:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planner', '0016_webhookevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookevent',
+            name='verified',
+            field=models.BooleanField(default=False, verbose_name='Отправитель подтверждён'),
+        ),
+    ]
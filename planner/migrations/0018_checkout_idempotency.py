@@ -0,0 +1,27 @@
+# Generated by Django 4.2.20 on 2026-10-18 18:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('planner', '0017_webhookevent_verified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriptionorder',
+            name='confirmation_url',
+            field=models.URLField(blank=True, max_length=500, verbose_name='Ссылка на оплату'),
+        ),
+        migrations.AddField(
+            model_name='subscriptionorder',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, verbose_name='Ключ идемпотентности'),
+        ),
+        migrations.AddConstraint(
+            model_name='subscriptionorder',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'pending')), fields=('idempotency_key',), name='unique_pending_checkout'),
+        ),
+    ]
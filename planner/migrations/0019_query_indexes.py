@@ -0,0 +1,43 @@
+# Generated by Django 4.2.20 on 2026-10-18 19:21
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def clear_blank_payment_ids(apps, schema_editor):
+    # Уникальность проверяется только для непустых ID платежа
+    SubscriptionOrder = apps.get_model('planner', 'SubscriptionOrder')
+    SubscriptionOrder.objects.filter(payment_id='').update(payment_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('planner', '0018_checkout_idempotency'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dish',
+            index=models.Index(fields=['diet_type', 'category'], name='dish_diet_category_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subscriptionorder',
+            index=models.Index(fields=['user', 'status'], name='order_user_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userprofile',
+            index=models.Index(fields=['subscription_end_date'], name='profile_subscription_end_idx'),
+        ),
+        migrations.RunPython(clear_blank_payment_ids, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='subscriptionorder',
+            constraint=models.UniqueConstraint(condition=models.Q(('payment_id__isnull', False)), fields=('payment_id',), name='unique_payment_id'),
+        ),
+        # Проверка email при регистрации; таблица пользователей принадлежит auth
+        migrations.RunSQL(
+            'CREATE INDEX IF NOT EXISTS planner_auth_user_email_idx ON auth_user (email)',
+            'DROP INDEX IF EXISTS planner_auth_user_email_idx',
+        ),
+    ]
@@ -1,14 +1,68 @@
 from django.db import models
+from django.db.models import (
+    Case,
+    DecimalField,
+    ExpressionWrapper,
+    F,
+    OuterRef,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+from .bulk import update_rows
+
+
+# Битовая маска хранится в знаковом BIGINT, поэтому аллергенов не больше 63
+MAX_ALLERGY_BITS = 63
 
 
 class Allergy(models.Model):
     name = models.CharField(max_length=150, verbose_name='Аллергия')
+    bit = models.BigIntegerField(
+        unique=True,
+        null=True,
+        editable=False,
+        verbose_name='Бит в маске аллергенов'
+    )
+
+    def save(self, *args, **kwargs):
+        if self.bit is None:
+            self.bit = self.next_free_bit()
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def next_free_bit():
+        used = set(
+            Allergy.objects.filter(bit__isnull=False).values_list('bit', flat=True)
+        )
+        for index in range(MAX_ALLERGY_BITS):
+            if 1 << index not in used:
+                return 1 << index
+        raise ValueError('Закончились свободные биты для аллергенов')
 
     def __str__(self):
         return self.name
 
 
+def allergen_mask_subquery(**lookup):
+    """Маска аллергенов как SUM(DISTINCT bit): биты не пересекаются, так что это OR."""
+    return Coalesce(
+        Subquery(
+            Allergy.objects.filter(**lookup).values(
+                *lookup.keys()
+            ).annotate(
+                mask=Sum('bit', distinct=True)
+            ).values('mask')
+        ),
+        Value(0, output_field=models.BigIntegerField()),
+    )
+
+
 class DietType(models.Model):
     name = models.CharField(max_length=150, verbose_name='Тип диеты')
 
@@ -16,6 +70,36 @@ class DietType(models.Model):
         return self.name
 
 
+class SubscriptionOrderQuerySet(models.QuerySet):
+    def with_activity(self, today=None):
+        """Добавляет subscription_is_active: заказ оплачен и подписка не истекла."""
+        today = today or timezone.now().date()
+        return self.annotate(
+            subscription_is_active=Case(
+                When(
+                    status='paid',
+                    user__userprofile__subscription_end_date__gte=today,
+                    then=Value(True),
+                ),
+                default=Value(False),
+                output_field=models.BooleanField(),
+            )
+        )
+
+    # Фильтры повторяют условие аннотации: по выражению CASE индекс не работает
+    def active(self, today=None):
+        today = today or timezone.now().date()
+        return self.with_activity(today).filter(
+            status='paid',
+            user__userprofile__subscription_end_date__gte=today,
+        )
+
+    def expired(self, today=None):
+        return self.with_activity(today).exclude(
+            pk__in=self.active(today).values('pk')
+        )
+
+
 class SubscriptionOrder(models.Model):
     user = models.ForeignKey(
         User,
@@ -60,9 +144,48 @@ class SubscriptionOrder(models.Model):
         blank=True,
         verbose_name='Данные платежа'
     )
+    idempotency_key = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name='Ключ идемпотентности'
+    )
+    confirmation_url = models.URLField(
+        max_length=500,
+        blank=True,
+        verbose_name='Ссылка на оплату'
+    )
+
+    class Meta:
+        constraints = [
+            # Повторная отправка формы находит уже созданный заказ
+            models.UniqueConstraint(
+                fields=['idempotency_key'],
+                condition=models.Q(status='pending'),
+                name='unique_pending_checkout',
+            ),
+            # Вебхуки и сверка ищут заказ по ID платежа
+            models.UniqueConstraint(
+                fields=['payment_id'],
+                condition=models.Q(payment_id__isnull=False),
+                name='unique_payment_id',
+            ),
+        ]
+        indexes = [
+            models.Index(
+                fields=['user', 'status'],
+                name='order_user_status_idx',
+            ),
+        ]
+
+    objects = SubscriptionOrderQuerySet.as_manager()
 
     @property
     def is_active(self):
+        # Списки заказов берут признак из with_activity() без запроса к профилю
+        if hasattr(self, 'subscription_is_active'):
+            return self.subscription_is_active
         return self.status == 'paid' and (
             self.user.userprofile.subscription_end_date >= timezone.now().date()
             if hasattr(self.user, 'userprofile') and self.user.userprofile.subscription_end_date
@@ -73,6 +196,36 @@ class SubscriptionOrder(models.Model):
         return f"Заказ #{self.id} - {self.get_status_display()}"
 
 
+class UserProfileQuerySet(models.QuerySet):
+    def with_subscription_status(self, today=None):
+        today = today or timezone.now().date()
+        return self.annotate(
+            subscription_is_active=Case(
+                When(subscription_end_date__gte=today, then=Value(True)),
+                default=Value(False),
+                output_field=models.BooleanField(),
+            )
+        )
+
+    def active(self, today=None):
+        today = today or timezone.now().date()
+        return self.with_subscription_status(today).filter(
+            subscription_end_date__gte=today
+        )
+
+    def expired(self, today=None):
+        today = today or timezone.now().date()
+        return self.with_subscription_status(today).filter(
+            models.Q(subscription_end_date__lt=today)
+            | models.Q(subscription_end_date__isnull=True)
+        )
+
+    def refresh_allergen_mask(self):
+        return self.update(
+            allergen_mask=allergen_mask_subquery(userprofile=OuterRef('pk'))
+        )
+
+
 class UserProfile(models.Model):
     user = models.OneToOneField(
         User,
@@ -136,6 +289,22 @@ class UserProfile(models.Model):
         on_delete=models.SET_NULL,
         verbose_name='Активная подписка'
     )
+    allergen_mask = models.BigIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Маска аллергий'
+    )
+
+    objects = UserProfileQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Выборки активных подписчиков
+            models.Index(
+                fields=['subscription_end_date'],
+                name='profile_subscription_end_idx',
+            ),
+        ]
 
     def __str__(self):
         return self.user.username
@@ -178,6 +347,68 @@ class Ingredient(models.Model):
         return f'{self.name} ({self.get_unit_display()})'
 
 
+UNIT_NAMES = dict(Ingredient.UNIT_CHOICES)
+
+
+class DishQuerySet(models.QuerySet):
+    def refresh_cached_totals(self):
+        """Пересчитывает cached_price/cached_calories одним UPDATE."""
+        totals = DishIngredient.objects.filter(
+            dish=OuterRef('pk')
+        ).values('dish').annotate(
+            price=Sum(ExpressionWrapper(
+                F('quantity') * F('ingredient__price'),
+                output_field=DecimalField(max_digits=20, decimal_places=4),
+            )),
+            calories=Sum(ExpressionWrapper(
+                F('quantity') * F('ingredient__callories'),
+                output_field=DecimalField(max_digits=20, decimal_places=4),
+            )),
+        )
+        zero = Value(0, output_field=DecimalField(max_digits=12, decimal_places=2))
+        return self.update(
+            cached_price=Coalesce(Subquery(totals.values('price')), zero),
+            cached_calories=Coalesce(Subquery(totals.values('calories')), zero),
+        )
+
+    def refresh_allergen_mask(self):
+        return self.update(
+            allergen_mask=allergen_mask_subquery(
+                ingredient__dishingredient__dish=OuterRef('pk')
+            )
+        )
+
+    def drop_future_daily_menus(self):
+        """Удаляет будущие меню профилей, в которые попали эти блюда.
+
+        Меню удаляется целиком, а не только строки с блюдом: частично
+        удалённый день показал бы пустые приёмы пищи вместо подбора заново.
+        """
+        today = timezone.now().date()
+        profile_ids = DailyMenu.objects.filter(
+            dish__in=self.values('pk'), date__gte=today
+        ).values('profile_id')
+        return DailyMenu.objects.filter(
+            profile_id__in=profile_ids, date__gte=today
+        ).delete()
+
+    def refresh_ingredient_lists(self):
+        """Пересобирает списки ингредиентов карточек одним запросом на чтение."""
+        dishes = list(self.only('pk'))
+        lists = {dish.pk: [] for dish in dishes}
+        rows = DishIngredient.objects.filter(
+            dish__in=lists.keys()
+        ).order_by('pk').values_list(
+            'dish_id', 'ingredient__name', 'quantity', 'ingredient__unit'
+        )
+        for dish_id, name, quantity, unit in rows:
+            lists[dish_id].append(DishIngredient.make_card_entry(name, quantity, unit))
+
+        for dish in dishes:
+            dish.ingredient_list = lists[dish.pk]
+        return update_rows(dishes, ['ingredient_list'])
+
+
 class Dish(models.Model):
     DISH_CATEGORY_CHOICES = [
         ('breakfast', 'Завтрак'),
@@ -220,20 +451,65 @@ class Dish(models.Model):
         verbose_name='Категория блюда',
         default='lunch'
     )
+    cached_price = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        default=0,
+        editable=False,
+        verbose_name='Стоимость'
+    )
+    cached_calories = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        default=0,
+        editable=False,
+        verbose_name='Калорийность'
+    )
+    allergen_mask = models.BigIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Маска аллергенов'
+    )
+    recipe_paragraphs = models.JSONField(
+        default=list,
+        editable=False,
+        verbose_name='Абзацы рецепта'
+    )
+    ingredient_list = models.JSONField(
+        default=list,
+        editable=False,
+        verbose_name='Ингредиенты для карточки'
+    )
+
+    objects = DishQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Подбор меню: блюда одного типа диеты по приёмам пищи
+            models.Index(
+                fields=['diet_type', 'category'],
+                name='dish_diet_category_idx',
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.recipe_paragraphs = self.recipe.splitlines()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'recipe' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'recipe_paragraphs'}
+        super().save(*args, **kwargs)
 
     @property
     def total_price(self):
-        return sum(
-            di.quantity * di.ingredient.price
-            for di in self.dishingredient_set.all()
-        )
+        return self.cached_price
 
     @property
     def total_calories(self):
-        return sum(
-            di.quantity * di.ingredient.callories
-            for di in self.dishingredient_set.all()
-        )
+        return self.cached_calories
+
+    def refresh_cached_totals(self):
+        Dish.objects.filter(pk=self.pk).refresh_cached_totals()
+        self.refresh_from_db(fields=['cached_price', 'cached_calories'])
 
     def __str__(self):
         return self.name
@@ -253,5 +529,145 @@ class DishIngredient(models.Model):
         verbose_name='Количество'
     )
 
+    @staticmethod
+    def make_card_entry(name, quantity, unit):
+        return {
+            'name': name,
+            'quantity': str(quantity),
+            'unit': UNIT_NAMES.get(unit, unit),
+        }
+
+    def card_entry(self):
+        return self.make_card_entry(
+            self.ingredient.name, self.quantity, self.ingredient.unit
+        )
+
     def __str__(self):
         return f'{self.ingredient} - {self.quantity}'
+
+
+class DailyMenu(models.Model):
+    profile = models.ForeignKey(
+        UserProfile,
+        on_delete=models.CASCADE,
+        related_name='daily_menus',
+        verbose_name='Профиль'
+    )
+    date = models.DateField(verbose_name='Дата')
+    category = models.CharField(
+        max_length=50,
+        choices=Dish.DISH_CATEGORY_CHOICES,
+        verbose_name='Приём пищи'
+    )
+    dish = models.ForeignKey(
+        Dish,
+        on_delete=models.CASCADE,
+        verbose_name='Блюдо'
+    )
+    price = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        verbose_name='Стоимость на всех персон'
+    )
+    calories = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        verbose_name='Калорийность на всех персон'
+    )
+
+    class Meta:
+        verbose_name = 'Меню на день'
+        verbose_name_plural = 'Меню на день'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['profile', 'date', 'category'],
+                name='unique_daily_menu_meal',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.profile} {self.date:%d.%m.%Y} {self.get_category_display()}'
+
+
+class WebhookEvent(models.Model):
+    STATUS_CHOICES = [
+        ('new', 'Ожидает обработки'),
+        ('processed', 'Обработано'),
+        ('failed', 'Не удалось обработать'),
+    ]
+
+    event = models.CharField(
+        max_length=64,
+        blank=True,
+        verbose_name='Событие'
+    )
+    payment_id = models.CharField(
+        max_length=255,
+        blank=True,
+        db_index=True,
+        verbose_name='ID платежа'
+    )
+    payload = models.JSONField(verbose_name='Тело уведомления')
+    verified = models.BooleanField(
+        default=False,
+        verbose_name='Отправитель подтверждён'
+    )
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default='new',
+        verbose_name='Статус'
+    )
+    attempts = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Попыток обработки'
+    )
+    next_attempt_at = models.DateTimeField(
+        default=timezone.now,
+        verbose_name='Следующая попытка'
+    )
+    last_error = models.TextField(
+        blank=True,
+        verbose_name='Последняя ошибка'
+    )
+    received_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name='Получено'
+    )
+    processed_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name='Обработано'
+    )
+
+    class Meta:
+        verbose_name = 'Уведомление ЮKassa'
+        verbose_name_plural = 'Уведомления ЮKassa'
+        indexes = [
+            models.Index(
+                fields=['status', 'next_attempt_at'],
+                name='webhook_event_queue_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.event or "без события"} {self.payment_id} - {self.get_status_display()}'
+
+
+class CatalogVersion(models.Model):
+    """Версия каталога блюд, общая для всех процессов приложения.
+
+    Хранится одной строкой в базе: снимки каталога и закешированные меню
+    в памяти процессов сверяются с ней и перечитываются после изменений.
+    """
+    version = models.PositiveBigIntegerField(
+        default=1,
+        verbose_name='Версия'
+    )
+
+    class Meta:
+        verbose_name = 'Версия каталога'
+        verbose_name_plural = 'Версия каталога'
+
+    def __str__(self):
+        return str(self.version)
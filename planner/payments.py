@@ -0,0 +1,407 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta, timezone as dt_timezone
+from functools import partial
+
+import requests
+from yookassa import Configuration, Payment
+from yookassa.client import ApiClient
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Allergy, DietType, SubscriptionOrder, UserProfile
+
+
+logger = logging.getLogger(__name__)
+
+
+REQUIRED_FIELDS = [
+    'foodtype',
+    'select1',
+    'select2',
+    'select3',
+    'select4',
+    'select5',
+    'duration',
+]
+
+duration_mapping = {
+    '0': '30',
+    '1': '90',
+    '2': '180',
+    '3': '365',
+}
+
+FOODTYPE_NAMES = {
+    'classic': 'Классическое',
+    'low': 'Низкоуглеводное',
+    'veg': 'Вегетарианское',
+    'keto': 'Кето',
+}
+
+ALLERGY_FIELDS = {
+    'allergy1': 'Рыба и морепродукты',
+    'allergy2': 'Мясо',
+    'allergy3': 'Зерновые',
+    'allergy4': 'Продукты пчеловодства',
+    'allergy5': 'Орехи и бобовые',
+    'allergy6': 'Молочные продукты',
+}
+
+# Одинаковые оформления в пределах окна считаются повторной отправкой формы
+CHECKOUT_IDEMPOTENCY_WINDOW = 10 * 60
+CHECKOUT_POLL_INTERVAL = 0.1
+
+_lookup_cache = {}
+_lookup_lock = threading.Lock()
+
+# Вызовы SDK блокирующие, поэтому асинхронные view выполняют их в
+# отдельном ограниченном пуле потоков, а не в пуле sync_to_async
+provider_pool = ThreadPoolExecutor(
+    max_workers=settings.YOOKASSA_MAX_CONCURRENCY,
+    thread_name_prefix='yookassa',
+)
+
+
+class PaymentActivationError(Exception):
+    pass
+
+
+class ProviderTimeout(Exception):
+    """ЮKassa не ответила вовремя: платёж мог быть создан, а мог и нет."""
+
+
+def provider_timeouts():
+    return settings.YOOKASSA_CONNECT_TIMEOUT, settings.YOOKASSA_TIMEOUT
+
+
+class ProviderApiClient(ApiClient):
+    """Клиент SDK с таймаутами соединения и чтения.
+
+    SDK вызывает ``session.request`` без таймаута, а ``Configuration.timeout``
+    задаёт только паузу между повторами, поэтому зависший API ЮKassa
+    держал бы поток сколь угодно долго.
+    """
+
+    def get_session(self):
+        session = super().get_session()
+        # Повтор после таймаута умножал бы время ожидания
+        adapter = session.get_adapter('https://')
+        adapter.max_retries = adapter.max_retries.new(connect=0, read=0)
+        session.request = partial(session.request, timeout=provider_timeouts())
+        return session
+
+    def request(self, *args, **kwargs):
+        try:
+            return super().request(*args, **kwargs)
+        except Exception as e:
+            # SDK разбирает только ошибки с ответом API: на сетевой ошибке
+            # он падает с AttributeError, а исходная остаётся в __context__
+            if isinstance(e.__context__, (requests.Timeout, requests.ConnectionError)):
+                raise ProviderTimeout(str(e.__context__)) from e.__context__
+            raise
+
+
+class ProviderPayment(Payment):
+    def __init__(self):
+        self.client = ProviderApiClient()
+
+
+def subscription_order_data(post):
+    """Сумма, описание и параметры подписки из формы заказа."""
+    duration = post.get('duration', '0')
+    meal_count = sum(
+        1 for select in ['select1', 'select2', 'select3', 'select4']
+        if post.get(select) == '0'
+    )
+
+    price_per_month = {'0': 1200, '1': 1000, '2': 700, '3': 500}.get(
+        duration, 1200
+    )
+    total_amount = price_per_month * meal_count
+    duration_days = int(duration_mapping.get(duration, '30'))
+
+    diet_type_name = FOODTYPE_NAMES.get(post.get('foodtype'), 'Неизвестный')
+
+    description = (
+        f"Подписка FoodPlan: {diet_type_name} меню, "
+        f"{duration_days} дней, {meal_count} приемов пищи"
+    )
+
+    return {
+        'amount': total_amount,
+        'description': description,
+        'subscription_params': {
+            'duration': duration,
+            'duration_days': duration_days,
+            'meal_count': meal_count,
+            'foodtype': post.get('foodtype'),
+            'select1': post.get('select1'),
+            'select2': post.get('select2'),
+            'select3': post.get('select3'),
+            'select4': post.get('select4'),
+            'select5': post.get('select5'),
+            **{
+                f'allergy{i}': post.get(f'allergy{i}', '0')
+                for i in range(1, 7)
+            },
+        },
+    }
+
+
+def checkout_idempotency_key(user_id, subscription_params, now=None):
+    """Ключ оформления: пользователь, параметры подписки и интервал времени."""
+    bucket = int((now or time.time()) // CHECKOUT_IDEMPOTENCY_WINDOW)
+    data = json.dumps(
+        [user_id, subscription_params, bucket], sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def provider_idempotency_key(order):
+    """Ключ запроса к ЮKassa: один платёж на заказ, не длиннее 64 символов."""
+    return f'order-{order.pk}-{order.idempotency_key[:40]}'
+
+
+def checkout_cache_key(idempotency_key):
+    return f'checkout:{idempotency_key}'
+
+
+def remember_checkout(order):
+    cache.set(
+        checkout_cache_key(order.idempotency_key),
+        order.confirmation_url,
+        CHECKOUT_IDEMPOTENCY_WINDOW,
+    )
+
+
+def forget_checkouts(orders):
+    """Оплаченный или отменённый заказ больше не отдаётся повторной отправке."""
+    keys = [
+        checkout_cache_key(order.idempotency_key)
+        for order in orders if order.idempotency_key
+    ]
+    if keys:
+        transaction.on_commit(partial(cache.delete_many, keys))
+
+
+def confirmation_deadline(order):
+    """До какого момента запрос, создавший заказ, ещё может получить ссылку.
+
+    Позже его вызов ЮKassa уже завершился по таймауту, и ждать ссылку
+    бессмысленно: повторный запрос с тем же ключом вернёт тот же платёж.
+    """
+    return order.created_at + timedelta(seconds=sum(provider_timeouts()))
+
+
+def wait_for_confirmation_url(order):
+    """Ждёт, пока параллельный запрос получит ссылку на оплату заказа."""
+    deadline = confirmation_deadline(order)
+    while not order.confirmation_url and timezone.now() < deadline:
+        time.sleep(CHECKOUT_POLL_INTERVAL)
+        order.refresh_from_db(fields=['payment_id', 'confirmation_url'])
+    return order.confirmation_url
+
+
+async def await_confirmation_url(order):
+    deadline = confirmation_deadline(order)
+    while not order.confirmation_url and timezone.now() < deadline:
+        await asyncio.sleep(CHECKOUT_POLL_INTERVAL)
+        await order.arefresh_from_db(fields=['payment_id', 'confirmation_url'])
+    return order.confirmation_url
+
+
+def payment_payload(order, return_url):
+    return {
+        "amount": {
+            "value": f"{order.amount:.2f}",
+            "currency": "RUB",
+        },
+        "confirmation": {
+            "type": "redirect",
+            "return_url": return_url,
+        },
+        "capture": True,
+        "description": order.description,
+        "metadata": {
+            "order_id": order.id,
+            "user_id": order.user_id,
+            "subscription_type": "foodplan",
+        },
+    }
+
+
+def configure_provider():
+    """Настраивает SDK ЮKassa; адрес API можно подменить локальной заглушкой."""
+    Configuration.configure(
+        settings.YOOKASSA_SHOP_ID,
+        settings.YOOKASSA_SECRET_KEY,
+        api_url=settings.YOOKASSA_API_URL,
+    )
+
+
+def api_timestamp(moment):
+    """Время в формате API ЮKassa: 2024-01-01T10:00:00.000Z."""
+    return moment.astimezone(dt_timezone.utc).isoformat(
+        timespec='milliseconds'
+    ).replace('+00:00', 'Z')
+
+
+def create_provider_payment(payload, idempotency_key=None):
+    return ProviderPayment.create(payload, idempotency_key or str(uuid.uuid4()))
+
+
+def find_provider_payment(payment_id):
+    return ProviderPayment.find_one(payment_id)
+
+
+def list_provider_payments(params):
+    """Перебирает все страницы списка платежей ЮKassa."""
+    params = dict(params, limit=100)
+    while True:
+        response = ProviderPayment.list(params)
+        yield from response.items or []
+        if not response.next_cursor:
+            return
+        params['cursor'] = response.next_cursor
+
+
+async def run_provider_call(func, *args):
+    """Выполняет вызов SDK в пуле потоков.
+
+    Поток освобождается по таймаутам HTTP-сессии SDK; ``wait_for`` лишь
+    страхует view от ответа, который приходит медленно, но без пауз.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(provider_pool, partial(func, *args)),
+            timeout=sum(provider_timeouts()),
+        )
+    except asyncio.TimeoutError:
+        raise ProviderTimeout('Истекло время ожидания ответа ЮKassa')
+
+
+def lookup_objects(model, names):
+    """Справочные записи по названиям, закешированные на время жизни процесса.
+
+    Набор диет и аллергий фиксирован, поэтому записи читаются из базы
+    одним запросом при первом обращении; недостающие создаются.
+    """
+    cache = _lookup_cache.setdefault(model, {})
+    objects = {name: cache[name] for name in names if name in cache}
+    missing = [name for name in names if name not in objects]
+    if missing:
+        with _lookup_lock:
+            for obj in model.objects.filter(name__in=missing):
+                objects[obj.name] = cache[obj.name] = obj
+            for name in missing:
+                if name not in objects:
+                    obj = objects[name] = model.objects.get_or_create(name=name)[0]
+                    # Созданная запись пропадёт, если транзакция откатится
+                    transaction.on_commit(partial(cache.setdefault, name, obj))
+    return [objects[name] for name in names]
+
+
+def clear_lookup_cache():
+    _lookup_cache.clear()
+
+
+def activate_subscription(order, payment):
+    try:
+        with transaction.atomic():
+            profile = order.user.userprofile
+            sub_params = order.subscription_params
+
+            profile.breakfast = sub_params.get('select1') == '0'
+            profile.lunch = sub_params.get('select2') == '0'
+            profile.dinner = sub_params.get('select3') == '0'
+            profile.dessert = sub_params.get('select4') == '0'
+
+            persons_mapping = {'0': 1, '1': 2, '2': 3, '3': 4, '4': 5, '5': 6}
+            profile.count_of_persons = persons_mapping.get(
+                sub_params.get('select5', '0'), 1
+            )
+
+            diet_type_name = FOODTYPE_NAMES.get(sub_params.get('foodtype'))
+            if diet_type_name:
+                profile.diet_type = lookup_objects(DietType, [diet_type_name])[0]
+
+            allergies = lookup_objects(Allergy, list(ALLERGY_FIELDS.values()))
+            allergies = [
+                allergy for key, allergy in zip(ALLERGY_FIELDS, allergies)
+                if sub_params.get(key) == '1'
+            ]
+            # Связи пишем напрямую в промежуточную таблицу: set() вызывал бы
+            # m2m_changed, пересчитывающий маску запросом на каждое действие,
+            # а маска и так известна из битов аллергий
+            Through = UserProfile.allergies.through
+            Through.objects.filter(userprofile=profile).delete()
+            Through.objects.bulk_create([
+                Through(userprofile=profile, allergy=allergy) for allergy in allergies
+            ])
+            profile.allergen_mask = sum(allergy.bit or 0 for allergy in allergies)
+
+            duration_days = int(sub_params.get('duration_days', 30))
+            profile.subscription_end_date = timezone.now().date() + timedelta(
+                days=duration_days
+            )
+
+            profile.active_subscription = order
+            profile.save()
+
+            order.status = 'paid'
+            order.payment_data = {
+                'id': payment.id,
+                'status': payment.status,
+                'paid': payment.paid,
+                'amount': str(payment.amount.value),
+                'currency': payment.amount.currency,
+                'created_at': payment.created_at,
+            }
+            order.save(update_fields=['status', 'payment_data'])
+            forget_checkouts([order])
+
+        logger.info(
+            f"Subscription activated for user {order.user.username}, "
+            f"order #{order.id}"
+        )
+        return True
+
+    except Exception as e:
+        # Закешированная запись могла быть удалена или не сохраниться
+        # вместе с откатом транзакции
+        clear_lookup_cache()
+        logger.error(
+            f"Subscription activation failed for order #{order.id}: {str(e)}",
+            exc_info=True,
+        )
+        return False
+
+
+def apply_payment(order, payment):
+    """Переносит статус платежа на заказ в одной транзакции."""
+    with transaction.atomic():
+        order = SubscriptionOrder.objects.select_for_update().select_related(
+            'user__userprofile'
+        ).get(pk=order.pk)
+        if order.status == 'paid':
+            return
+        if payment.status == 'succeeded':
+            if not activate_subscription(order, payment):
+                raise PaymentActivationError(
+                    f'Не удалось активировать подписку по заказу #{order.id}'
+                )
+        elif payment.status == 'canceled':
+            order.status = 'failed'
+            order.save(update_fields=['status'])
+            forget_checkouts([order])
@@ -0,0 +1,162 @@
+import csv
+import io
+import logging
+import zipfile
+from collections import Counter
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+import openpyxl
+from openpyxl.utils.exceptions import InvalidFileException
+
+from django.db import transaction
+
+from .bulk import update_rows
+from .catalog import bump_catalog_version
+from .models import Dish, DishIngredient, Ingredient
+
+
+logger = logging.getLogger(__name__)
+
+
+PRICE_IMPORT_CHUNK_SIZE = 1000
+PRICE_FIELDS = ('price', 'callories')
+
+
+class PriceImportError(Exception):
+    pass
+
+
+def csv_rows(file):
+    if isinstance(file, io.TextIOBase):
+        text = file
+    else:
+        text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    yield from csv.DictReader(text, dialect=dialect)
+
+
+def xlsx_rows(file):
+    try:
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, InvalidFileException, KeyError) as e:
+        raise PriceImportError(f'Не удалось прочитать XLSX: {str(e)}')
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(cell or '').strip() for cell in next(rows, ())]
+        for values in rows:
+            yield {
+                column: '' if value is None else str(value)
+                for column, value in zip(header, values)
+            }
+    finally:
+        workbook.close()
+
+
+def read_price_rows(file, filename):
+    """Построчно читает прайс-лист CSV или XLSX в словари по заголовку."""
+    if filename.lower().endswith('.xlsx'):
+        return xlsx_rows(file)
+    return csv_rows(file)
+
+
+def parse_decimal(value):
+    value = (value or '').strip().replace(' ', '').replace(',', '.')
+    if not value:
+        return None
+    number = Decimal(value)
+    if not number.is_finite() or number < 0:
+        raise InvalidOperation(value)
+    return number.quantize(Decimal('0.01'))
+
+
+def parse_price_row(row):
+    """Ключ (название, единица) и новые значения полей; пустые поля не меняются."""
+    name = (row.get('name') or '').strip()
+    unit = (row.get('unit') or '').strip()
+    if not name or not unit:
+        raise ValueError('не указаны название или единица измерения')
+    try:
+        values = {field: parse_decimal(row.get(field)) for field in PRICE_FIELDS}
+    except InvalidOperation:
+        raise ValueError('стоимость и калорийность должны быть неотрицательными числами')
+    return (name, unit), {field: value for field, value in values.items() if value is not None}
+
+
+def import_price_chunk(rows, stats):
+    """Обновляет одну пачку строк; возвращает id изменённых ингредиентов."""
+    parsed = {}
+    for line, row in rows:
+        try:
+            key, values = parse_price_row(row)
+        except ValueError as e:
+            stats['invalid'] += 1
+            logger.warning(f"Price import: line {line} skipped: {str(e)}")
+            continue
+        # Повтор ингредиента в прайсе: действует последняя строка
+        parsed[key] = values
+
+    existing = Ingredient.objects.filter(
+        name__in={name for name, _ in parsed}
+    ).only('pk', 'name', 'unit', *PRICE_FIELDS)
+    by_key = {}
+    for ingredient in existing:
+        by_key.setdefault((ingredient.name, ingredient.unit), []).append(ingredient)
+
+    changed = []
+    for key, values in parsed.items():
+        ingredients = by_key.get(key)
+        if not ingredients:
+            stats['unknown'] += 1
+            continue
+        for ingredient in ingredients:
+            if all(getattr(ingredient, field) == value for field, value in values.items()):
+                stats['unchanged'] += 1
+                continue
+            for field, value in values.items():
+                setattr(ingredient, field, value)
+            changed.append(ingredient)
+
+    # Сигналы не вызываются: блюда пересчитываются один раз в конце
+    update_rows(changed, PRICE_FIELDS)
+    stats['updated'] += len(changed)
+    return [ingredient.pk for ingredient in changed]
+
+
+def import_prices(rows, chunk_size=PRICE_IMPORT_CHUNK_SIZE):
+    """Загружает цены и калорийность ингредиентов из прайс-листа.
+
+    Строки читаются и применяются пачками по ``chunk_size``, после чего
+    сохранённые итоги пересчитываются только у блюд с изменёнными
+    ингредиентами. Возвращает счётчики строк и пересчитанных блюд.
+    """
+    stats = Counter()
+    dish_ids = set()
+    numbered = enumerate(rows, start=2)
+    with transaction.atomic():
+        while True:
+            chunk = list(islice(numbered, chunk_size))
+            if not chunk:
+                break
+            stats['rows'] += len(chunk)
+            changed = import_price_chunk(chunk, stats)
+            if changed:
+                dish_ids.update(
+                    DishIngredient.objects.filter(
+                        ingredient_id__in=changed
+                    ).values_list('dish_id', flat=True)
+                )
+
+        dish_ids = sorted(dish_ids)
+        for start in range(0, len(dish_ids), chunk_size):
+            dishes = Dish.objects.filter(pk__in=dish_ids[start:start + chunk_size])
+            stats['dishes'] += dishes.refresh_cached_totals()
+            dishes.drop_future_daily_menus()
+    if stats['updated']:
+        bump_catalog_version()
+    return stats
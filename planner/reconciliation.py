@@ -0,0 +1,176 @@
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import transaction
+
+from .models import SubscriptionOrder
+from .payments import (
+    PaymentActivationError,
+    api_timestamp,
+    apply_payment,
+    find_provider_payment,
+    forget_checkouts,
+    list_provider_payments,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+RECONCILE_BATCH_SIZE = 500
+RECONCILE_WORKERS = 16
+FINAL_STATUSES = ('succeeded', 'canceled')
+
+
+def pending_orders(created_from, created_to):
+    return SubscriptionOrder.objects.filter(
+        status='pending',
+        payment_id__isnull=False,
+        created_at__gte=created_from,
+        created_at__lt=created_to,
+    ).exclude(payment_id='')
+
+
+def unconfirmed_orders(created_from, created_to):
+    """Заказы без платежа: запрос на его создание оборвался по таймауту."""
+    return SubscriptionOrder.objects.filter(
+        status='pending',
+        payment_id__isnull=True,
+        created_at__gte=created_from,
+        created_at__lt=created_to,
+    )
+
+
+def recover_payments(created_from, created_to):
+    """Привязывает к заказам платежи, ответ на создание которых не дошёл.
+
+    Платёж находится в списке ЮKassa по order_id в метаданных. Если его
+    там нет, запрос до ЮKassa не дошёл, и заказ отменяется.
+    """
+    stats = Counter()
+    orders = {
+        str(order.pk): order
+        for order in unconfirmed_orders(created_from, created_to)
+    }
+    if not orders:
+        return stats
+
+    for payment in list_provider_payments({'created_at.gte': api_timestamp(created_from)}):
+        order = orders.pop(str((payment.metadata or {}).get('order_id')), None)
+        if order is None:
+            continue
+        confirmation = payment.confirmation
+        stats['recovered'] += SubscriptionOrder.objects.filter(
+            pk=order.pk, payment_id__isnull=True
+        ).update(
+            payment_id=payment.id,
+            confirmation_url=confirmation.confirmation_url if confirmation else '',
+        )
+
+    if orders:
+        with transaction.atomic():
+            stats['failed'] += SubscriptionOrder.objects.filter(
+                pk__in=[order.pk for order in orders.values()],
+                status='pending',
+                payment_id__isnull=True,
+            ).update(status='failed')
+            forget_checkouts(orders.values())
+    return stats
+
+
+def fetch_payments(payment_ids, pool):
+    """Статусы платежей, запрошенные параллельно; ошибки запросов пропускаются."""
+    def fetch(payment_id):
+        try:
+            return find_provider_payment(payment_id)
+        except Exception as e:
+            logger.warning(f"Payment lookup failed for {payment_id}: {str(e)}")
+            return None
+
+    return {
+        payment_id: payment
+        for payment_id, payment in zip(payment_ids, pool.map(fetch, payment_ids))
+        if payment is not None
+    }
+
+
+def listed_payments(created_from, payment_ids):
+    """Окончательные статусы платежей из списка API, без запроса на каждый."""
+    payments = {}
+    for status in FINAL_STATUSES:
+        for payment in list_provider_payments({
+            'status': status,
+            'created_at.gte': api_timestamp(created_from),
+        }):
+            if payment.id in payment_ids:
+                payments[payment.id] = payment
+    return payments
+
+
+def apply_payments(orders, payments):
+    """Переносит статусы платежей на пачку заказов в одной транзакции."""
+    stats = Counter()
+    with transaction.atomic():
+        canceled = set()
+        for order in orders:
+            payment = payments.get(order.payment_id)
+            if payment is None:
+                stats['unknown'] += 1
+            elif payment.status == 'canceled':
+                canceled.add(order.pk)
+            elif payment.status == 'succeeded':
+                # Сбой одной активации откатывает только её точку сохранения
+                try:
+                    apply_payment(order, payment)
+                except PaymentActivationError:
+                    stats['errors'] += 1
+                else:
+                    stats['paid'] += 1
+            else:
+                stats['pending'] += 1
+
+        if canceled:
+            stats['failed'] += SubscriptionOrder.objects.filter(
+                pk__in=canceled, status='pending'
+            ).update(status='failed')
+            forget_checkouts(order for order in orders if order.pk in canceled)
+    return stats
+
+
+def reconcile_orders(
+    created_from,
+    created_to,
+    batch_size=RECONCILE_BATCH_SIZE,
+    workers=RECONCILE_WORKERS,
+    use_list=False,
+):
+    """Сверяет ожидающие оплаты заказы с ЮKassa.
+
+    Сначала заказам, у которых создание платежа оборвалось по таймауту,
+    находятся их платежи. Заказы читаются пачками по первичному ключу.
+    Статусы платежей запрашиваются пулом из ``workers`` потоков или, с
+    ``use_list``, заранее выбираются постранично из списка платежей.
+    """
+    stats = recover_payments(created_from, created_to)
+    orders = pending_orders(created_from, created_to)
+
+    payments = None
+    if use_list:
+        payment_ids = set(orders.values_list('payment_id', flat=True))
+        payments = listed_payments(created_from, payment_ids)
+
+    last_pk = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reconcile') as pool:
+        while True:
+            batch = list(orders.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            batch_payments = payments
+            if batch_payments is None:
+                batch_payments = fetch_payments([order.payment_id for order in batch], pool)
+            stats['checked'] += len(batch)
+            stats.update(apply_payments(batch, batch_payments))
+    return stats
@@ -0,0 +1,183 @@
+import csv
+import json
+from collections import Counter, defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db.models import Case, DecimalField, F, IntegerField, Sum, Value, When
+
+from .catalog import get_catalog
+from .menu import rotated_selection
+from .models import DailyMenu, DishIngredient, Ingredient, UserProfile
+
+
+SHOPPING_LIST_DAYS = 7
+
+UNIT_NAMES = dict(Ingredient.UNIT_CHOICES)
+
+EXPORT_CHUNK_SIZE = 1000
+
+EXPORT_FIELDS = [
+    'date', 'profile_id', 'username', 'ingredient_id', 'ingredient',
+    'unit', 'quantity', 'cost',
+]
+
+EXPORT_PROFILE_FIELDS = (
+    'id', 'user_id', 'user__username', 'diet_type_id', 'allergen_mask',
+    'budget_limit', 'count_of_persons', 'breakfast', 'lunch', 'dinner', 'dessert',
+)
+
+
+def week_dish_counts(profile, start_date, days=SHOPPING_LIST_DAYS):
+    """Сколько раз каждое блюдо встречается в меню профиля за период."""
+    dates = [start_date + timedelta(days=offset) for offset in range(days)]
+    counts = Counter()
+    materialized_dates = set()
+    for day, dish_id in DailyMenu.objects.filter(
+        profile=profile, date__in=dates
+    ).values_list('date', 'dish_id'):
+        counts[dish_id] += 1
+        materialized_dates.add(day)
+
+    missing_dates = [day for day in dates if day not in materialized_dates]
+    if missing_dates:
+        catalog = get_catalog()
+        for day in missing_dates:
+            for dish_ids in rotated_selection(profile, day, catalog).values():
+                counts.update(dish_ids)
+    return counts
+
+
+def aggregate_ingredients(dish_counts, persons=1):
+    """Суммирует ингредиенты блюд одним GROUP BY.
+
+    ``dish_counts`` сопоставляет id блюда и число его повторов в меню.
+    """
+    if not dish_counts:
+        return [], Decimal('0')
+
+    if set(dish_counts.values()) == {1}:
+        repeats = Value(1)
+    else:
+        repeats = Case(
+            *[When(dish_id=dish_id, then=Value(count)) for dish_id, count in dish_counts.items()],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+    amount = DecimalField(max_digits=20, decimal_places=4)
+    rows = DishIngredient.objects.filter(
+        dish_id__in=dish_counts.keys()
+    ).values(
+        'ingredient_id', 'ingredient__name', 'ingredient__unit',
+    ).annotate(
+        total_quantity=Sum(F('quantity') * repeats, output_field=amount),
+        total_cost=Sum(F('quantity') * repeats * F('ingredient__price'), output_field=amount),
+    ).order_by('ingredient__name', 'ingredient__unit')
+
+    items = []
+    total = Decimal('0')
+    for row in rows:
+        cost = (row['total_cost'] * persons).quantize(Decimal('0.01'))
+        items.append({
+            'ingredient_id': row['ingredient_id'],
+            'name': row['ingredient__name'],
+            'unit': UNIT_NAMES.get(row['ingredient__unit'], row['ingredient__unit']),
+            'quantity': row['total_quantity'] * persons,
+            'cost': cost,
+        })
+        total += cost
+    return items, total
+
+
+def shopping_list_for_profile(profile, start_date, days=SHOPPING_LIST_DAYS):
+    return aggregate_ingredients(
+        week_dish_counts(profile, start_date, days),
+        persons=profile.count_of_persons,
+    )
+
+
+def _export_batch(profiles, day):
+    menus = defaultdict(list)
+    for profile_id, dish_id in DailyMenu.objects.filter(
+        profile__in=profiles, date=day
+    ).values_list('profile_id', 'dish_id'):
+        menus[profile_id].append(dish_id)
+    # Один снимок каталога на пачку, а не чтение версии на каждый профиль
+    catalog = get_catalog()
+    for profile in profiles:
+        if profile.pk not in menus:
+            menus[profile.pk] = [
+                dish_id
+                for dish_ids in rotated_selection(profile, day, catalog).values()
+                for dish_id in dish_ids
+            ]
+
+    recipes = defaultdict(list)
+    dish_ids = {dish_id for dish_ids in menus.values() for dish_id in dish_ids}
+    for row in DishIngredient.objects.filter(dish_id__in=dish_ids).values_list(
+        'dish_id', 'ingredient_id', 'ingredient__name', 'ingredient__unit',
+        'quantity', 'ingredient__price',
+    ):
+        recipes[row[0]].append(row[1:])
+
+    for profile in profiles:
+        totals = {}
+        for dish_id in menus[profile.pk]:
+            for ingredient_id, name, unit, quantity, price in recipes[dish_id]:
+                entry = totals.setdefault(
+                    ingredient_id, [name, unit, Decimal('0'), Decimal('0')]
+                )
+                entry[2] += quantity
+                entry[3] += quantity * price
+
+        persons = profile.count_of_persons
+        for ingredient_id, (name, unit, quantity, cost) in sorted(totals.items()):
+            yield {
+                'date': day.isoformat(),
+                'profile_id': profile.pk,
+                'username': profile.user.username,
+                'ingredient_id': ingredient_id,
+                'ingredient': name,
+                'unit': unit,
+                'quantity': str(quantity * persons),
+                'cost': str((cost * persons).quantize(Decimal('0.01'))),
+            }
+
+
+def export_shopping_rows(day, chunk_size=EXPORT_CHUNK_SIZE):
+    """Построчно отдаёт ингредиенты на день для всех активных подписчиков.
+
+    Профили читаются курсором пачками по ``chunk_size``, поэтому расход
+    памяти не зависит от числа подписчиков.
+    """
+    profiles = UserProfile.objects.filter(
+        subscription_end_date__gte=day,
+        diet_type__isnull=False,
+    ).select_related('user').only(*EXPORT_PROFILE_FIELDS).order_by('pk')
+
+    batch = []
+    for profile in profiles.iterator(chunk_size=chunk_size):
+        batch.append(profile)
+        if len(batch) == chunk_size:
+            yield from _export_batch(batch, day)
+            batch = []
+    if batch:
+        yield from _export_batch(batch, day)
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def render_export(rows, export_format):
+    """Превращает строки выгрузки в поток строк CSV или NDJSON."""
+    if export_format == 'ndjson':
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False) + '\n'
+        return
+
+    writer = csv.DictWriter(_Echo(), fieldnames=EXPORT_FIELDS)
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
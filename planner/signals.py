@@ -0,0 +1,180 @@
+from django.db.models import F
+from django.utils import timezone
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save,
+)
+from django.dispatch import receiver
+
+from .catalog import bump_catalog_version
+from .models import (
+    Allergy,
+    DailyMenu,
+    DietType,
+    Dish,
+    DishIngredient,
+    Ingredient,
+    UserProfile,
+)
+from .payments import clear_lookup_cache
+
+
+@receiver(pre_save, sender=DishIngredient)
+def remember_previous_dish(sender, instance, **kwargs):
+    instance._previous_dish_id = None
+    if instance.pk is not None:
+        instance._previous_dish_id = DishIngredient.objects.filter(
+            pk=instance.pk
+        ).values_list('dish_id', flat=True).first()
+
+
+@receiver(post_save, sender=DishIngredient)
+@receiver(post_delete, sender=DishIngredient)
+def refresh_dish_on_ingredient_row_change(sender, instance, **kwargs):
+    # Строку могли перенести в другое блюдо: старое тоже пересчитывается
+    dish_ids = {instance.dish_id, getattr(instance, '_previous_dish_id', None)} - {None}
+    dishes = Dish.objects.filter(pk__in=dish_ids)
+    dishes.refresh_cached_totals()
+    dishes.refresh_allergen_mask()
+    dishes.refresh_ingredient_lists()
+    dishes.drop_future_daily_menus()
+    bump_catalog_version()
+
+
+@receiver(pre_save, sender=Ingredient)
+def remember_ingredient_changes(sender, instance, **kwargs):
+    instance._totals_changed = False
+    instance._card_changed = False
+    if instance.pk is None:
+        return
+    old = Ingredient.objects.filter(pk=instance.pk).values(
+        'price', 'callories', 'name', 'unit'
+    ).first()
+    if old is None:
+        return
+    instance._totals_changed = (
+        old['price'] != instance.price
+        or old['callories'] != instance.callories
+    )
+    instance._card_changed = (
+        old['name'] != instance.name
+        or old['unit'] != instance.unit
+    )
+
+
+@receiver(post_save, sender=Ingredient)
+def refresh_dishes_on_ingredient_change(sender, instance, created, **kwargs):
+    if created:
+        return
+    dishes = Dish.objects.filter(dishingredient__ingredient=instance)
+    if getattr(instance, '_totals_changed', False):
+        dishes.refresh_cached_totals()
+        # Новая цена может не уложиться в бюджет подписчиков
+        dishes.drop_future_daily_menus()
+    if getattr(instance, '_card_changed', False):
+        dishes.refresh_ingredient_lists()
+
+
+@receiver(m2m_changed, sender=Ingredient.allergens.through)
+def refresh_dishes_on_allergens_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # Изменение со стороны аллергии: затронуты ингредиенты из pk_set
+        if action == 'pre_clear':
+            instance._cleared_ingredient_ids = list(
+                instance.ingredient_set.values_list('pk', flat=True)
+            )
+            return
+        if action == 'post_clear':
+            ingredient_ids = getattr(instance, '_cleared_ingredient_ids', [])
+        else:
+            ingredient_ids = pk_set
+    else:
+        ingredient_ids = [instance.pk]
+
+    if action not in ('post_add', 'post_remove', 'post_clear') or not ingredient_ids:
+        return
+    dishes = Dish.objects.filter(dishingredient__ingredient__in=ingredient_ids)
+    dishes.refresh_allergen_mask()
+    dishes.drop_future_daily_menus()
+    bump_catalog_version()
+
+
+@receiver(m2m_changed, sender=UserProfile.allergies.through)
+def refresh_profile_allergen_mask(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        if action == 'pre_clear':
+            instance._cleared_profile_ids = list(
+                instance.userprofile_set.values_list('pk', flat=True)
+            )
+            return
+        if action == 'post_clear':
+            profile_ids = getattr(instance, '_cleared_profile_ids', [])
+        else:
+            profile_ids = pk_set
+    else:
+        profile_ids = [instance.pk]
+
+    if action not in ('post_add', 'post_remove', 'post_clear') or not profile_ids:
+        return
+    UserProfile.objects.filter(pk__in=profile_ids).refresh_allergen_mask()
+    drop_future_daily_menus(profile_ids)
+    if not reverse:
+        instance.refresh_from_db(fields=['allergen_mask'])
+
+
+def drop_future_daily_menus(profile_ids):
+    DailyMenu.objects.filter(
+        profile_id__in=profile_ids,
+        date__gte=timezone.now().date(),
+    ).delete()
+
+
+@receiver(post_save, sender=Dish)
+@receiver(pre_delete, sender=Dish)
+def drop_daily_menus_on_dish_change(sender, instance, created=False, **kwargs):
+    # Блюдо могло сменить тип диеты или категорию; при удалении каскад
+    # убрал бы только его строки и оставил меню без приёма пищи
+    if not created:
+        Dish.objects.filter(pk=instance.pk).drop_future_daily_menus()
+
+
+@receiver(post_save, sender=UserProfile)
+def drop_daily_menus_on_profile_change(sender, instance, created, **kwargs):
+    # Сохранённое меню подбиралось под старые настройки профиля
+    if not created:
+        drop_future_daily_menus([instance.pk])
+
+
+@receiver(post_delete, sender=Allergy)
+def drop_deleted_allergy_bit(sender, instance, **kwargs):
+    if instance.bit is None:
+        return
+    for model in (Dish, UserProfile):
+        model.objects.alias(
+            has_bit=F('allergen_mask').bitand(instance.bit)
+        ).filter(has_bit=instance.bit).update(
+            allergen_mask=F('allergen_mask') - instance.bit
+        )
+
+
+@receiver(post_save, sender=Allergy)
+@receiver(post_delete, sender=Allergy)
+@receiver(post_save, sender=DietType)
+@receiver(post_delete, sender=DietType)
+def drop_activation_lookups(sender, created=False, **kwargs):
+    # Новые записи кеш подхватит сам, устаревают только изменённые и удалённые
+    if not created:
+        clear_lookup_cache()
+
+
+# Регистрируется последним, чтобы версия менялась после пересчёта блюд
+@receiver(post_save, sender=Dish)
+@receiver(post_delete, sender=Dish)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_delete, sender=Allergy)
+def bump_catalog_on_change(sender, **kwargs):
+    bump_catalog_version()
@@ -1,3 +1,1531 @@
-from django.test import TestCase
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal
+from http.client import HTTPConnection
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+from urllib.parse import urlsplit
 
-# Create your tests here.
+import openpyxl
+from yookassa import Configuration
+from yookassa.domain.response import PaymentResponse
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.db.models import F
+from django.db.utils import ConnectionHandler
+from django.template.loader import render_to_string
+from django.test import (
+    Client,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import catalog
+from .catalog import (
+    CATALOG_VERSION_ID,
+    MenuCatalog,
+    get_catalog,
+    get_catalog_version,
+)
+from .fragments import render_menu_section
+from .shopping import EXPORT_FIELDS, aggregate_ingredients, export_shopping_rows
+from .price_import import import_prices, read_price_rows
+from .catalog_import import CatalogImportError, load_catalog, read_catalog
+from .payments import (
+    ALLERGY_FIELDS,
+    activate_subscription,
+    clear_lookup_cache,
+    configure_provider,
+)
+from .webhooks import process_webhook_batch
+from .yookassa_stub import StubProvider
+from .meal_plan import MEAL_CALORIE_SHARES, build_meal_plan
+from .menu import (
+    menu_for_day,
+    rotated_selection,
+    select_daily_menu,
+)
+from .models import (
+    Allergy,
+    CatalogVersion,
+    SubscriptionOrder,
+    DailyMenu,
+    DietType,
+    Dish,
+    DishIngredient,
+    Ingredient,
+    UserProfile,
+    WebhookEvent,
+)
+
+
+class CatalogTestMixin:
+    """Версия каталога откатывается вместе с тестом, а снимок и кеш меню
+    живут в процессе, поэтому каждый тест начинает с пустых."""
+
+    def setUp(self):
+        catalog._catalog = None
+        cache.clear()
+        super().setUp()
+
+
+class DishCachedTotalsTest(TestCase):
+    def setUp(self):
+        self.diet = DietType.objects.create(name='Классическое')
+        self.egg = Ingredient.objects.create(
+            name='Яйцо', price=Decimal('10.00'), callories=Decimal('80.00'), unit='pcs'
+        )
+        self.milk = Ingredient.objects.create(
+            name='Молоко', price=Decimal('0.10'), callories=Decimal('0.60'), unit='ml'
+        )
+        self.omelette = Dish.objects.create(
+            name='Омлет', description='', diet_type=self.diet, category='breakfast'
+        )
+        self.pancakes = Dish.objects.create(
+            name='Блины', description='', diet_type=self.diet, category='breakfast'
+        )
+        DishIngredient.objects.create(dish=self.omelette, ingredient=self.egg, quantity=2)
+        DishIngredient.objects.create(dish=self.omelette, ingredient=self.milk, quantity=100)
+        DishIngredient.objects.create(dish=self.pancakes, ingredient=self.milk, quantity=200)
+
+    def test_totals_follow_dish_ingredient_changes(self):
+        self.omelette.refresh_from_db()
+        self.assertEqual(self.omelette.total_price, Decimal('30.00'))
+        self.assertEqual(self.omelette.total_calories, Decimal('220.00'))
+
+        self.omelette.dishingredient_set.get(ingredient=self.milk).delete()
+        self.omelette.refresh_from_db()
+        self.assertEqual(self.omelette.total_price, Decimal('20.00'))
+
+    def test_moved_row_refreshes_both_dishes(self):
+        nuts = Allergy.objects.create(name='Орехи')
+        self.egg.allergens.add(nuts)
+        row = self.omelette.dishingredient_set.get(ingredient=self.egg)
+
+        row.dish = self.pancakes
+        row.save()
+
+        self.omelette.refresh_from_db()
+        self.pancakes.refresh_from_db()
+        self.assertEqual(self.omelette.total_price, Decimal('10.00'))
+        self.assertEqual(self.omelette.allergen_mask, 0)
+        self.assertEqual([entry['name'] for entry in self.omelette.ingredient_list], ['Молоко'])
+        self.assertEqual(self.pancakes.total_price, Decimal('40.00'))
+        self.assertEqual(self.pancakes.allergen_mask, nuts.bit)
+
+    def test_ingredient_price_change_updates_only_affected_dishes(self):
+        Dish.objects.filter(pk=self.pancakes.pk).update(cached_price=0)
+        self.egg.price = Decimal('15.00')
+        self.egg.save()
+
+        self.omelette.refresh_from_db()
+        self.pancakes.refresh_from_db()
+        self.assertEqual(self.omelette.total_price, Decimal('40.00'))
+        self.assertEqual(self.pancakes.total_price, Decimal('0.00'))
+
+    def test_rebuild_command_restores_all_totals(self):
+        Dish.objects.update(cached_price=0, cached_calories=0)
+        call_command('rebuild_dish_totals', stdout=StringIO())
+
+        self.pancakes.refresh_from_db()
+        self.assertEqual(self.pancakes.total_price, Decimal('20.00'))
+        self.assertEqual(self.pancakes.total_calories, Decimal('120.00'))
+
+
+class MenuSelectionTest(CatalogTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.diet = DietType.objects.create(name='Классическое')
+        self.fish_allergy = Allergy.objects.create(name='Рыба и морепродукты')
+        salmon = Ingredient.objects.create(
+            name='Лосось', price=Decimal('2.00'), callories=Decimal('2.00')
+        )
+        salmon.allergens.add(self.fish_allergy)
+        oats = Ingredient.objects.create(
+            name='Овсянка', price=Decimal('0.50'), callories=Decimal('3.50')
+        )
+
+        self.porridge = self._dish('Каша', 'breakfast', oats, 100)
+        self.cheap_porridge = self._dish('Каша на воде', 'breakfast', oats, 40)
+        self.fish_lunch = self._dish('Лосось на пару', 'lunch', salmon, 150)
+        self.soup = self._dish('Суп', 'lunch', oats, 60)
+        self._dish('Сырники', 'dessert', oats, 10)
+
+        user = User.objects.create_user('eater', password='secret')
+        self.profile = UserProfile.objects.create(
+            user=user, diet_type=self.diet, count_of_persons=2
+        )
+
+    def _dish(self, name, category, ingredient, quantity):
+        dish = Dish.objects.create(
+            name=name, description='', diet_type=self.diet, category=category
+        )
+        DishIngredient.objects.create(dish=dish, ingredient=ingredient, quantity=quantity)
+        return dish
+
+    def test_daily_menu_respects_allergies_and_budget(self):
+        self.profile.allergies.add(self.fish_allergy)
+        self.profile.budget_limit = Decimal('90')
+
+        menu = select_daily_menu(self.profile, date(2030, 1, 1))
+
+        self.assertEqual(set(menu), {'breakfast', 'lunch', 'dinner'})
+        self.assertEqual(menu['breakfast'], [self.cheap_porridge])
+        self.assertEqual(menu['lunch'], [self.soup])
+        self.assertEqual(menu['dinner'], [])
+
+    def test_daily_menu_cards_are_scaled_by_persons(self):
+        menu = select_daily_menu(self.profile, date(2030, 1, 1))
+
+        dish = menu['breakfast'][0]
+        self.assertIn(dish, [self.porridge, self.cheap_porridge])
+        self.assertEqual(dish.adjusted_price, dish.cached_price * 2)
+        self.assertEqual(dish.adjusted_calories, dish.cached_calories * 2)
+        self.assertTrue({'recipe', 'photo'} <= dish.get_deferred_fields())
+
+    def test_catalog_is_reused_until_catalog_changes(self):
+        get_catalog()
+        # Только чтение версии каталога
+        with self.assertNumQueries(1):
+            snapshot = get_catalog()
+            snapshot.select(self.diet.pk, ['breakfast'], persons=2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self._dish('Гранола', 'breakfast', Ingredient.objects.first(), 1)
+        self.assertIsNot(get_catalog(), snapshot)
+        self.assertEqual(len(get_catalog()), len(snapshot) + 1)
+
+    def test_catalog_version_is_bumped_after_commit(self):
+        version = get_catalog_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.soup.name = 'Суп-пюре'
+            self.soup.save()
+            self.assertEqual(get_catalog_version(), version)
+        self.assertGreater(get_catalog_version(), version)
+
+    def test_materialized_menu_is_read_with_one_query(self):
+        day = date(2030, 1, 1)
+        UserProfile.objects.filter(pk=self.profile.pk).update(subscription_end_date=day)
+        call_command('materialize_daily_menus', date='2030-01-01', stdout=StringIO())
+
+        rows = DailyMenu.objects.filter(profile=self.profile, date=day)
+        self.assertEqual(
+            {row.category: [row.dish_id] for row in rows},
+            {
+                category: dish_ids
+                for category, dish_ids in rotated_selection(self.profile, day).items()
+                if dish_ids
+            },
+        )
+        with self.assertNumQueries(1):
+            menu = menu_for_day(self.profile, day)
+        self.assertEqual(
+            menu['breakfast'][0].adjusted_price, rows.get(category='breakfast').price
+        )
+        self.assertEqual(menu['dinner'], [])
+
+        self.profile.dessert = True
+        self.profile.save()
+        self.assertFalse(DailyMenu.objects.filter(profile=self.profile).exists())
+
+    def materialize(self, day):
+        UserProfile.objects.filter(pk=self.profile.pk).update(subscription_end_date=day)
+        call_command('materialize_daily_menus', date=day.isoformat(), stdout=StringIO())
+        return menu_for_day(self.profile, day)
+
+    def test_catalog_allergen_change_drops_materialized_menu(self):
+        nuts = Allergy.objects.create(name='Орехи')
+        self.profile.allergies.add(nuts)
+        day = date(2030, 1, 1)
+        breakfast = self.materialize(day)['breakfast'][0]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            breakfast.dishingredient_set.get().ingredient.allergens.add(nuts)
+
+        self.assertFalse(DailyMenu.objects.filter(profile=self.profile).exists())
+        self.assertEqual(menu_for_day(self.profile, day)['breakfast'], [])
+
+    def test_dish_moved_to_other_diet_drops_materialized_menu(self):
+        day = date(2030, 1, 1)
+        lunch = self.materialize(day)['lunch'][0]
+
+        lunch.diet_type = DietType.objects.create(name='Кето')
+        with self.captureOnCommitCallbacks(execute=True):
+            lunch.save()
+
+        self.assertFalse(DailyMenu.objects.filter(profile=self.profile).exists())
+        self.assertNotIn(lunch, menu_for_day(self.profile, day)['lunch'])
+
+    def test_rotation_is_stable_within_a_day_and_changes_across_days(self):
+        day = date(2030, 1, 1)
+        self.assertEqual(
+            rotated_selection(self.profile, day), rotated_selection(self.profile, day)
+        )
+
+        breakfasts = {
+            rotated_selection(self.profile, date(2030, 1, number))['breakfast'][0]
+            for number in range(1, 15)
+        }
+        self.assertEqual(breakfasts, {self.porridge.pk, self.cheap_porridge.pk})
+
+    def test_daily_menu_is_served_from_cache_after_warm_up(self):
+        day = date(2030, 1, 1)
+        menu = select_daily_menu(self.profile, day)
+
+        # Только чтение версии каталога
+        with self.assertNumQueries(1):
+            with mock.patch.object(MenuCatalog, 'select') as select:
+                self.assertEqual(select_daily_menu(self.profile, day), menu)
+        select.assert_not_called()
+
+
+class AllergenMaskTest(TestCase):
+    def setUp(self):
+        self.fish = Allergy.objects.create(name='Рыба и морепродукты')
+        self.nuts = Allergy.objects.create(name='Орехи и бобовые')
+        self.salmon = Ingredient.objects.create(
+            name='Лосось', price=Decimal('2.00'), callories=Decimal('2.00')
+        )
+        self.dish = Dish.objects.create(name='Лосось на пару', description='')
+        DishIngredient.objects.create(dish=self.dish, ingredient=self.salmon, quantity=100)
+
+    def test_allergies_get_distinct_bits(self):
+        self.assertEqual({self.fish.bit, self.nuts.bit}, {1, 2})
+
+    def test_dish_mask_follows_ingredient_allergens(self):
+        self.salmon.allergens.add(self.fish, self.nuts)
+        self.dish.refresh_from_db()
+        self.assertEqual(self.dish.allergen_mask, self.fish.bit | self.nuts.bit)
+
+        self.nuts.ingredient_set.clear()
+        self.dish.refresh_from_db()
+        self.assertEqual(self.dish.allergen_mask, self.fish.bit)
+
+        self.fish.delete()
+        self.dish.refresh_from_db()
+        self.assertEqual(self.dish.allergen_mask, 0)
+
+    def test_profile_mask_follows_allergies(self):
+        user = User.objects.create_user('eater', password='secret')
+        profile = UserProfile.objects.create(user=user)
+
+        profile.allergies.add(self.fish, self.nuts)
+        self.assertEqual(profile.allergen_mask, self.fish.bit | self.nuts.bit)
+
+        profile.allergies.remove(self.nuts)
+        self.assertEqual(profile.allergen_mask, self.fish.bit)
+
+
+class MealPlanTest(SimpleTestCase):
+    def setUp(self):
+        rows = []
+        for category, base_calories in (('breakfast', 500), ('lunch', 700)):
+            for offset in range(10):
+                dish_id = len(rows) + 1
+                rows.append((dish_id, category, 1, 0, 100 + 10 * offset, base_calories + offset))
+        rows.append((len(rows) + 1, 'lunch', 1, 0b1, 50, 700))
+        self.catalog = MenuCatalog(version=0, rows=rows)
+
+    def test_plan_avoids_repeats_and_allergens_within_budget(self):
+        plan = build_meal_plan(
+            self.catalog, 1, ['breakfast', 'lunch'], 14,
+            allergen_mask=0b1, persons=2, daily_budget=Decimal('600'),
+            repeat_window=5,
+        )
+
+        self.assertEqual(len(plan), 14)
+        self.assertNotIn(21, [day['meals']['lunch'] for day in plan])
+        for day in plan:
+            self.assertTrue(day['within_budget'])
+            self.assertLessEqual(day['price'], Decimal('600'))
+        for start in range(len(plan) - 4):
+            window = plan[start:start + 5]
+            lunches = [day['meals']['lunch'] for day in window]
+            self.assertEqual(len(set(lunches)), len(lunches))
+
+    def test_plan_hits_calorie_target_within_budget(self):
+        # Блюда точно в норму калорий дороже бюджета, остальные близко к ней
+        rows = []
+        for category, target in (('breakfast', 500), ('lunch', 700)):
+            for offset in range(-20, 21, 5):
+                rows.append((len(rows) + 1, category, 1, 0, 100, target + offset))
+            rows.append((len(rows) + 1, category, 1, 0, 1000, target))
+        expensive = {dish_id for dish_id, *_, price, _ in rows if price == 1000}
+        catalog = MenuCatalog(version=0, rows=rows)
+
+        plan = build_meal_plan(
+            catalog, 1, ['breakfast', 'lunch'], 14,
+            persons=2, daily_budget=Decimal('400'), calorie_target=2000,
+            repeat_window=3,
+        )
+
+        day_target = 2000 * (MEAL_CALORIE_SHARES['breakfast'] + MEAL_CALORIE_SHARES['lunch'])
+        for day in plan:
+            self.assertTrue(day['within_budget'])
+            self.assertLessEqual(day['price'], Decimal('400'))
+            self.assertFalse(expensive & set(day['meals'].values()))
+            self.assertLessEqual(abs(day['calories'] - day_target), day_target * 0.02)
+
+
+class MealPlanViewTest(CatalogTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        diet = DietType.objects.create(name='Классическое')
+        oats = Ingredient.objects.create(
+            name='Овсянка', price=Decimal('0.50'), callories=Decimal('3.50')
+        )
+        for name, category in (('Каша', 'breakfast'), ('Суп', 'lunch')):
+            dish = Dish.objects.create(
+                name=name, description='', diet_type=diet, category=category
+            )
+            DishIngredient.objects.create(dish=dish, ingredient=oats, quantity=150)
+
+        user = User.objects.create_user('eater', password='secret')
+        UserProfile.objects.create(
+            user=user, diet_type=diet, dinner=False,
+            subscription_end_date=date.today() + timedelta(days=30),
+        )
+        self.client.force_login(user)
+
+    def test_cabinet_shows_week_plan(self):
+        response = self.client.get(reverse('meal_plan'))
+
+        days = response.context['days']
+        self.assertEqual(len(days), 7)
+        self.assertEqual(
+            [(title, dish.name) for title, dish in days[0]['meals']],
+            [('Завтрак', 'Каша'), ('Обед', 'Суп')],
+        )
+        self.assertContains(response, 'Каша', count=7)
+
+
+class MenuFragmentCacheTest(CatalogTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        diet = DietType.objects.create(name='Кето')
+        butter = Ingredient.objects.create(
+            name='Масло', price=Decimal('1.00'), callories=Decimal('7.00')
+        )
+        for category in ('breakfast', 'lunch', 'dinner'):
+            dish = Dish.objects.create(
+                name=f'Блюдо {category}', description='', diet_type=diet, category=category
+            )
+            DishIngredient.objects.create(dish=dish, ingredient=butter, quantity=50)
+
+        self.profiles = []
+        for username in ('first', 'second'):
+            user = User.objects.create_user(username, password='secret')
+            self.profiles.append(UserProfile.objects.create(
+                user=user, diet_type=diet, subscription_end_date=date(2100, 1, 1)
+            ))
+
+    def test_subscribers_with_same_plan_share_one_render(self):
+        with mock.patch(
+            'planner.fragments.render_to_string', wraps=render_to_string
+        ) as render:
+            for profile in self.profiles:
+                response = self.client_for(profile).get(reverse('lk'))
+                self.assertContains(response, 'Блюдо lunch')
+
+        self.assertEqual(render.call_count, 1)
+
+    def test_catalog_change_invalidates_fragment(self):
+        profile = self.profiles[0]
+        menu = {'lunch': list(Dish.objects.filter(category='lunch'))}
+        render_menu_section(profile, menu)
+
+        Dish.objects.filter(category='lunch').update(name='Новое имя')
+        with self.captureOnCommitCallbacks(execute=True):
+            Dish.objects.get(category='dinner').save()
+        menu = {'lunch': list(Dish.objects.filter(category='lunch'))}
+        self.assertIn('Новое имя', render_menu_section(profile, menu))
+
+    def client_for(self, profile):
+        client = Client()
+        client.force_login(profile.user)
+        return client
+
+
+class DishCardTest(CatalogTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.diet = DietType.objects.create(name='Классическое')
+        self.flour = Ingredient.objects.create(
+            name='Мука', price=Decimal('0.05'), callories=Decimal('3.40')
+        )
+        self.dish = Dish.objects.create(
+            name='Блины', description='', diet_type=self.diet,
+            category='breakfast', recipe='Смешать.\nЖарить.',
+        )
+        DishIngredient.objects.create(dish=self.dish, ingredient=self.flour, quantity=150)
+
+    def test_card_fields_are_precomputed(self):
+        self.dish.refresh_from_db()
+        self.assertEqual(self.dish.recipe_paragraphs, ['Смешать.', 'Жарить.'])
+        self.assertEqual(
+            self.dish.ingredient_list,
+            [{'name': 'Мука', 'quantity': '150.00', 'unit': 'Граммы'}],
+        )
+
+        self.flour.name = 'Мука пшеничная'
+        self.flour.save()
+        self.dish.refresh_from_db()
+        self.assertEqual(self.dish.ingredient_list[0]['name'], 'Мука пшеничная')
+
+    def test_anonymous_card_renders_with_one_query(self):
+        url = reverse('card', args=[self.dish.pk])
+        self.client.get(url)
+
+        # Блюдо и версия каталога в ключе кеша ингредиентов
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertContains(response, 'Мука (150 Граммы)')
+        self.assertContains(response, '<p>Жарить.</p>', html=True)
+
+    def test_card_scales_ingredients_for_profile(self):
+        user = User.objects.create_user('eater', password='secret')
+        UserProfile.objects.create(user=user, count_of_persons=3)
+        self.client.force_login(user)
+
+        response = self.client.get(reverse('card', args=[self.dish.pk]))
+        self.assertContains(response, 'Мука (450 Граммы)')
+
+
+class ShoppingListTest(CatalogTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.diet = DietType.objects.create(name='Классическое')
+        self.egg = Ingredient.objects.create(
+            name='Яйцо', price=Decimal('10.00'), callories=Decimal('80.00'), unit='pcs'
+        )
+        self.milk = Ingredient.objects.create(
+            name='Молоко', price=Decimal('0.10'), callories=Decimal('0.60'), unit='ml'
+        )
+        self.dishes = []
+        for number in range(10):
+            dish = Dish.objects.create(
+                name=f'Омлет {number}', description='', diet_type=self.diet, category='breakfast'
+            )
+            DishIngredient.objects.create(dish=dish, ingredient=self.egg, quantity=2)
+            DishIngredient.objects.create(dish=dish, ingredient=self.milk, quantity=50)
+            self.dishes.append(dish)
+
+    def test_aggregation_is_one_query_for_any_number_of_dishes(self):
+        dish_counts = {dish.pk: 1 for dish in self.dishes}
+        dish_counts[self.dishes[0].pk] = 3
+
+        with self.assertNumQueries(1):
+            items, total = aggregate_ingredients(dish_counts, persons=2)
+
+        by_name = {item['name']: item for item in items}
+        self.assertEqual(by_name['Яйцо']['quantity'], Decimal('48'))
+        self.assertEqual(by_name['Яйцо']['unit'], 'Штуки')
+        self.assertEqual(by_name['Молоко']['quantity'], Decimal('1200'))
+        self.assertEqual(total, Decimal('600.00'))
+
+    def test_shopping_list_page(self):
+        user = User.objects.create_user('eater', password='secret')
+        UserProfile.objects.create(
+            user=user, diet_type=self.diet, subscription_end_date=date(2100, 1, 1),
+            lunch=False, dinner=False,
+        )
+        self.client.force_login(user)
+        self.client.get(reverse('shopping_list'))
+
+        # Сессия, пользователь, профиль, сохранённые меню, версия каталога
+        # и один GROUP BY: число запросов не зависит от дней в неделе
+        with self.assertNumQueries(6):
+            response = self.client.get(reverse('shopping_list'))
+        self.assertContains(response, 'Яйцо')
+        self.assertContains(response, '14 Штуки')
+
+    def test_export_streams_rows_for_active_subscribers(self):
+        day = date(2030, 1, 1)
+        for number in range(3):
+            user = User.objects.create_user(f'eater{number}', password='secret')
+            UserProfile.objects.create(
+                user=user, diet_type=self.diet, subscription_end_date=day,
+                lunch=False, dinner=False, count_of_persons=number + 1,
+            )
+        admin = User.objects.create_user('admin', password='secret', is_staff=True)
+        self.client.force_login(admin)
+
+        response = self.client.get(
+            reverse('export_shopping_lists'), {'date': '2030-01-01', 'format': 'ndjson'}
+        )
+        content = b''.join(response.streaming_content)
+        rows = [json.loads(line) for line in content.splitlines()]
+
+        self.assertEqual(len(rows), 6)
+        eggs = {
+            row['username']: row['quantity']
+            for row in rows if row['ingredient'] == 'Яйцо'
+        }
+        self.assertEqual(eggs, {'eater0': '2.00', 'eater1': '4.00', 'eater2': '6.00'})
+
+    def add_subscribers(self, count, day):
+        for _ in range(count):
+            user = User.objects.create_user(f'eater{User.objects.count()}')
+            UserProfile.objects.create(
+                user=user, diet_type=self.diet, subscription_end_date=day,
+                lunch=False, dinner=False,
+            )
+
+    def test_export_query_count_does_not_grow_with_subscribers(self):
+        day = date(2030, 1, 1)
+        self.add_subscribers(3, day)
+        # Первая выгрузка загружает снимок каталога
+        list(export_shopping_rows(day))
+        with CaptureQueriesContext(connection) as before:
+            list(export_shopping_rows(day))
+
+        self.add_subscribers(20, day)
+        with CaptureQueriesContext(connection) as after:
+            rows = list(export_shopping_rows(day))
+
+        self.assertEqual(len(rows), 46)
+        self.assertEqual(len(after), len(before))
+
+    def test_export_command_writes_csv(self):
+        user = User.objects.create_user('eater', password='secret')
+        UserProfile.objects.create(
+            user=user, diet_type=self.diet, subscription_end_date=date(2030, 1, 1),
+        )
+        out = StringIO()
+        call_command(
+            'export_shopping_lists', date='2030-01-01', chunk_size=1, stdout=out
+        )
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], ','.join(EXPORT_FIELDS))
+        self.assertEqual(len(lines), 3)
+
+
+CHECKOUT_FORM = {
+    'foodtype': 'keto',
+    'select1': '0',
+    'select2': '0',
+    'select3': '1',
+    'select4': '1',
+    'select5': '1',
+    'duration': '0',
+    'allergy2': '1',
+}
+
+
+class StubProviderMixin:
+    def setUp(self):
+        cache.clear()
+        clear_lookup_cache()
+        self.provider = StubProvider().start()
+        self.addCleanup(self.provider.stop)
+        patcher = mock.patch.multiple(
+            Configuration, api_url=self.provider.api_url, account_id='stub', secret_key='stub'
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user('payer', password='secret')
+        self.profile = UserProfile.objects.create(user=self.user)
+
+
+class StubProviderTestCase(StubProviderMixin, TestCase):
+    pass
+
+
+class AsyncCheckoutTest(StubProviderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.async_client.force_login(self.user)
+
+    async def test_async_checkout_creates_payment_and_activates_subscription(self):
+        response = await self.async_client.post(
+            reverse('create_payment_async'), CHECKOUT_FORM
+        )
+
+        order = await SubscriptionOrder.objects.aget(user=self.user)
+        self.assertEqual(order.amount, 2400)
+        self.assertEqual(
+            response['Location'],
+            f'{self.provider.base_url}/confirm/{order.payment_id}',
+        )
+
+        self.provider.set_status(order.payment_id, 'succeeded')
+        response = await self.async_client.get(
+            reverse('payment_success_async'), {'order_id': order.id}
+        )
+
+        self.assertEqual(response['Location'], reverse('lk'))
+        await order.arefresh_from_db()
+        self.assertEqual(order.status, 'paid')
+        await self.profile.arefresh_from_db()
+        self.assertEqual(self.profile.count_of_persons, 2)
+
+    @override_settings(YOOKASSA_CONNECT_TIMEOUT=0.1, YOOKASSA_TIMEOUT=0.1)
+    async def test_async_checkout_timeout_keeps_order_pending(self):
+        self.provider.latency = 0.5
+
+        response = await self.async_client.post(
+            reverse('create_payment_async'), CHECKOUT_FORM
+        )
+
+        self.assertEqual(response['Location'], reverse('order'))
+        order = await SubscriptionOrder.objects.aget(user=self.user)
+        self.assertEqual(order.status, 'pending')
+
+
+class WebhookTestCase(StubProviderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.payment = self.provider.create({'amount': {'value': '2400.00', 'currency': 'RUB'}})
+        self.order = SubscriptionOrder.objects.create(
+            user=self.user,
+            amount=2400,
+            description='Подписка',
+            payment_id=self.payment['id'],
+            subscription_params={'foodtype': 'veg', 'select1': '0', 'duration_days': 30},
+        )
+
+    def notify(self, ip='127.0.0.1', **extra):
+        return self.client.post(
+            reverse('yookassa_webhook'),
+            json.dumps(self.provider.notification(self.payment['id'], 'payment.succeeded')),
+            content_type='application/json',
+            REMOTE_ADDR=ip,
+            **extra,
+        )
+
+
+class WebhookInboxTest(WebhookTestCase):
+
+    def test_webhook_only_stores_event(self):
+        with self.assertNumQueries(1):
+            response = self.notify()
+
+        self.assertEqual(response.status_code, 200)
+        event = WebhookEvent.objects.get()
+        self.assertEqual(event.payment_id, self.payment['id'])
+        self.assertEqual(event.event, 'payment.succeeded')
+        self.assertEqual(self.provider.requests['find'], 0)
+
+    def test_invalid_body_is_rejected(self):
+        response = self.client.post(
+            reverse('yookassa_webhook'), 'not json', content_type='application/json'
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_worker_deduplicates_events_and_activates_subscription(self):
+        self.provider.set_status(self.payment['id'], 'succeeded')
+        for _ in range(3):
+            self.notify()
+
+        stats = process_webhook_batch(batch_size=2)
+
+        self.assertEqual(stats['processed'], 3)
+        self.assertEqual(self.provider.requests['find'], 1)
+        self.assertFalse(WebhookEvent.objects.exclude(status='processed').exists())
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'paid')
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.diet_type.name, 'Вегетарианское')
+
+    def test_provider_error_is_retried_with_backoff(self):
+        self.notify()
+
+        with mock.patch(
+            'planner.webhooks.find_provider_payment', side_effect=ConnectionError('timeout')
+        ):
+            stats = process_webhook_batch(max_attempts=2)
+        self.assertEqual(stats['retried'], 1)
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.status, event.attempts), ('new', 1))
+        self.assertEqual(event.last_error, 'timeout')
+        self.assertFalse(process_webhook_batch())
+
+        WebhookEvent.objects.update(next_attempt_at=event.received_at)
+        with mock.patch(
+            'planner.webhooks.find_provider_payment', side_effect=ConnectionError('timeout')
+        ):
+            stats = process_webhook_batch(max_attempts=2)
+        self.assertEqual(stats['failed'], 1)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'pending')
+
+
+@override_settings(YOOKASSA_WEBHOOK_VERIFICATION='ip')
+class TrustedWebhookTest(WebhookTestCase):
+    trusted_ip = '185.71.76.10'
+
+    def test_trusted_event_is_applied_without_api_call(self):
+        self.provider.set_status(self.payment['id'], 'succeeded')
+        self.notify(self.trusted_ip)
+
+        stats = process_webhook_batch()
+
+        self.assertTrue(WebhookEvent.objects.get().verified)
+        self.assertEqual((stats['processed'], stats['api_calls']), (1, 0))
+        self.assertEqual(self.provider.requests['find'], 0)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'paid')
+        self.assertEqual(self.order.payment_data['amount'], '2400.00')
+
+    def test_forwarded_address_is_taken_from_proxy(self):
+        with self.settings(YOOKASSA_WEBHOOK_IP_HEADER='HTTP_X_FORWARDED_FOR'):
+            self.notify(HTTP_X_FORWARDED_FOR=f'{self.trusted_ip}, 10.0.0.1')
+            self.notify(HTTP_X_FORWARDED_FOR=f'10.0.0.1, {self.trusted_ip}')
+
+        self.assertEqual(
+            list(WebhookEvent.objects.order_by('id').values_list('verified', flat=True)),
+            [False, True],
+        )
+
+    def test_unverified_or_ambiguous_events_fall_back_to_api(self):
+        self.provider.set_status(self.payment['id'], 'succeeded')
+        self.notify('203.0.113.5')
+        process_webhook_batch()
+        self.assertEqual(self.provider.requests['find'], 1)
+
+        self.order.status = 'pending'
+        self.order.amount = 999
+        self.order.save()
+        self.notify(self.trusted_ip)
+        stats = process_webhook_batch()
+        self.assertEqual(stats['api_calls'], 1)
+        self.assertEqual(self.provider.requests['find'], 2)
+
+    @override_settings(YOOKASSA_WEBHOOK_API_FALLBACK=False)
+    def test_untrusted_source_is_rejected_without_fallback(self):
+        response = self.notify('203.0.113.5')
+
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+
+class ReconcilePaymentsTest(StubProviderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.orders = {}
+        for status in ['succeeded', 'canceled', 'pending']:
+            payment = self.provider.create({'amount': {'value': '1200.00', 'currency': 'RUB'}})
+            self.provider.set_status(payment['id'], status)
+            self.orders[status] = SubscriptionOrder.objects.create(
+                user=self.user,
+                amount=1200,
+                description='Подписка',
+                payment_id=payment['id'],
+                subscription_params={'foodtype': 'low', 'duration_days': 30},
+            )
+        self.orders['unknown'] = SubscriptionOrder.objects.create(
+            user=self.user, amount=1200, description='Подписка', payment_id='missing',
+        )
+
+    def reconcile(self, *args):
+        out = StringIO()
+        call_command(
+            'reconcile_payments', '--min-age', '0', '--batch-size', '2', *args, stdout=out
+        )
+        return out.getvalue()
+
+    def assert_reconciled(self, output):
+        statuses = {
+            key: SubscriptionOrder.objects.get(pk=order.pk).status
+            for key, order in self.orders.items()
+        }
+        self.assertEqual(statuses, {
+            'succeeded': 'paid',
+            'canceled': 'failed',
+            'pending': 'pending',
+            'unknown': 'pending',
+        })
+        self.assertIn('Проверено заказов: 4', output)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.diet_type.name, 'Низкоуглеводное')
+
+    def test_statuses_are_fetched_by_worker_pool(self):
+        output = self.reconcile('--workers', '4')
+
+        self.assert_reconciled(output)
+        self.assertEqual(self.provider.requests['find'], 4)
+
+    def test_statuses_are_taken_from_payment_list(self):
+        output = self.reconcile('--use-list')
+
+        self.assert_reconciled(output)
+        self.assertEqual(self.provider.requests['find'], 0)
+        self.assertEqual(self.provider.requests['list'], 2)
+
+    def test_order_without_provider_payment_is_failed(self):
+        order = SubscriptionOrder.objects.create(
+            user=self.user, amount=1200, description='Подписка',
+        )
+
+        output = self.reconcile()
+
+        self.assertEqual(SubscriptionOrder.objects.get(pk=order.pk).status, 'failed')
+        self.assertIn('Найдено платежей после таймаута: 0', output)
+
+
+class ActivateSubscriptionTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('subscriber')
+        self.profile = UserProfile.objects.create(user=self.user)
+        self.payment = PaymentResponse({
+            'id': 'payment-1',
+            'status': 'succeeded',
+            'paid': True,
+            'amount': {'value': '1200.00', 'currency': 'RUB'},
+        })
+        DietType.objects.create(name='Вегетарианское')
+        for name in ALLERGY_FIELDS.values():
+            Allergy.objects.create(name=name)
+        clear_lookup_cache()
+
+    def make_order(self, **params):
+        order = SubscriptionOrder.objects.create(
+            user=self.user,
+            amount=1200,
+            description='Подписка',
+            subscription_params={'foodtype': 'veg', 'select1': '0', 'duration_days': 30, **params},
+        )
+        return SubscriptionOrder.objects.select_related('user__userprofile').get(pk=order.pk)
+
+    def test_activation_uses_cached_lookups(self):
+        self.assertTrue(activate_subscription(self.make_order(allergy1='1'), self.payment))
+
+        order = self.make_order(allergy2='1', allergy6='1')
+        with self.assertNumQueries(7):
+            self.assertTrue(activate_subscription(order, self.payment))
+
+        self.profile.refresh_from_db()
+        self.assertEqual(
+            set(self.profile.allergies.values_list('name', flat=True)),
+            {'Мясо', 'Молочные продукты'},
+        )
+        expected_mask = self.profile.allergen_mask
+        UserProfile.objects.filter(pk=self.profile.pk).refresh_allergen_mask()
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.allergen_mask, expected_mask)
+        self.assertEqual(self.profile.diet_type.name, 'Вегетарианское')
+
+    def test_failed_activation_leaves_profile_untouched(self):
+        order = self.make_order(allergy3='1')
+
+        with mock.patch.object(SubscriptionOrder, 'save', side_effect=RuntimeError('db down')):
+            self.assertFalse(activate_subscription(order, self.payment))
+
+        self.profile.refresh_from_db()
+        self.assertIsNone(self.profile.diet_type)
+        self.assertFalse(self.profile.allergies.exists())
+        self.assertEqual(self.profile.allergen_mask, 0)
+        self.assertEqual(SubscriptionOrder.objects.get(pk=order.pk).status, 'pending')
+
+    def test_deleted_allergy_is_not_served_from_cache(self):
+        self.assertTrue(activate_subscription(self.make_order(allergy1='1'), self.payment))
+        Allergy.objects.filter(name='Рыба и морепродукты').delete()
+
+        self.assertTrue(activate_subscription(self.make_order(allergy1='1'), self.payment))
+        self.assertTrue(self.profile.allergies.filter(name='Рыба и морепродукты').exists())
+
+
+class IdempotentCheckoutTest(StubProviderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def checkout(self, **form):
+        return self.client.post(reverse('create_payment'), {**CHECKOUT_FORM, **form})
+
+    def test_double_submit_reuses_pending_order(self):
+        first = self.checkout()
+        cache.clear()
+        second = self.checkout()
+
+        self.assertEqual(first['Location'], second['Location'])
+        self.assertEqual(SubscriptionOrder.objects.count(), 1)
+        self.assertEqual(self.provider.requests['create'], 1)
+
+        self.checkout(select5='2')
+        self.assertEqual(SubscriptionOrder.objects.count(), 2)
+
+    def test_paid_order_is_not_reused(self):
+        first = self.checkout()
+        order = SubscriptionOrder.objects.get()
+        self.provider.set_status(order.payment_id, 'succeeded')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('payment_success'), {'order_id': order.id})
+
+        second = self.checkout()
+
+        self.assertNotEqual(first['Location'], second['Location'])
+        self.assertEqual(self.provider.requests['create'], 2)
+
+
+class ConcurrentCheckoutTest(StubProviderMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.provider.latency = 0.2
+
+    def checkout(self):
+        try:
+            client = Client()
+            client.force_login(self.user)
+            return client.post(reverse('create_payment'), CHECKOUT_FORM)['Location']
+        finally:
+            connection.close()
+
+    def test_parallel_submits_create_one_payment(self):
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            locations = list(pool.map(lambda _: self.checkout(), range(6)))
+
+        order = SubscriptionOrder.objects.get()
+        self.assertEqual(set(locations), {order.confirmation_url})
+        self.assertEqual(self.provider.requests['create'], 1)
+
+
+class FakeProviderTest(StubProviderTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def test_confirmation_page_pays_and_sends_webhook(self):
+        notifications = []
+        self.provider.webhook = notifications.append
+        self.client.post(reverse('create_payment'), CHECKOUT_FORM)
+        order = SubscriptionOrder.objects.get()
+
+        url = urlsplit(order.confirmation_url)
+        client = HTTPConnection(url.hostname, url.port)
+        client.request('GET', url.path)
+        response = client.getresponse()
+        client.close()
+
+        self.assertEqual(response.status, 302)
+        self.assertTrue(response.getheader('Location').endswith(f'?order_id={order.id}'))
+        self.assertEqual(notifications[0]['event'], 'payment.succeeded')
+        self.assertEqual(notifications[0]['object']['id'], order.payment_id)
+
+    @override_settings(YOOKASSA_TIMEOUT=0.2)
+    def test_provider_timeout_leaves_order_for_reconciliation(self):
+        self.provider.latency = 0.5
+
+        response = self.client.post(reverse('create_payment'), CHECKOUT_FORM)
+
+        self.assertEqual(response['Location'], reverse('order'))
+        order = SubscriptionOrder.objects.get()
+        self.assertEqual(order.status, 'pending')
+        self.assertIsNone(order.payment_id)
+
+        # Заглушка создаёт платёж уже после того, как клиент перестал ждать
+        deadline = time.monotonic() + 5
+        while not self.provider.payments and time.monotonic() < deadline:
+            time.sleep(0.05)
+        (payment_id,) = self.provider.payments
+        self.provider.set_status(payment_id, 'succeeded')
+        self.provider.latency = 0
+
+        call_command('reconcile_payments', '--min-age', '0', stdout=StringIO())
+        order.refresh_from_db()
+        self.assertEqual(order.payment_id, payment_id)
+        self.assertEqual(order.status, 'paid')
+
+    @override_settings(YOOKASSA_TIMEOUT=0.2)
+    def test_retry_after_timeout_does_not_wait_for_confirmation(self):
+        self.provider.latency = 0.5
+        self.client.post(reverse('create_payment'), CHECKOUT_FORM)
+        # Запрос, создавший заказ, уже завершился по таймауту
+        SubscriptionOrder.objects.update(created_at=F('created_at') - timedelta(minutes=1))
+        deadline = time.monotonic() + 5
+        while not self.provider.payments and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.provider.latency = 0
+
+        with mock.patch('planner.payments.time.sleep') as sleep:
+            response = self.client.post(reverse('create_payment'), CHECKOUT_FORM)
+
+        sleep.assert_not_called()
+        order = SubscriptionOrder.objects.get()
+        (payment_id,) = self.provider.payments
+        self.assertEqual(order.payment_id, payment_id)
+        self.assertEqual(response['Location'], order.confirmation_url)
+
+    def test_provider_failure_fails_the_order(self):
+        self.provider.failure_rate = 1
+
+        response = self.client.post(reverse('create_payment'), CHECKOUT_FORM)
+
+        self.assertEqual(response['Location'], reverse('order'))
+        self.assertEqual(SubscriptionOrder.objects.get().status, 'failed')
+
+    @override_settings(YOOKASSA_API_URL='http://127.0.0.1:8099/v3')
+    def test_provider_url_comes_from_settings(self):
+        configure_provider()
+
+        self.assertEqual(Configuration.api_url, 'http://127.0.0.1:8099/v3')
+
+
+class SubscriptionActivityTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(self.admin)
+        self.today = date.today()
+        self.add_subscribers(3)
+
+    def add_subscribers(self, count):
+        diet_type, _ = DietType.objects.get_or_create(name='Кето')
+        for _ in range(count):
+            number = User.objects.count()
+            for end_offset, status in [(10, 'paid'), (-1, 'paid'), (10, 'pending')]:
+                user = User.objects.create_user(f'user-{number}-{end_offset}-{status}')
+                UserProfile.objects.create(
+                    user=user,
+                    diet_type=diet_type,
+                    subscription_end_date=self.today + timedelta(days=end_offset),
+                )
+                SubscriptionOrder.objects.create(
+                    user=user, amount=1200, description='Подписка', status=status,
+                )
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_annotation_matches_instance_property(self):
+        annotated = {
+            order.pk: order.subscription_is_active
+            for order in SubscriptionOrder.objects.with_activity()
+        }
+
+        expected = {order.pk: order.is_active for order in SubscriptionOrder.objects.all()}
+        self.assertEqual(annotated, expected)
+        self.assertEqual(sum(expected.values()), 3)
+        self.assertEqual(SubscriptionOrder.objects.active().count(), 3)
+        self.assertEqual(UserProfile.objects.expired().count(), 3)
+
+    def test_admin_changelists_use_constant_number_of_queries(self):
+        urls = [
+            reverse('admin:planner_subscriptionorder_changelist'),
+            reverse('admin:planner_subscriptionorder_changelist') + '?subscription=active',
+            reverse('admin:planner_userprofile_changelist'),
+            reverse('admin:planner_userprofile_changelist') + '?subscription=expired',
+        ]
+        self.client.get(urls[0])
+        before = [self.changelist_queries(url) for url in urls]
+
+        self.add_subscribers(5)
+
+        self.assertEqual([self.changelist_queries(url) for url in urls], before)
+
+    def test_profile_changelist_sorts_by_subscription_status(self):
+        url = reverse('admin:planner_userprofile_changelist')
+        # Третья колонка - статус подписки
+        response = self.client.get(url + '?o=-3')
+
+        statuses = [
+            profile.subscription_is_active for profile in response.context['cl'].result_list
+        ]
+        self.assertEqual(statuses, sorted(statuses, reverse=True))
+        self.assertEqual(sum(statuses), 6)
+        expired = self.today - timedelta(days=1)
+        self.assertContains(response, f'Истекла {expired:%d.%m.%Y}', count=3)
+
+
+class DishAdminTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(self.admin)
+        self.diet = DietType.objects.create(name='Классическое')
+        self.ingredients = [
+            Ingredient.objects.create(
+                name=f'Продукт {number}',
+                price=Decimal('1.00'),
+                callories=Decimal('2.00'),
+                unit='g',
+            )
+            for number in range(50)
+        ]
+        self.add_dishes([150, 700, 1200])
+
+    def add_dishes(self, prices):
+        for price in prices:
+            dish = Dish.objects.create(
+                name=f'Блюдо {Dish.objects.count()}',
+                description='',
+                diet_type=self.diet,
+                category='lunch',
+            )
+            DishIngredient.objects.create(
+                dish=dish, ingredient=self.ingredients[0], quantity=price
+            )
+            DishIngredient.objects.create(
+                dish=dish, ingredient=self.ingredients[1], quantity=0
+            )
+
+    def changelist(self, query=''):
+        url = reverse('admin:planner_dish_changelist') + query
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_changelist_uses_constant_number_of_queries(self):
+        self.changelist()
+        _, before = self.changelist('?o=4')
+
+        self.add_dishes([300, 900, 50])
+
+        _, after = self.changelist('?o=4')
+        self.assertEqual(after, before)
+
+    def test_changelist_sorts_and_filters_by_price(self):
+        response, _ = self.changelist('?o=-4')
+        prices = [dish.total_price for dish in response.context['cl'].result_list]
+        self.assertEqual(prices, sorted(prices, reverse=True))
+
+        response, _ = self.changelist('?price=500-1000')
+        self.assertEqual(
+            [dish.total_price for dish in response.context['cl'].result_list],
+            [Decimal('700.00')],
+        )
+
+    def test_ingredient_inline_does_not_render_all_ingredients(self):
+        dish = Dish.objects.first()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:planner_dish_change', args=[dish.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, self.ingredients[-1].name)
+        # Виджет автодополнения выбирает только уже указанные ингредиенты
+        ingredient_queries = [
+            query['sql'] for query in queries.captured_queries
+            if 'FROM "planner_ingredient"' in query['sql']
+        ]
+        self.assertTrue(all(' WHERE ' in sql for sql in ingredient_queries))
+
+
+class PriceImportTest(TestCase):
+    def setUp(self):
+        self.diet = DietType.objects.create(name='Классическое')
+        self.egg = Ingredient.objects.create(
+            name='Яйцо', price=Decimal('10.00'), callories=Decimal('80.00'), unit='pcs'
+        )
+        self.milk = Ingredient.objects.create(
+            name='Молоко', price=Decimal('0.10'), callories=Decimal('0.60'), unit='ml'
+        )
+        self.omelette = Dish.objects.create(
+            name='Омлет', description='', diet_type=self.diet, category='breakfast'
+        )
+        self.pancakes = Dish.objects.create(
+            name='Блины', description='', diet_type=self.diet, category='breakfast'
+        )
+        DishIngredient.objects.create(dish=self.omelette, ingredient=self.egg, quantity=2)
+        DishIngredient.objects.create(dish=self.pancakes, ingredient=self.milk, quantity=200)
+
+    def price_list(self, text):
+        return read_price_rows(StringIO(text), 'prices.csv')
+
+    def test_import_updates_prices_and_only_affected_dishes(self):
+        Dish.objects.filter(pk=self.pancakes.pk).update(cached_price=0)
+
+        stats = import_prices(self.price_list(
+            'name;unit;price;callories\n'
+            'Яйцо;pcs;12,50;\n'
+            'Молоко;ml;0.10;0.60\n'
+            'Мука;g;0.05;3.4\n'
+            'Сахар;;1;1\n'
+        ), chunk_size=2)
+
+        self.assertEqual(
+            (stats['rows'], stats['updated'], stats['unchanged'], stats['unknown'], stats['invalid']),
+            (4, 1, 1, 1, 1),
+        )
+        self.assertEqual(stats['dishes'], 1)
+        self.egg.refresh_from_db()
+        self.assertEqual((self.egg.price, self.egg.callories), (Decimal('12.50'), Decimal('80.00')))
+        self.omelette.refresh_from_db()
+        self.pancakes.refresh_from_db()
+        self.assertEqual(self.omelette.total_price, Decimal('25.00'))
+        self.assertEqual(self.pancakes.total_price, Decimal('0.00'))
+
+    def test_query_count_does_not_grow_with_rows(self):
+        Ingredient.objects.bulk_create(
+            Ingredient(name=f'Продукт {number}', price=1, callories=1, unit='g')
+            for number in range(300)
+        )
+        text = 'name,unit,price\n' + ''.join(
+            f'Продукт {number},g,2\n' for number in range(300)
+        )
+        with CaptureQueriesContext(connection) as queries:
+            stats = import_prices(self.price_list(text), chunk_size=1000)
+        self.assertEqual(stats['updated'], 300)
+        self.assertLess(len(queries), 10)
+
+    def test_admin_upload(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(admin)
+        url = reverse('admin:planner_ingredient_import_prices')
+        self.assertContains(self.client.get(reverse('admin:planner_ingredient_changelist')), url)
+
+        upload = SimpleUploadedFile(
+            'prices.csv', 'name,unit,price\nЯйцо,pcs,11\n'.encode(), content_type='text/csv'
+        )
+        response = self.client.post(url, {'file': upload})
+
+        self.assertRedirects(response, reverse('admin:planner_ingredient_changelist'))
+        self.omelette.refresh_from_db()
+        self.assertEqual(self.omelette.total_price, Decimal('22.00'))
+
+        upload = SimpleUploadedFile('prices.txt', b'name,unit,price\n')
+        self.assertEqual(self.client.post(url, {'file': upload}).status_code, 200)
+
+    def test_admin_upload_xlsx(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.force_login(admin)
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(['name', 'unit', 'price', 'callories'])
+        sheet.append(['Яйцо', 'pcs', 12.5, None])
+        sheet.append(['Молоко', 'ml', 0.2, 0.6])
+        content = BytesIO()
+        workbook.save(content)
+
+        upload = SimpleUploadedFile('prices.xlsx', content.getvalue())
+        response = self.client.post(
+            reverse('admin:planner_ingredient_import_prices'), {'file': upload}
+        )
+
+        self.assertRedirects(response, reverse('admin:planner_ingredient_changelist'))
+        self.egg.refresh_from_db()
+        self.assertEqual((self.egg.price, self.egg.callories), (Decimal('12.50'), Decimal('80.00')))
+        self.pancakes.refresh_from_db()
+        self.assertEqual(self.pancakes.total_price, Decimal('40.00'))
+
+        upload = SimpleUploadedFile('broken.xlsx', b'name,unit,price\n')
+        response = self.client.post(
+            reverse('admin:planner_ingredient_import_prices'), {'file': upload}
+        )
+        self.assertContains(response, 'Не удалось прочитать XLSX')
+
+
+class LoadCatalogTest(TestCase):
+    CATALOG = {
+        'ingredients': [
+            {'name': 'Лосось', 'unit': 'g', 'price': '1.80', 'callories': '2.00',
+             'allergens': ['Рыба и морепродукты']},
+            {'name': 'Рис', 'unit': 'g', 'price': '0.20', 'callories': '3.50'},
+        ],
+        'dishes': [
+            {'name': 'Лосось с рисом', 'diet_type': 'Низкоуглеводное',
+             'category': 'dinner', 'description': 'Ужин', 'recipe': 'Сварить\nЗапечь',
+             'ingredients': [
+                 {'name': 'Лосось', 'unit': 'g', 'quantity': '200'},
+                 {'name': 'Рис', 'unit': 'g', 'quantity': '100'},
+             ]},
+        ],
+    }
+
+    def setUp(self):
+        self.nuts = Allergy.objects.create(name='Орехи')
+
+    def test_load_creates_catalog_with_derived_fields(self):
+        stats = load_catalog(self.CATALOG)
+
+        self.assertEqual((stats['dishes_created'], stats['ingredients_created']), (1, 2))
+        dish = Dish.objects.get(name='Лосось с рисом')
+        fish = Allergy.objects.get(name='Рыба и морепродукты')
+        self.assertEqual(dish.diet_type.name, 'Низкоуглеводное')
+        self.assertEqual(dish.total_price, Decimal('380.00'))
+        self.assertEqual(dish.total_calories, Decimal('750.00'))
+        self.assertNotEqual(fish.bit, self.nuts.bit)
+        self.assertEqual(dish.allergen_mask, fish.bit)
+        self.assertEqual(dish.recipe_paragraphs, ['Сварить', 'Запечь'])
+        self.assertEqual(
+            dish.ingredient_list,
+            [row.card_entry() for row in dish.dishingredient_set.select_related('ingredient')],
+        )
+
+    def test_reload_upserts_by_natural_key(self):
+        load_catalog(self.CATALOG)
+        other = Dish.objects.create(name='Рисовая каша', description='', category='breakfast')
+        DishIngredient.objects.create(
+            dish=other, ingredient=Ingredient.objects.get(name='Рис'), quantity=50
+        )
+
+        catalog = json.loads(json.dumps(self.CATALOG))
+        catalog['ingredients'][1]['price'] = '0.30'
+        catalog['ingredients'][1]['allergens'] = ['Орехи']
+        catalog['dishes'][0]['ingredients'] = catalog['dishes'][0]['ingredients'][1:]
+        stats = load_catalog(catalog)
+
+        self.assertEqual((stats['dishes_created'], stats['dishes_updated']), (0, 1))
+        self.assertEqual(stats['ingredients_updated'], 1)
+        self.assertEqual(Dish.objects.count(), 2)
+        self.assertEqual(Ingredient.objects.count(), 2)
+        dish = Dish.objects.get(name='Лосось с рисом')
+        self.assertEqual(dish.total_price, Decimal('30.00'))
+        self.assertEqual(dish.allergen_mask, self.nuts.bit)
+        self.assertEqual(dish.dishingredient_set.count(), 1)
+        self.assertEqual(
+            list(Ingredient.objects.get(name='Рис').allergens.all()), [self.nuts]
+        )
+        other.refresh_from_db()
+        self.assertEqual(other.total_price, Decimal('15.00'))
+        self.assertEqual(other.allergen_mask, self.nuts.bit)
+
+        load_catalog(self.CATALOG, update_existing=False)
+        self.assertEqual(
+            Dish.objects.get(name='Лосось с рисом').total_price, Decimal('30.00')
+        )
+
+    def test_csv_catalog_and_errors(self):
+        catalog = read_catalog(StringIO(
+            'dish,diet_type,category,description,recipe,ingredient,unit,quantity,price,callories,allergens\n'
+            'Омлет,Классическое,breakfast,Завтрак,,Яйцо,pcs,2,10,80,Яйца\n'
+            'Омлет,Классическое,breakfast,Завтрак,,Молоко,ml,100,0.1,0.6,\n'
+        ), 'catalog.csv')
+        load_catalog(catalog)
+        dish = Dish.objects.get(name='Омлет')
+        self.assertEqual(dish.total_price, Decimal('30.00'))
+        self.assertEqual(dish.allergen_mask, Allergy.objects.get(name='Яйца').bit)
+
+        catalog['dishes'][0]['ingredients'].append({'name': 'Мука', 'quantity': '1'})
+        with self.assertRaises(CatalogImportError):
+            load_catalog(catalog)
+        self.assertEqual(dish.dishingredient_set.count(), 2)
+
+    def test_query_count_does_not_grow_with_catalog(self):
+        def catalog(size):
+            return {
+                'ingredients': self.CATALOG['ingredients'],
+                'dishes': [
+                    dict(self.CATALOG['dishes'][0], name=f'Блюдо {number}')
+                    for number in range(size)
+                ],
+            }
+
+        def load_queries(size):
+            Dish.objects.all().delete()
+            with CaptureQueriesContext(connection) as queries:
+                load_catalog(catalog(size))
+            return len(queries)
+
+        load_catalog(catalog(1))
+        self.assertEqual(load_queries(50), load_queries(5))
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Разбирается план запроса SQLite')
+class QueryPlanTest(TestCase):
+    def assertUsesIndex(self, queryset, table, index):
+        plan = queryset.explain()
+        self.assertIn(index, plan)
+        self.assertNotRegex(plan, rf'\bSCAN {table}\b')
+
+    def test_hot_queries_use_indexes(self):
+        user = User.objects.create_user('indexed', email='indexed@example.com')
+        profile = UserProfile.objects.create(user=user, diet_type=DietType.objects.create(name='Кето'))
+        today = date.today()
+
+        # Меню на день, список покупок и выгрузка читают DailyMenu
+        # по уникальному ключу (profile, date)
+        for daily_menus in (
+            DailyMenu.objects.filter(profile=profile, date=today),
+            DailyMenu.objects.filter(profile=profile, date__in=[today]),
+            DailyMenu.objects.filter(profile__in=[profile], date=today),
+        ):
+            self.assertUsesIndex(
+                daily_menus, 'planner_dailymenu', 'sqlite_autoindex_planner_dailymenu_1'
+            )
+        # Перед загрузкой каталога читается только его версия
+        self.assertUsesIndex(
+            CatalogVersion.objects.filter(pk=CATALOG_VERSION_ID),
+            'planner_catalogversion', 'INTEGER PRIMARY KEY',
+        )
+        self.assertUsesIndex(
+            SubscriptionOrder.objects.filter(payment_id='payment'),
+            'planner_subscriptionorder', 'unique_payment_id',
+        )
+        self.assertUsesIndex(
+            SubscriptionOrder.objects.filter(payment_id__in=['first', 'second']),
+            'planner_subscriptionorder', 'unique_payment_id',
+        )
+        self.assertUsesIndex(
+            SubscriptionOrder.objects.filter(user=user, status='paid'),
+            'planner_subscriptionorder', 'order_user_status_idx',
+        )
+        self.assertUsesIndex(
+            UserProfile.objects.active(today),
+            'planner_userprofile', 'profile_subscription_end_idx',
+        )
+        self.assertUsesIndex(
+            User.objects.filter(email='indexed@example.com'),
+            'auth_user', 'planner_auth_user_email_idx',
+        )
+
+    def test_payment_id_is_unique_only_when_set(self):
+        user = User.objects.create_user('payer')
+        for _ in range(2):
+            SubscriptionOrder.objects.create(user=user, amount=1200, description='Подписка')
+        SubscriptionOrder.objects.create(
+            user=user, amount=1200, description='Подписка', payment_id='payment'
+        )
+        with self.assertRaises(IntegrityError):
+            SubscriptionOrder.objects.create(
+                user=user, amount=1200, description='Подписка', payment_id='payment'
+            )
+
+
+class ConcurrentSQLiteBackendTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'db.sqlite3')
+        self.connections = ConnectionHandler({'default': {
+            'ENGINE': 'food_plan.sqlite_backend',
+            'NAME': self.path,
+            'OPTIONS': {'pragmas': {'busy_timeout': 1234}},
+        }})
+        self.addCleanup(self.connections.close_all)
+        self.connection = self.connections['default']
+
+    def pragma(self, name):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_new_connections_are_tuned(self):
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('busy_timeout'), 1234)
+        self.assertEqual(self.pragma('cache_size'), -32000)
+        self.assertEqual(self.pragma('foreign_keys'), 1)
+
+    def test_transactions_take_write_lock_immediately(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE item (id INTEGER PRIMARY KEY)')
+
+        self.connection.set_autocommit(False, force_begin_transaction_with_broken_autocommit=True)
+        try:
+            other = sqlite3.connect(self.path, timeout=0)
+            self.addCleanup(other.close)
+            # Транзакция ещё ничего не записала, но блокировку уже держит
+            with self.assertRaisesMessage(sqlite3.OperationalError, 'locked'):
+                other.execute('INSERT INTO item DEFAULT VALUES')
+        finally:
+            self.connection.rollback()
+            self.connection.set_autocommit(True)
+        other.execute('INSERT INTO item DEFAULT VALUES')
@@ -1,13 +1,12 @@
 import json
 import logging
-import random
-import uuid
-from datetime import timedelta
+from datetime import date, timedelta
 
-from yookassa import Configuration, Payment
+from asgiref.sync import sync_to_async
 
 from django.conf import settings
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import (
     authenticate,
     get_user_model,
@@ -15,24 +14,51 @@ from django.contrib.auth import (
     logout,
 )
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache
 from django.shortcuts import (
     get_object_or_404,
     redirect,
     render,
 )
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils import timezone
 from django.urls import reverse
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
 
 from .forms import LoginForm, RegisterForm, UserProfileForm
+from .fragments import render_menu_section, scaled_ingredient_list
+from .meal_plan import MEAL_PLAN_DAYS, MealPlanError, plan_for_profile
+from .menu import menu_for_day
+from .payments import (
+    REQUIRED_FIELDS,
+    ProviderTimeout,
+    activate_subscription,
+    await_confirmation_url,
+    checkout_cache_key,
+    checkout_idempotency_key,
+    create_provider_payment,
+    find_provider_payment,
+    payment_payload,
+    provider_idempotency_key,
+    remember_checkout,
+    run_provider_call,
+    subscription_order_data,
+    wait_for_confirmation_url,
+)
+from .shopping import (
+    SHOPPING_LIST_DAYS,
+    export_shopping_rows,
+    render_export,
+    shopping_list_for_profile,
+)
+from .webhooks import is_verified_webhook
 from .models import (
-    Allergy,
-    DietType,
     Dish,
     UserProfile,
     SubscriptionOrder,
+    WebhookEvent,
 )
 
 
@@ -41,15 +67,12 @@ logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
-Configuration.account_id = settings.YOOKASSA_SHOP_ID
-Configuration.secret_key = settings.YOOKASSA_SECRET_KEY
 
-duration_mapping = {
-    '0': '30',
-    '1': '90',
-    '2': '180',
-    '3': '365',
-}
+PROVIDER_TIMEOUT_MESSAGE = (
+    "Платёжная система не ответила вовремя. Повторите оплату через минуту: "
+    "второй платёж по этому заказу создан не будет."
+)
+
 
 
 @csrf_exempt
@@ -59,101 +82,143 @@ def create_payment(request):
         messages.error(request, "Неверный метод запроса")
         return redirect('order')
 
-    required_fields = [
-        'foodtype',
-        'select1',
-        'select2',
-        'select3',
-        'select4',
-        'select5',
-        'duration',
-    ]
-    if not all(field in request.POST for field in required_fields):
+    if not all(field in request.POST for field in REQUIRED_FIELDS):
         messages.error(request, "Не все необходимые данные получены")
         return redirect('order')
 
+    order_data = subscription_order_data(request.POST)
+    idempotency_key = checkout_idempotency_key(
+        request.user.pk, order_data['subscription_params']
+    )
+    confirmation_url = cache.get(checkout_cache_key(idempotency_key))
+    if confirmation_url:
+        return redirect(confirmation_url)
+
+    order = None
     try:
-        duration = request.POST.get('duration', '0')
-        meal_count = sum(
-            1 for select in ['select1', 'select2', 'select3', 'select4']
-            if request.POST.get(select) == '0'
+        order, created = SubscriptionOrder.objects.get_or_create(
+            idempotency_key=idempotency_key,
+            status='pending',
+            defaults={'user': request.user, **order_data},
         )
+        if not created and wait_for_confirmation_url(order):
+            logger.info(f"Repeated checkout for order #{order.id}")
+            remember_checkout(order)
+            return redirect(order.confirmation_url)
+
+        # Тот же ключ у ЮKassa не даст создать второй платёж, даже если
+        # параллельный запрос не дождался ссылки
+        payment = create_provider_payment(
+            payment_payload(order, payment_return_url(request, order)),
+            provider_idempotency_key(order),
+        )
+
+        order.payment_id = payment.id
+        order.confirmation_url = payment.confirmation.confirmation_url
+        order.save(update_fields=['payment_id', 'confirmation_url'])
+        remember_checkout(order)
 
-        price_per_month = {'0': 1200, '1': 1000, '2': 700, '3': 500}.get(
-            duration, 1200
+        logger.info(
+            f"Created payment for order #{order.id}. "
+            f"Amount: {order.amount}, user: {request.user.username}"
         )
-        total_amount = price_per_month * meal_count
-        duration_days = int(duration_mapping.get(duration, '30'))
-
-        diet_type_name = {
-            'classic': 'Классическое',
-            'low': 'Низкоуглеводное',
-            'veg': 'Вегетарианское',
-            'keto': 'Кето',
-        }.get(request.POST.get('foodtype'), 'Неизвестный')
-
-        description = (
-            f"Подписка FoodPlan: {diet_type_name} меню, "
-            f"{duration_days} дней, {meal_count} приемов пищи"
+
+        return redirect(order.confirmation_url)
+
+    except ProviderTimeout as e:
+        # Платёж мог создаться, поэтому заказ остаётся ожидающим: повторная
+        # отправка формы получит его по тому же ключу, а если пользователь
+        # не вернётся, платёж найдёт reconcile_payments
+        logger.warning(f"Payment creation timed out for order #{order.id}: {str(e)}")
+        messages.error(request, PROVIDER_TIMEOUT_MESSAGE)
+        return redirect('order')
+
+    except Exception as e:
+        logger.error(f"Error creating payment: {str(e)}", exc_info=True)
+        if order is not None and not order.payment_id:
+            # Освобождаем ключ, чтобы повторная попытка создала новый заказ
+            order.status = 'failed'
+            order.save(update_fields=['status'])
+        messages.error(
+            request,
+            "Произошла ошибка при создании платежа. Пожалуйста, попробуйте позже.",
         )
+        return redirect('order')
+
 
-        order = SubscriptionOrder.objects.create(
-            user=request.user,
-            amount=total_amount,
-            description=description,
+def payment_return_url(request, order):
+    return request.build_absolute_uri(
+        reverse('payment_success') + f"?order_id={order.id}"
+    )
+
+
+async def authenticated_user(request):
+    def get_user():
+        return request.user if request.user.is_authenticated else None
+    return await sync_to_async(get_user)()
+
+
+async def create_payment_async(request):
+    user = await authenticated_user(request)
+    if user is None:
+        return redirect_to_login(request.get_full_path())
+
+    if request.method != 'POST':
+        messages.error(request, "Неверный метод запроса")
+        return redirect('order')
+
+    if not all(field in request.POST for field in REQUIRED_FIELDS):
+        messages.error(request, "Не все необходимые данные получены")
+        return redirect('order')
+
+    order_data = subscription_order_data(request.POST)
+    idempotency_key = checkout_idempotency_key(
+        user.pk, order_data['subscription_params']
+    )
+    confirmation_url = await cache.aget(checkout_cache_key(idempotency_key))
+    if confirmation_url:
+        return redirect(confirmation_url)
+
+    order = None
+    try:
+        order, created = await SubscriptionOrder.objects.aget_or_create(
+            idempotency_key=idempotency_key,
             status='pending',
-            subscription_params={
-                'duration': duration,
-                'duration_days': duration_days,
-                'meal_count': meal_count,
-                'foodtype': request.POST.get('foodtype'),
-                'select1': request.POST.get('select1'),
-                'select2': request.POST.get('select2'),
-                'select3': request.POST.get('select3'),
-                'select4': request.POST.get('select4'),
-                'select5': request.POST.get('select5'),
-                **{
-                    f'allergy{i}': request.POST.get(f'allergy{i}', '0')
-                    for i in range(1, 7)
-                },
-            },
+            defaults={'user': user, **order_data},
         )
-
-        payment = Payment.create(
-            {
-                "amount": {
-                    "value": f"{total_amount:.2f}",
-                    "currency": "RUB",
-                },
-                "confirmation": {
-                    "type": "redirect",
-                    "return_url": request.build_absolute_uri(
-                        reverse('payment_success') + f"?order_id={order.id}"
-                    ),
-                },
-                "capture": True,
-                "description": description,
-                "metadata": {
-                    "order_id": order.id,
-                    "user_id": request.user.id,
-                    "subscription_type": "foodplan",
-                },
-            },
-            str(uuid.uuid4()),
+        if not created and await await_confirmation_url(order):
+            logger.info(f"Repeated checkout for order #{order.id}")
+            await sync_to_async(remember_checkout)(order)
+            return redirect(order.confirmation_url)
+
+        payment = await run_provider_call(
+            create_provider_payment,
+            payment_payload(order, payment_return_url(request, order)),
+            provider_idempotency_key(order),
         )
 
         order.payment_id = payment.id
-        order.save()
+        order.confirmation_url = payment.confirmation.confirmation_url
+        await order.asave(update_fields=['payment_id', 'confirmation_url'])
+        await sync_to_async(remember_checkout)(order)
 
         logger.info(
             f"Created payment for order #{order.id}. "
-            f"Amount: {total_amount}, user: {request.user.username}"
+            f"Amount: {order.amount}, user: {user.username}"
         )
 
-        return redirect(payment.confirmation.confirmation_url)
+        return redirect(order.confirmation_url)
+
+    except ProviderTimeout as e:
+        logger.warning(f"Payment creation timed out for order #{order.id}: {str(e)}")
+        messages.error(request, PROVIDER_TIMEOUT_MESSAGE)
+        return redirect('order')
 
     except Exception as e:
         logger.error(f"Error creating payment: {str(e)}", exc_info=True)
+        if order is not None and not order.payment_id:
+            order.status = 'failed'
+            await order.asave(update_fields=['status'])
         messages.error(
             request,
             "Произошла ошибка при создании платежа. Пожалуйста, попробуйте позже.",
@@ -161,6 +226,9 @@ def create_payment(request):
         return redirect('order')
 
 
+create_payment_async.csrf_exempt = True
+
+
 @csrf_exempt
 @login_required
 def payment_success(request):
@@ -176,22 +244,10 @@ def payment_success(request):
             messages.success(request, "Подписка уже активирована!")
             return redirect('lk')
 
-        payment = Payment.find_one(order.payment_id)
-
-        if payment.status == 'succeeded':
-            if activate_subscription(order, payment):
-                messages.success(request, "Подписка успешно оформлена!")
-            else:
-                messages.error(request, "Ошибка активации подписки")
-            return redirect('lk')
-        elif payment.status == 'waiting_for_capture':
-            messages.info(request, "Платеж ожидает подтверждения")
-            return redirect('lk')
-        else:
-            messages.error(
-                request, f"Платеж не прошел. Статус: {payment.status}"
-            )
-            return redirect('order')
+        payment = find_provider_payment(order.payment_id)
+        return payment_status_redirect(
+            request, payment, lambda: activate_subscription(order, payment)
+        )
 
     except Exception as e:
         logger.error(f"Payment success error: {str(e)}", exc_info=True)
@@ -199,99 +255,84 @@ def payment_success(request):
         return redirect('order')
 
 
-@csrf_exempt
-def yookassa_webhook(request):
-    if request.method == 'POST':
-        event_json = json.loads(request.body)
-        payment_id = event_json['object']['id']
-
-        try:
-            payment = Payment.find_one(payment_id)
-            order = SubscriptionOrder.objects.get(payment_id=payment_id)
-
-            if payment.status == 'succeeded' and order.status != 'paid':
-                activate_subscription(order.user, order)
-                order.status = 'paid'
-                order.save()
+async def payment_success_async(request):
+    user = await authenticated_user(request)
+    if user is None:
+        return redirect_to_login(request.get_full_path())
 
-        except Exception as e:
-            logger.error(f"Webhook error: {str(e)}")
+    order_id = request.GET.get('order_id')
+    if not order_id:
+        messages.error(request, "Не получен ID заказа")
+        return redirect('order')
 
-    return HttpResponse(status=200)
+    try:
+        order = await SubscriptionOrder.objects.select_related('user').aget(id=order_id)
 
+        if order.status == 'paid':
+            messages.success(request, "Подписка уже активирована!")
+            return redirect('lk')
 
-def activate_subscription(order, payment):
-    try:
-        profile = order.user.userprofile
-        sub_params = order.subscription_params
+        payment = await run_provider_call(find_provider_payment, order.payment_id)
+        activated = None
+        if payment.status == 'succeeded':
+            activated = await sync_to_async(activate_subscription)(order, payment)
+        return payment_status_redirect(request, payment, lambda: activated)
 
-        profile.breakfast = sub_params.get('select1') == '0'
-        profile.lunch = sub_params.get('select2') == '0'
-        profile.dinner = sub_params.get('select3') == '0'
-        profile.dessert = sub_params.get('select4') == '0'
+    except Exception as e:
+        logger.error(f"Payment success error: {str(e)}", exc_info=True)
+        messages.error(request, "Ошибка при обработке платежа")
+        return redirect('order')
 
-        persons_mapping = {'0': 1, '1': 2, '2': 3, '3': 4, '4': 5, '5': 6}
-        profile.count_of_persons = persons_mapping.get(
-            sub_params.get('select5', '0'), 1
-        )
 
-        diet_type_name = {
-            'classic': 'Классическое',
-            'low': 'Низкоуглеводное',
-            'veg': 'Вегетарианское',
-            'keto': 'Кето',
-        }.get(sub_params.get('foodtype'))
-
-        if diet_type_name:
-            diet_type, _ = DietType.objects.get_or_create(name=diet_type_name)
-            profile.diet_type = diet_type
-
-        allergy_map = {
-            'allergy1': 'Рыба и морепродукты',
-            'allergy2': 'Мясо',
-            'allergy3': 'Зерновые',
-            'allergy4': 'Продукты пчеловодства',
-            'allergy5': 'Орехи и бобовые',
-            'allergy6': 'Молочные продукты',
-        }
+payment_success_async.csrf_exempt = True
 
-        profile.allergies.clear()
-        for key, name in allergy_map.items():
-            if sub_params.get(key) == '1':
-                allergy, _ = Allergy.objects.get_or_create(name=name)
-                profile.allergies.add(allergy)
 
-        duration_days = int(sub_params.get('duration_days', 30))
-        profile.subscription_end_date = timezone.now().date() + timedelta(
-            days=duration_days
+def payment_status_redirect(request, payment, activate):
+    if payment.status == 'succeeded':
+        if activate():
+            messages.success(request, "Подписка успешно оформлена!")
+        else:
+            messages.error(request, "Ошибка активации подписки")
+        return redirect('lk')
+    elif payment.status == 'waiting_for_capture':
+        messages.info(request, "Платеж ожидает подтверждения")
+        return redirect('lk')
+    else:
+        messages.error(
+            request, f"Платеж не прошел. Статус: {payment.status}"
         )
+        return redirect('order')
 
-        profile.active_subscription = order
-        profile.save()
-
-        order.status = 'paid'
-        order.payment_data = {
-            'id': payment.id,
-            'status': payment.status,
-            'paid': payment.paid,
-            'amount': payment.amount.value,
-            'currency': payment.amount.currency,
-            'created_at': payment.created_at,
-        }
-        order.save()
 
-        logger.info(
-            f"Subscription activated for user {order.user.username}, "
-            f"order #{order.id}"
-        )
-        return True
+@csrf_exempt
+@require_POST
+def yookassa_webhook(request):
+    # Только сохраняем уведомление: проверку платежа и активацию подписки
+    # выполняет команда process_webhooks, чтобы ЮKassa не ждала наш ответ
+    verified = is_verified_webhook(request)
+    if (
+        settings.YOOKASSA_WEBHOOK_VERIFICATION == 'ip'
+        and not verified
+        and not settings.YOOKASSA_WEBHOOK_API_FALLBACK
+    ):
+        return HttpResponse(status=403)
 
-    except Exception as e:
-        logger.error(
-            f"Subscription activation failed for order #{order.id}: {str(e)}",
-            exc_info=True,
-        )
-        return False
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return HttpResponse(status=400)
+    if not isinstance(payload, dict):
+        return HttpResponse(status=400)
+
+    payment = payload.get('object')
+    payment_id = payment.get('id', '') if isinstance(payment, dict) else ''
+    WebhookEvent.objects.create(
+        event=str(payload.get('event', ''))[:64],
+        payment_id=str(payment_id)[:255],
+        payload=payload,
+        verified=verified,
+    )
+    return HttpResponse(status=200)
 
 
 def index(request):
@@ -314,22 +355,17 @@ def registration(request):
 
 
 def dish_card(request, dish_id):
-    dish = get_object_or_404(Dish, id=dish_id)
-    ingredients = dish.dishingredient_set.all()
-    profile = request.user.userprofile
-
-    adjusted_ingredients = []
-    for ingredient in ingredients:
-        adjusted_quantity = float(ingredient.quantity) * profile.count_of_persons
-        adjusted_ingredients.append({
-            'ingredient': ingredient.ingredient,
-            'quantity': adjusted_quantity,
-            'unit': ingredient.ingredient.get_unit_display(),
-        })
+    dish = get_object_or_404(
+        Dish.objects.select_related('diet_type'), id=dish_id
+    )
+    profile = None
+    if request.user.is_authenticated:
+        profile = UserProfile.objects.filter(user=request.user).first()
+    persons = profile.count_of_persons if profile else 1
 
     context = {
         'dish': dish,
-        'ingredients': adjusted_ingredients,
+        'ingredients': scaled_ingredient_list(dish, persons),
         'profile': profile,
     }
     return render(request, 'card.html', context)
@@ -345,53 +381,15 @@ def lk_view(request):
         return redirect('index')
 
     # Проверка активности подписки
+    today = timezone.now().date()
     subscription_active = (
         profile.subscription_end_date
-        and profile.subscription_end_date >= timezone.now().date()
+        and profile.subscription_end_date >= today
     )
-    dishes_by_category = {}
-
-    if subscription_active and profile.diet_type:
-        # Логика фильтрации блюд только если подписка активна и выбран тип диеты
-        categories = []
-        if profile.breakfast:
-            categories.append('breakfast')
-        if profile.lunch:
-            categories.append('lunch')
-        if profile.dinner:
-            categories.append('dinner')
-        if profile.dessert:
-            categories.append('dessert')
-
-        if categories:
-            dishes = Dish.objects.filter(
-                diet_type=profile.diet_type,
-                category__in=categories,
-            ).distinct()
-
-            if profile.allergies.exists():
-                dishes = dishes.exclude(
-                    ingredients__allergens__in=profile.allergies.all()
-                ).distinct()
-
-            adjusted_dishes = []
-            for dish in dishes:
-                dish.adjusted_price = dish.total_price * profile.count_of_persons
-                dish.adjusted_calories = dish.total_calories * profile.count_of_persons
-                adjusted_dishes.append(dish)
-
-            if profile.budget_limit:
-                adjusted_dishes = [
-                    dish
-                    for dish in adjusted_dishes
-                    if dish.adjusted_price <= profile.budget_limit
-                ]
-
-            for category in categories:
-                category_dishes = [
-                    d for d in adjusted_dishes if d.category == category
-                ]
-                dishes_by_category[f"{category}_dishes"] = category_dishes
+    menu = {}
+    if subscription_active and profile.diet_type_id:
+        # Подбор блюд только если подписка активна и выбран тип диеты
+        menu = menu_for_day(profile, today)
 
     form = UserProfileForm(instance=profile, user=user)
 
@@ -400,12 +398,89 @@ def lk_view(request):
         'profile': profile,
         'user': user,
         'subscription_active': subscription_active,
-        **dishes_by_category,
+        'menu_html': render_menu_section(profile, menu),
     }
 
     return render(request, 'lk.html', context)
 
 
+@login_required
+def shopping_list(request):
+    profile = get_object_or_404(UserProfile, user=request.user)
+    start_date = timezone.now().date()
+    items, total = [], 0
+    if profile.subscription_end_date and profile.subscription_end_date >= start_date:
+        items, total = shopping_list_for_profile(profile, start_date)
+
+    context = {
+        'profile': profile,
+        'items': items,
+        'total': total,
+        'start_date': start_date,
+        'end_date': start_date + timedelta(days=SHOPPING_LIST_DAYS - 1),
+    }
+    return render(request, 'shopping_list.html', context)
+
+
+@login_required
+def meal_plan_view(request):
+    profile = get_object_or_404(UserProfile, user=request.user)
+    start_date = timezone.now().date()
+    plan, error = [], None
+    if profile.subscription_end_date and profile.subscription_end_date >= start_date:
+        try:
+            plan = plan_for_profile(profile, MEAL_PLAN_DAYS, start_date)
+        except MealPlanError as e:
+            error = str(e)
+
+    dishes = Dish.objects.only('id', 'name').in_bulk(
+        {dish_id for day in plan for dish_id in day['meals'].values()}
+    )
+    titles = dict(Dish.DISH_CATEGORY_CHOICES)
+    days = [
+        {
+            **day,
+            'meals': [
+                (titles[category], dishes[dish_id])
+                for category, dish_id in day['meals'].items()
+            ],
+        }
+        for day in plan
+    ]
+
+    context = {
+        'profile': profile,
+        'days': days,
+        'error': error,
+        'start_date': start_date,
+        'end_date': start_date + timedelta(days=MEAL_PLAN_DAYS - 1),
+    }
+    return render(request, 'meal_plan.html', context)
+
+
+@staff_member_required
+def export_shopping_lists(request):
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return HttpResponse(status=400)
+    try:
+        day = date.fromisoformat(request.GET['date'])
+    except (KeyError, ValueError):
+        day = timezone.now().date() + timedelta(days=1)
+
+    response = StreamingHttpResponse(
+        render_export(export_shopping_rows(day), export_format),
+        content_type=(
+            'text/csv; charset=utf-8' if export_format == 'csv'
+            else 'application/x-ndjson; charset=utf-8'
+        ),
+    )
+    response['Content-Disposition'] = (
+        f'attachment; filename="shopping-{day.isoformat()}.{export_format}"'
+    )
+    return response
+
+
 @login_required
 def order(request):
     return render(request, 'order.html')
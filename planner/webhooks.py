@@ -0,0 +1,189 @@
+import ipaddress
+import logging
+from collections import Counter, defaultdict
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+
+from yookassa.domain.response import PaymentResponse
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import SubscriptionOrder, WebhookEvent
+from .payments import apply_payment, find_provider_payment
+
+
+logger = logging.getLogger(__name__)
+
+
+WEBHOOK_BATCH_SIZE = 100
+WEBHOOK_MAX_ATTEMPTS = 8
+# Задержка перед повтором удваивается с каждой попыткой: 30 с, 1 мин, 2 мин...
+WEBHOOK_RETRY_DELAY = timedelta(seconds=30)
+WEBHOOK_MAX_RETRY_DELAY = timedelta(hours=1)
+
+
+# События, статус платежа в которых окончательный и не требует перепроверки
+TRUSTED_EVENTS = {
+    'payment.succeeded': 'succeeded',
+    'payment.canceled': 'canceled',
+}
+
+
+class WebhookProcessingError(Exception):
+    pass
+
+
+class UnverifiedWebhookError(WebhookProcessingError):
+    """Уведомление нельзя обработать без запроса к API, а он отключён."""
+
+
+@lru_cache(maxsize=None)
+def trusted_networks(networks):
+    return tuple(ipaddress.ip_network(network.strip()) for network in networks)
+
+
+def webhook_source_ip(request):
+    value = request.META.get(settings.YOOKASSA_WEBHOOK_IP_HEADER, '')
+    # Прокси дописывает адрес клиента в конец X-Forwarded-For,
+    # начало заголовка может подставить кто угодно
+    return value.split(',')[-1].strip()
+
+
+def is_trusted_source(ip):
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return any(
+        address in network
+        for network in trusted_networks(tuple(settings.YOOKASSA_TRUSTED_NETWORKS))
+    )
+
+
+def is_verified_webhook(request):
+    return (
+        settings.YOOKASSA_WEBHOOK_VERIFICATION == 'ip'
+        and is_trusted_source(webhook_source_ip(request))
+    )
+
+
+def payment_from_events(events, order):
+    """Платёж из тела подтверждённых уведомлений.
+
+    Возвращает None, если подтверждённых уведомлений нет или они
+    неоднозначны: статус не окончательный, уведомления противоречат друг
+    другу или сумма не совпадает с заказом.
+    """
+    objects = [
+        (event.event, event.payload.get('object'))
+        for event in events if event.verified
+    ]
+    if not objects or any(not isinstance(obj, dict) for _, obj in objects):
+        return None
+    statuses = {TRUSTED_EVENTS.get(name) for name, _ in objects}
+    statuses |= {obj.get('status') for _, obj in objects}
+    if len(statuses) != 1 or None in statuses:
+        return None
+
+    obj = objects[-1][1]
+    amount = obj.get('amount')
+    if not isinstance(amount, dict) or amount.get('currency') != 'RUB':
+        return None
+    try:
+        if Decimal(str(amount.get('value'))) != order.amount:
+            return None
+    except InvalidOperation:
+        return None
+    return PaymentResponse(obj)
+
+
+def retry_delay(attempts):
+    return min(WEBHOOK_RETRY_DELAY * 2 ** (attempts - 1), WEBHOOK_MAX_RETRY_DELAY)
+
+
+def process_payment_events(payment_id, order, events):
+    if order is None:
+        raise WebhookProcessingError(f'Заказ для платежа {payment_id} не найден')
+    if order.status == 'paid':
+        return False
+
+    payment = payment_from_events(events, order)
+    if payment is not None:
+        apply_payment(order, payment)
+        return False
+    if not settings.YOOKASSA_WEBHOOK_API_FALLBACK:
+        raise UnverifiedWebhookError(
+            f'Уведомление о платеже {payment_id} не удалось подтвердить'
+        )
+    apply_payment(order, find_provider_payment(payment_id))
+    return True
+
+
+def process_webhook_batch(batch_size=WEBHOOK_BATCH_SIZE, max_attempts=WEBHOOK_MAX_ATTEMPTS):
+    """Обрабатывает одну пачку уведомлений из очереди.
+
+    Уведомления группируются по платежу: ЮKassa присылает повторы, а статус
+    платежа достаточно проверить один раз. Статус из подтверждённых
+    уведомлений применяется без запроса к API. Возвращает счётчики
+    обработанных, отложенных и окончательно не обработанных уведомлений,
+    а также число запросов к API.
+    """
+    now = timezone.now()
+    events = list(
+        WebhookEvent.objects.filter(status='new', next_attempt_at__lte=now)
+        .order_by('id')[:batch_size]
+    )
+    stats = Counter()
+    if not events:
+        return stats
+
+    by_payment = defaultdict(list)
+    for event in events:
+        by_payment[event.payment_id].append(event)
+    orders = {
+        order.payment_id: order
+        for order in SubscriptionOrder.objects.filter(
+            payment_id__in=[payment_id for payment_id in by_payment if payment_id]
+        ).select_related('user')
+    }
+
+    for payment_id, group in by_payment.items():
+        if not payment_id:
+            stats['failed'] += WebhookEvent.objects.filter(
+                pk__in=[event.pk for event in group]
+            ).update(status='failed', last_error='В уведомлении нет ID платежа')
+            continue
+
+        try:
+            stats['api_calls'] += process_payment_events(
+                payment_id, orders.get(payment_id), group
+            )
+        except Exception as e:
+            attempts = max(event.attempts for event in group) + 1
+            status = 'new'
+            if attempts >= max_attempts or isinstance(e, UnverifiedWebhookError):
+                status = 'failed'
+            WebhookEvent.objects.filter(pk__in=[event.pk for event in group]).update(
+                status=status,
+                attempts=attempts,
+                next_attempt_at=timezone.now() + retry_delay(attempts),
+                last_error=str(e),
+            )
+            stats['failed' if status == 'failed' else 'retried'] += len(group)
+            logger.warning(
+                f"Webhook processing failed for payment {payment_id} "
+                f"(attempt {attempts}): {str(e)}"
+            )
+            continue
+
+        # Закрываем и повторы этого платежа, не попавшие в текущую пачку
+        stats['processed'] += WebhookEvent.objects.filter(
+            status='new', payment_id=payment_id
+        ).update(
+            status='processed',
+            processed_at=timezone.now(),
+            last_error='',
+        )
+    return stats
@@ -0,0 +1,251 @@
+"""Локальная заглушка API ЮKassa для тестов, замеров и ручной проверки.
+
+Поддерживает только то, что использует проект: создание платежа
+(POST /v3/payments), получение платежа (GET /v3/payments/<id>), список
+платежей (GET /v3/payments) и уведомления об изменении статуса. Страница
+оплаты /confirm/<id> сразу проводит платёж и возвращает пользователя на
+return_url, как это сделала бы ЮKassa после успешной оплаты.
+"""
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import Request, urlopen
+
+from .payments import api_timestamp
+
+
+logger = logging.getLogger(__name__)
+
+
+class StubPaymentHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/v3/payments':
+            return self.send_json(404, {'type': 'error', 'code': 'not_found'})
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        idempotence_key = self.headers.get('Idempotence-Key')
+        if self.server.provider.delay():
+            return self.send_error_json()
+        self.send_json(200, self.server.provider.create(body, idempotence_key))
+
+    def do_GET(self):
+        provider = self.server.provider
+        url = urlsplit(self.path)
+        if url.path.startswith('/confirm/'):
+            payment = provider.pay(url.path[len('/confirm/'):])
+            if payment is None:
+                return self.send_json(404, {'type': 'error', 'code': 'not_found'})
+            return self.send_redirect(provider.return_urls.get(payment['id']) or '/')
+
+        if url.path.rstrip('/') == '/v3/payments':
+            if provider.delay():
+                return self.send_error_json()
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            return self.send_json(200, provider.list(query))
+
+        prefix = '/v3/payments/'
+        if not url.path.startswith(prefix):
+            return self.send_json(404, {'type': 'error', 'code': 'not_found'})
+        if provider.delay():
+            return self.send_error_json()
+        payment = provider.get(url.path[len(prefix):])
+        if payment is None:
+            return self.send_json(404, {'type': 'error', 'code': 'not_found'})
+        self.send_json(200, payment)
+
+    def send_error_json(self):
+        self.send_json(500, {'type': 'error', 'code': 'internal_server_error'})
+
+    def send_redirect(self, location):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def post_webhook(url):
+    """Отправитель уведомлений по HTTP, как их шлёт ЮKassa."""
+    def send(notification):
+        request = Request(
+            url,
+            data=json.dumps(notification).encode(),
+            headers={'Content-Type': 'application/json'},
+            method='POST',
+        )
+        with urlopen(request, timeout=10) as response:
+            return response.status
+    return send
+
+
+class StubProvider:
+    """Заглушка ЮKassa.
+
+    ``latency`` - задержка ответа API в секундах, ``failure_rate`` - доля
+    запросов к API, на которые заглушка отвечает ошибкой 500. ``webhook`` -
+    URL или функция, получающая тело уведомления при оплате платежа.
+    """
+    handler_class = StubPaymentHandler
+
+    def __init__(
+        self,
+        host='127.0.0.1',
+        port=0,
+        latency=0.0,
+        failure_rate=0.0,
+        webhook=None,
+        seed=None,
+    ):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.webhook = post_webhook(webhook) if isinstance(webhook, str) else webhook
+        self.payments = {}
+        self.idempotence_keys = {}
+        self.return_urls = {}
+        self.requests = {'create': 0, 'find': 0, 'list': 0, 'failed': 0, 'webhooks': 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler_class)
+        self.server.daemon_threads = True
+        self.server.provider = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def api_url(self):
+        return f'{self.base_url}/v3'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def delay(self):
+        """Имитирует задержку API; возвращает True, если запрос должен упасть."""
+        if self.latency:
+            time.sleep(self.latency)
+        if not self.failure_rate:
+            return False
+        with self._lock:
+            failed = self._random.random() < self.failure_rate
+            self.requests['failed'] += failed
+        return failed
+
+    def create(self, body, idempotence_key=None):
+        with self._lock:
+            self.requests['create'] += 1
+            if idempotence_key in self.idempotence_keys:
+                return self.payments[self.idempotence_keys[idempotence_key]]
+
+            payment_id = str(uuid.uuid4())
+            payment = {
+                'id': payment_id,
+                'status': 'pending',
+                'paid': False,
+                'amount': body.get('amount', {'value': '0.00', 'currency': 'RUB'}),
+                'confirmation': {
+                    'type': 'redirect',
+                    'confirmation_url': f'{self.base_url}/confirm/{payment_id}',
+                },
+                'created_at': api_timestamp(datetime.now(timezone.utc)),
+                'description': body.get('description', ''),
+                'metadata': body.get('metadata', {}),
+                'recipient': {'account_id': 'stub', 'gateway_id': 'stub'},
+                'refundable': False,
+                'test': True,
+            }
+            self.payments[payment_id] = payment
+            self.return_urls[payment_id] = body.get('confirmation', {}).get('return_url')
+            if idempotence_key:
+                self.idempotence_keys[idempotence_key] = payment_id
+            return payment
+
+    def get(self, payment_id):
+        with self._lock:
+            self.requests['find'] += 1
+            return self.payments.get(payment_id)
+
+    def list(self, query):
+        """Страница списка платежей с фильтрами по статусу и дате создания."""
+        limit = min(int(query.get('limit', 10)), 100)
+        offset = int(query.get('cursor') or 0)
+        with self._lock:
+            self.requests['list'] += 1
+            payments = [
+                payment for payment in self.payments.values()
+                if query.get('status') in (None, payment['status'])
+                and query.get('created_at.gte', '') <= payment['created_at']
+            ]
+        payments.sort(key=lambda payment: payment['created_at'])
+        page = payments[offset:offset + limit]
+        response = {'type': 'list', 'items': page}
+        if offset + limit < len(payments):
+            response['next_cursor'] = str(offset + limit)
+        return response
+
+    def set_status(self, payment_id, status):
+        with self._lock:
+            payment = self.payments[payment_id]
+            payment['status'] = status
+            payment['paid'] = status == 'succeeded'
+            return payment
+
+    def pay(self, payment_id):
+        """Проводит платёж, как после оплаты на странице ЮKassa, и шлёт уведомление."""
+        if payment_id not in self.payments:
+            return None
+        payment = self.set_status(payment_id, 'succeeded')
+        self.send_webhook(payment_id)
+        return payment
+
+    def send_webhook(self, payment_id):
+        if self.webhook is None:
+            return
+        with self._lock:
+            self.requests['webhooks'] += 1
+        try:
+            self.webhook(self.notification(payment_id))
+        except Exception as e:
+            logger.warning(f"Stub webhook delivery failed for {payment_id}: {str(e)}")
+
+    def notification(self, payment_id, event=None):
+        """Тело уведомления, которое ЮKassa отправила бы на вебхук."""
+        with self._lock:
+            payment = dict(self.payments[payment_id])
+        return {
+            'type': 'notification',
+            'event': event or f"payment.{payment['status']}",
+            'object': payment,
+        }